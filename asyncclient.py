@@ -0,0 +1,442 @@
+#!/usr/bin/python3
+
+# Headless asyncio client for the v2 control protocol (see protocol.py).
+# Covers the lobby requests and multiplexed room chat without touching the
+# terminal, so the server can be driven from scripts, bots and load tests.
+#
+#   client = await AsyncChatClient.connect("127.0.0.1", 5000, "alice")
+#   room_id = await client.join("Group Chat")
+#   await client.publish(room_id, "hello")
+#   room_id, text = await client.nextMessage()
+#
+# Requests may be issued concurrently: each is written at once and its response
+# is matched by request id, so concurrent awaits are pipelined on the wire.
+#
+# Large messages and files are streamed in chunks (see protocol.py):
+#
+#   await client.sendStream(room_id, open("photo.jpg", "rb"), "photo.jpg", size)
+#   stream = await client.nextStream()
+#   data = await stream.read()
+
+import asyncio
+import json
+
+from compression import CODECS, acceptedCodec, compressOffer
+from framing import HEADER_BYTES, MAX_FRAME_BYTES
+from protocol import (
+    OP_BYE, OP_COMPRESSED, OP_CREATE_ROOM, OP_ERROR, OP_GET_ROOM, OP_HELLO, OP_HISTORY, OP_JOIN, OP_LEAVE,
+    OP_LIST_ROOMS, OP_PING, OP_PONG, OP_PROFILE, OP_PUBLISH, OP_STATS, OP_STREAM_CHUNK, OP_STREAM_DATA, OP_STREAM_END,
+    OP_STREAM_FINISH, OP_STREAM_OPEN, OP_STREAM_START, OP_WINDOW, PROTOCOL_ID, RequestError, decodeMessage,
+    encodeMessage, expandCompressed, fieldText, packU32, packU64, unpackInt
+)
+
+
+# Stream being received: iterate over it for its chunks, or read() it whole
+class IncomingStream:
+    def __init__(self, room_id: int, stream_id: int, sender: str, name: str, size: int):
+        self.ROOM_ID = room_id
+        self.STREAM_ID = stream_id
+        self.SENDER = sender
+        self.NAME = name
+        self.SIZE = size
+
+        # Chunks as they arrive; None once the stream has finished
+        self.chunks = asyncio.Queue()
+
+        # Why the stream was cut short, if it was
+        self.error = None
+
+
+    def finish(self, error: str = None) -> None:
+        self.error = error
+        self.chunks.put_nowait(None)
+
+
+    # Raises RequestError if the stream is cut short
+    async def __aiter__(self):
+        while True:
+            chunk = await self.chunks.get()
+
+            if chunk is None:
+                # Leave the marker for any other reader
+                self.chunks.put_nowait(None)
+
+                if self.error is not None:
+                    raise RequestError(self.error)
+
+                return
+
+            yield chunk
+
+
+    async def read(self) -> bytes:
+        return b"".join([chunk async for chunk in self])
+
+
+
+# Credit for a stream being sent
+class OutgoingWindow:
+    def __init__(self, credit: int):
+        self.credit = credit
+        self.changed = asyncio.Event()
+
+        # Set if the server aborts the stream
+        self.error = None
+
+
+class AsyncChatClient:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.nextRequestId = 1
+
+        # Request id -> future resolved with the response fields
+        self.pending = {}
+
+        # (opcode, fields) pushes in arrival order; None marks a closed connection
+        self.pushed = asyncio.Queue()
+
+        # Resume token and newest sequence number read, by room id, for resuming each
+        # session on a later connection
+        self.tokens = {}
+        self.lastSeqs = {}
+
+        # Streams being received by stream id, new ones in arrival order (None marks a closed
+        # connection), and the credit of streams being sent
+        self.receiving = {}
+        self.newStreams = asyncio.Queue()
+        self.windows = {}
+
+        # Compression codec the server accepted in the handshake, or None
+        self.codec = None
+
+        self.closed = False
+        self.readTask = asyncio.get_running_loop().create_task(self.readLoop())
+
+
+    # Open a connection and complete the HELLO handshake, offering to take compressed
+    # pushes unless compress is False. Given an SSLContext it connects over TLS; asyncio
+    # cannot offer a saved session, so every connection does a full handshake.
+    @classmethod
+    async def connect(cls, host: str, port: int, username: str, compress: bool = True, ssl_context=None):
+        reader, writer = await asyncio.open_connection(host, port, ssl=ssl_context)
+        client = cls(reader, writer)
+
+        try:
+            if compress:
+                client.codec = acceptedCodec(await client.request(OP_HELLO, PROTOCOL_ID, username, compressOffer(CODECS)))
+            else:
+                await client.request(OP_HELLO, PROTOCOL_ID, username)
+        except BaseException:
+            await client.close(bye=False)
+            raise
+
+        return client
+
+
+    async def close(self, bye: bool = True) -> None:
+        if self.closed:
+            return
+
+        self.closed = True
+
+        try:
+            if bye:
+                self.writer.write(encodeMessage(OP_BYE, 0))
+                await self.writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.writer.close()
+            self.readTask.cancel()
+
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+
+
+    def newRequestId(self) -> int:
+        request_id = self.nextRequestId
+
+        # Request id 0 is reserved for requests that want no response
+        self.nextRequestId = self.nextRequestId % 0xFFFFFFFF + 1
+
+        return request_id
+
+
+    # Route every response to its waiting request and every push to the queue
+    async def readLoop(self) -> None:
+        error = ConnectionError("Server closed the connection")
+
+        try:
+            while True:
+                header = await self.reader.readexactly(HEADER_BYTES)
+                msg_len = int.from_bytes(header, byteorder="big")
+
+                if msg_len > MAX_FRAME_BYTES:
+                    raise ConnectionError(f"Frame of {msg_len} bytes exceeds limit")
+
+                opcode, request_id, fields = decodeMessage(await self.reader.readexactly(msg_len))
+
+                # A compressed push carries whole frames, handled in order
+                if opcode == OP_COMPRESSED and self.codec is not None and fields:
+                    for frame in expandCompressed(self.codec, fields[0]):
+                        self.dispatch(*decodeMessage(frame))
+                else:
+                    self.dispatch(opcode, request_id, fields)
+        except (asyncio.IncompleteReadError, ConnectionError, RequestError, ValueError) as e:
+            if not isinstance(e, asyncio.IncompleteReadError):
+                error = ConnectionError(str(e))
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+
+            self.pending.clear()
+            self.pushed.put_nowait(None)
+
+            for stream in self.receiving.values():
+                stream.finish("Connection closed")
+
+            for window in self.windows.values():
+                window.error = "Connection closed"
+                window.changed.set()
+
+            self.receiving.clear()
+            self.newStreams.put_nowait(None)
+
+
+    def dispatch(self, opcode: int, request_id: int, fields: list) -> None:
+        fields = [bytes(field) for field in fields]
+
+        # Answer the server's heartbeat at once, so a quiet client is not taken for dead
+        if opcode == OP_PING:
+            self.writer.write(encodeMessage(OP_PONG, request_id))
+            return
+
+        if opcode in (OP_STREAM_START, OP_STREAM_CHUNK, OP_STREAM_FINISH, OP_WINDOW):
+            self.routeStream(opcode, fields)
+            return
+
+        future = self.pending.pop(request_id, None) if request_id else None
+
+        if future is None:
+            # A PONG nobody waits for answers a fire-and-forget PING
+            if opcode != OP_PONG:
+                self.pushed.put_nowait((opcode, fields))
+        elif not future.done():
+            future.set_result((opcode, fields))
+
+
+    def routeStream(self, opcode: int, fields: list) -> None:
+        stream_id = unpackInt(fields[0] if opcode != OP_STREAM_START else fields[1])
+
+        if opcode == OP_STREAM_CHUNK:
+            stream = self.receiving.get(stream_id)
+
+            if stream is not None:
+                stream.chunks.put_nowait(fields[1])
+        elif opcode == OP_STREAM_START:
+            stream = IncomingStream(unpackInt(fields[0]), stream_id, fieldText(fields[2]), fieldText(fields[3]), unpackInt(fields[4]))
+            self.receiving[stream_id] = stream
+            self.newStreams.put_nowait(stream)
+        elif opcode == OP_WINDOW:
+            window = self.windows.get(stream_id)
+
+            if window is not None:
+                window.credit += unpackInt(fields[1])
+                window.changed.set()
+        else:
+            error = fieldText(fields[1]) if len(fields) > 1 else None
+
+            # Aborted by the server while this client was sending it
+            if stream_id in self.windows:
+                self.windows[stream_id].error = error
+                self.windows[stream_id].changed.set()
+            elif stream_id in self.receiving:
+                self.receiving.pop(stream_id).finish(error)
+
+
+    def send(self, opcode: int, request_id: int, *fields) -> None:
+        if self.closed or self.readTask.done():
+            raise ConnectionError("Connection is closed")
+
+        self.writer.write(encodeMessage(opcode, request_id, *fields))
+
+
+    # Send one request and wait for its response fields.
+    # Raises RequestError if the server rejected it.
+    async def request(self, opcode: int, *fields) -> list:
+        request_id = self.newRequestId()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+
+        try:
+            self.send(opcode, request_id, *fields)
+        except ConnectionError:
+            del self.pending[request_id]
+            raise
+
+        await self.writer.drain()
+
+        opcode, fields = await future
+
+        if opcode == OP_ERROR:
+            raise RequestError(fieldText(fields[0]) if fields else "Request failed")
+
+        return fields
+
+
+    async def listRooms(self) -> list:
+        return [fieldText(field) for field in await self.request(OP_LIST_ROOMS)]
+
+
+    async def getRoom(self, name: str) -> int:
+        return unpackInt((await self.request(OP_GET_ROOM, name))[0])
+
+
+    async def createRoom(self, name: str) -> int:
+        return unpackInt((await self.request(OP_CREATE_ROOM, name))[0])
+
+
+    # (first sequence number, message texts oldest first)
+    async def history(self, room: str, before_seq: int, count: int):
+        fields = await self.request(OP_HISTORY, room, packU64(before_seq), packU32(count))
+
+        return unpackInt(fields[0]), [fieldText(field) for field in fields[1:]]
+
+
+    # Subscribe to a room on this connection; returns its room id. With the token and last
+    # sequence number of a session from an earlier connection, only the missed messages follow.
+    async def join(self, name: str, token: str = None, last_seq: int = 0) -> int:
+        if token is not None:
+            fields = await self.request(OP_JOIN, name, token, packU64(last_seq))
+        else:
+            fields = await self.request(OP_JOIN, name)
+
+        room_id = unpackInt(fields[0])
+        self.tokens[room_id] = fieldText(fields[1])
+
+        return room_id
+
+
+    async def leave(self, room_id: int) -> None:
+        await self.request(OP_LEAVE, packU32(room_id))
+
+
+    # Server stats, or one room's stats if a room name is given
+    async def stats(self, room: str = None) -> dict:
+        fields = await (self.request(OP_STATS, room) if room is not None else self.request(OP_STATS))
+
+        return json.loads(fields[0])
+
+
+    # Turn the server's profiler on or off (None leaves it as it is); returns its state
+    async def profile(self, action: str = None) -> dict:
+        fields = await (self.request(OP_PROFILE, action) if action is not None else self.request(OP_PROFILE))
+
+        return json.loads(fields[0])
+
+
+    # Round trip to the server and back
+    async def ping(self) -> None:
+        await self.request(OP_PING)
+
+
+    # Fire and forget: only a failure is answered, through nextMessage
+    async def publish(self, room_id: int, message: str) -> None:
+        self.send(OP_PUBLISH, 0, packU32(room_id), message)
+
+        await self.writer.drain()
+
+
+    # Next room message as (room id, text), waiting until one arrives.
+    # Raises RequestError for a failed fire-and-forget request and
+    # ConnectionError once the connection has closed.
+    async def nextMessage(self):
+        push = await self.pushed.get()
+
+        if push is None:
+            # Leave the marker for any other reader
+            self.pushed.put_nowait(None)
+            raise ConnectionError("Server closed the connection")
+
+        opcode, fields = push
+
+        if opcode == OP_ERROR:
+            raise RequestError(fieldText(fields[0]) if fields else "Request failed")
+
+        room_id = unpackInt(fields[0])
+
+        if len(fields) > 2:
+            self.lastSeqs[room_id] = unpackInt(fields[2])
+
+        return room_id, fieldText(fields[1])
+
+
+    # Stream a long message (bytes) or a file (a binary file object, with its size) to a room in
+    # chunks, sending no more than the server's window allows. Raises RequestError if the server
+    # aborts it.
+    async def sendStream(self, room_id: int, source, name: str = "", size: int = None) -> None:
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = memoryview(source)
+            size = len(source)
+
+        fields = await self.request(OP_STREAM_OPEN, packU32(room_id), name, packU64(size))
+        stream_id, credit, max_chunk = (unpackInt(field) for field in fields)
+        stream_field = packU32(stream_id)
+
+        window = self.windows[stream_id] = OutgoingWindow(credit)
+        sent = 0
+
+        try:
+            while sent < size:
+                while window.credit == 0 and window.error is None:
+                    window.changed.clear()
+                    await window.changed.wait()
+
+                if window.error is not None:
+                    raise RequestError(window.error)
+
+                count = min(max_chunk, window.credit, size - sent)
+
+                if isinstance(source, memoryview):
+                    chunk = source[sent:sent + count]
+                else:
+                    chunk = source.read(count)
+
+                if not chunk:
+                    await self.request(OP_STREAM_END, stream_field, "Source ended early")
+                    raise ValueError(f"Source ended after {sent} of {size} bytes")
+
+                self.send(OP_STREAM_DATA, 0, stream_field, chunk)
+                window.credit -= len(chunk)
+                sent += len(chunk)
+
+                await self.writer.drain()
+
+            await self.request(OP_STREAM_END, stream_field)
+        finally:
+            del self.windows[stream_id]
+
+
+    # Next stream sent to a room this client is in, waiting until one starts.
+    # Raises ConnectionError once the connection has closed.
+    async def nextStream(self) -> IncomingStream:
+        stream = await self.newStreams.get()
+
+        if stream is None:
+            self.newStreams.put_nowait(None)
+            raise ConnectionError("Server closed the connection")
+
+        return stream
+
+
+    # Yield room messages until the connection closes
+    async def messages(self):
+        while True:
+            try:
+                yield await self.nextMessage()
+            except ConnectionError:
+                return
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+# Compression benchmark for the loop server.
+# Publishes the same long chat messages to a room of v2 members, once with
+# compression negotiated and once without, and reports the bytes the server
+# queued to members and the bytes written for a HISTORY request covering every
+# message, plus what compressing one broadcast costs (done once however many
+# members it goes to). The clients share the server's process, so fan-out times
+# measured inside the server would mostly time them.
+#
+#   python3 benchmarks/compress.py [--members 50] [--messages 500] [--words 120]
+
+import argparse
+import asyncio
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from asyncclient import AsyncChatClient
+from compression import CODECS
+from console import console
+from protocol import encodeCompressed, encodeRoomMessage, packU32
+from reactor import LoopServer
+
+
+WORDS = (
+    "the be to of and a in that have it for not on with he as you do at this but his by from they we say her she or "
+    "an will my one all would there their what so up out if about who get which go me when make can like time no just "
+    "him know take people into year your good some could them see other than then now look only come its over think "
+    "also back after use two how our work first well way even new want because any these give day most us server room "
+    "message deploy build release branch merge review test failing passing latency queue socket thread meeting tomorrow"
+).split()
+
+
+def chatText(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+async def run(server, compress: bool, members: int, messages: int, words: int) -> dict:
+    port, room = server.SERVER_PORT, server.MAIN_ROOM
+    rng = random.Random(1)
+
+    sender = await AsyncChatClient.connect("127.0.0.1", port, "sender", compress)
+    clients = [await AsyncChatClient.connect("127.0.0.1", port, f"member{i}", compress) for i in range(members)]
+    room_id = await sender.join(room)
+
+    for client in clients:
+        await client.join(room)
+
+    before = server.roomStats(room)["bytes_out"]
+
+    async def receive(client):
+        seen = 0
+
+        while seen < messages:
+            _, text = await client.nextMessage()
+            seen += text.startswith("<sender>")
+
+    for _ in range(messages):
+        await sender.publish(room_id, chatText(rng, words))
+
+    await asyncio.gather(*[receive(client) for client in clients])
+
+    queued = server.roomStats(room)["bytes_out"] - before
+
+    # History replay of every message to a late joiner
+    late = await AsyncChatClient.connect("127.0.0.1", port, "late", compress)
+    conn = next(conn for conn in list(server.connectedUsers.values()) if conn.username == "late")
+
+    # The server thread counts a write after making it, so a round trip after each reply
+    # makes sure the reply's bytes have been counted
+    await late.ping()
+    written = conn.outbound.bytesWritten
+    await late.history(room, messages + 1, messages)
+    await late.ping()
+    history = conn.outbound.bytesWritten - written
+
+    for client in [sender, late] + clients:
+        await client.close()
+
+    return {"queued": queued, "history": history}
+
+
+# Microseconds to compress one MESSAGE push of the same kind of text
+def compressCost(codec, messages: int, words: int) -> float:
+    rng = random.Random(1)
+    frames = [encodeRoomMessage(packU32(1), chatText(rng, words), 1) for _ in range(messages)]
+
+    started = time.perf_counter()
+
+    for frame in frames:
+        encodeCompressed(codec, frame)
+
+    return (time.perf_counter() - started) * 1e6 / messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare room traffic with and without negotiated compression")
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--words", type=int, default=120)
+    args = parser.parse_args()
+
+    # Keep the server's console output out of the report
+    console.stream = io.StringIO()
+
+    for compress in (False, True):
+        # HISTORY is served from the room logs
+        server = LoopServer(port=0, log_dir=tempfile.mkdtemp())
+        server.CLIENT_MESSAGE_RATE = server.CLIENT_BYTE_RATE = None
+        server.ROOM_MESSAGE_RATE = server.ROOM_BYTE_RATE = None
+        threading.Thread(target=server.serverMain, daemon=True).start()
+
+        result = asyncio.run(run(server, compress, args.members, args.messages, args.words))
+        copies = args.members * args.messages
+
+        print(f"{'compressed' if compress else 'plain':>10}: {result['queued'] / copies:8.1f} bytes per delivered message, "
+              f"history of {args.messages} messages {result['history']} bytes")
+
+    for codec in CODECS.values():
+        print(f"{codec.NAME}: {compressCost(codec, args.messages, args.words):.1f} us to compress one broadcast")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+
+# Fan-out syscall benchmark for the loop server.
+# Runs the same burst through a room with per-frame writes and with coalesced
+# gathered writes, and reports write syscalls per delivered message for each.
+#
+#   python3 benchmarks/fanout.py [--members 50] [--messages 2000] [--burst 20]
+
+import argparse
+import io
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from console import console
+from framing import FrameDecoder, encodeFrame
+from reactor import LoopServer
+
+
+def joinRoom(port: int, username: str, room: str):
+    sock = socket.create_connection(("127.0.0.1", port))
+
+    for message in (username, "JOIN_ROOM", room):
+        sock.sendall(encodeFrame(message))
+
+    return sock
+
+
+# Read until the member has seen every message from the sender
+def receive(sock, count: int, done: threading.Event) -> None:
+    decoder = FrameDecoder()
+    seen = 0
+
+    while seen < count:
+        if decoder.feed(sock) == 0:
+            break
+
+        for frame in decoder.frames():
+            if bytes(frame[:7]) == b"<sender":
+                seen += 1
+
+    done.set()
+
+
+def runBurst(coalesce: bool, members: int, messages: int, burst: int) -> dict:
+    # Keep the server's per-message console output out of the measurement
+    console.stream = io.StringIO()
+
+    server = LoopServer(port=0, log_dir="")
+    server.COALESCE_WRITES = coalesce
+
+    # One sender floods the room on purpose
+    server.CLIENT_MESSAGE_RATE = server.CLIENT_BYTE_RATE = None
+    server.ROOM_MESSAGE_RATE = server.ROOM_BYTE_RATE = None
+    threading.Thread(target=server.serverMain, daemon=True).start()
+
+    room = server.MAIN_ROOM
+    receivers = [joinRoom(server.SERVER_PORT, f"member{i}", room) for i in range(members)]
+    sender = joinRoom(server.SERVER_PORT, "sender", room)
+
+    # Wait for every join to land before counting writes
+    while len(server.openRooms[room].members) < members + 1:
+        time.sleep(0.01)
+    time.sleep(0.2)
+
+    for conn in server.connectedUsers.values():
+        conn.outbound.writeCalls = conn.outbound.framesWritten = 0
+
+    events = []
+    for sock in receivers:
+        done = threading.Event()
+        events.append(done)
+        threading.Thread(target=receive, args=(sock, messages, done), daemon=True).start()
+
+    start = time.perf_counter()
+
+    # Send in bursts so several messages land in the same loop iteration
+    for first in range(0, messages, burst):
+        sender.sendall(b"".join(encodeFrame(f"msg {i}") for i in range(first, min(first + burst, messages))))
+
+    for done in events:
+        done.wait()
+
+    elapsed = time.perf_counter() - start
+
+    write_calls = sum(conn.outbound.writeCalls for conn in server.connectedUsers.values())
+    frames = sum(conn.outbound.framesWritten for conn in server.connectedUsers.values())
+
+    for sock in receivers + [sender]:
+        sock.close()
+    server.server.close()
+
+    return {
+        "writes": write_calls,
+        "frames": frames,
+        "writes_per_message": write_calls / max(frames, 1),
+        "seconds": elapsed
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure write syscalls per delivered room message")
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--burst", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{args.members} members, {args.messages} messages in bursts of {args.burst}")
+
+    for coalesce in (False, True):
+        result = runBurst(coalesce, args.members, args.messages, args.burst)
+        label = "coalesced sendmsg" if coalesce else "per-frame send"
+
+        print(f"{label:>18}: {result['writes']} writes for {result['frames']} frames "
+              f"({result['writes_per_message']:.3f} per delivered message, {result['seconds']:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
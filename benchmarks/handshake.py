@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+
+# TLS connect benchmark for the loop server. Makes a self-signed certificate with
+# the openssl command, then opens connections to the server plaintext, over TLS
+# with a full handshake each time, and over TLS resuming the session of an earlier
+# connection (as a client entering a room does), and reports the time per connect
+# on the client (connect, handshake and a HELLO round trip) and in the server loop.
+#
+#   python3 benchmarks/handshake.py [--connects 500] [--key ec|rsa]
+
+import argparse
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from console import console
+from protocol import ControlClient
+from reactor import LoopServer
+from tls import TLSConnector, clientContext
+
+
+# Self-signed certificate for 127.0.0.1 in directory; returns (certificate file, key file)
+def makeCertificate(directory: str, key: str):
+    cert_file = os.path.join(directory, "cert.pem")
+    key_file = os.path.join(directory, "key.pem")
+    new_key = ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1"] if key == "ec" else ["-newkey", "rsa:2048"]
+
+    subprocess.run(["openssl", "req", "-x509", *new_key, "-nodes", "-keyout", key_file, "-out", cert_file, "-days", "1",
+                    "-subj", "/CN=localhost", "-addext", "subjectAltName=IP:127.0.0.1"], check=True, capture_output=True)
+
+    return cert_file, key_file
+
+
+# Seconds per connect on the client and in the server loop
+def run(server, connects: int, connector=None, fresh: bool = False) -> dict:
+    address = ("127.0.0.1", server.SERVER_PORT)
+    timings = []
+    loop_seconds = server.stats.loopSeconds.sum
+
+    for i in range(connects):
+        # A full handshake every time: nothing is kept from the last connection
+        if fresh:
+            connector.forget(address)
+
+        started = time.perf_counter()
+        client = ControlClient(*address, f"user{i}", compress=False, tls=connector)
+        timings.append(time.perf_counter() - started)
+        client.close()
+
+    # Let the server finish with the last connection before reading its loop time
+    time.sleep(0.05)
+    timings.sort()
+
+    return {
+        "mean": sum(timings) / connects,
+        "p50": timings[connects // 2],
+        "p99": timings[min(connects - 1, connects * 99 // 100)],
+        "server": (server.stats.loopSeconds.sum - loop_seconds) / connects
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure what TLS and session resumption cost per connect")
+    parser.add_argument("--connects", type=int, default=500)
+    parser.add_argument("--key", choices=("ec", "rsa"), default="ec")
+    args = parser.parse_args()
+
+    # Keep the server's console output out of the report
+    console.stream = io.StringIO()
+
+    with tempfile.TemporaryDirectory() as directory:
+        cert_file, key_file = makeCertificate(directory, args.key)
+
+        server = LoopServer(port=0, log_dir="", tls_cert=cert_file, tls_key=key_file)
+        threading.Thread(target=server.serverMain, daemon=True).start()
+
+        plain = run(server, args.connects)
+
+        full_connector = TLSConnector(clientContext(cert_file))
+        full = run(server, args.connects, full_connector, fresh=True)
+
+        resumed_connector = TLSConnector(clientContext(cert_file))
+        resumed = run(server, args.connects, resumed_connector)
+
+    for label, result in (("plaintext         ", plain), ("TLS, full         ", full), ("TLS, resumed      ", resumed)):
+        print(f"{label}: mean {result['mean'] * 1e3:6.2f} ms, p50 {result['p50'] * 1e3:6.2f} ms, p99 {result['p99'] * 1e3:6.2f} ms per connect, "
+              f"server loop {result['server'] * 1e3:6.2f} ms")
+
+    print(f"  {resumed_connector.resumed} of {resumed_connector.handshakes} connects resumed a session "
+          f"({server.stats.tlsResumed} of {server.stats.tlsHandshakes} handshakes on the server, {args.key} key)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+
+# Load generator and latency benchmark for the loop server.
+# Starts a server process, connects simulated users spread over rooms through
+# the asyncio client (in several client processes), has them publish at a fixed
+# total rate, and reports delivery throughput, end-to-end latency percentiles
+# and server CPU time per message.
+#
+#   python3 benchmarks/load.py [--users 2000] [--rooms 20] [--rate 50] [--duration 10]
+#   python3 benchmarks/load.py --save-baseline benchmarks/load_baseline.json
+#   python3 benchmarks/load.py --baseline benchmarks/load_baseline.json [--tolerance 0.25]
+#
+# Every message carries its send time (CLOCK_MONOTONIC, shared by all processes
+# on the host); latency is measured when each member receives it. With
+# --baseline the run is compared metric by metric and the exit status is 1 if
+# any metric regressed by more than the tolerance.
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from asyncclient import AsyncChatClient
+from console import console
+from reactor import LoopServer
+
+
+HOST = "127.0.0.1"
+
+# Simultaneous connection attempts per client process (stays under the listen backlog)
+CONNECT_CONCURRENCY = 64
+
+# Metrics compared against a baseline, and whether a larger value is better
+METRICS = {
+    "deliveries_per_sec": True,
+    "latency_p50_ms": False,
+    "latency_p99_ms": False,
+    "latency_p999_ms": False,
+    "server_cpu_us_per_message": False,
+    "server_cpu_us_per_delivery": False
+}
+
+
+def roomName(index: int) -> str:
+    return f"load-{index}"
+
+
+def runServer(port_pipe, log_dir: str) -> None:
+    # Per-message console output would dominate the server's CPU time
+    with open(os.devnull, "w") as devnull:
+        console.stream = devnull
+        server = LoopServer(port=0, log_dir=log_dir)
+        server.MAX_ROOMS = 1 << 20
+
+        # The listening socket is bound to a free port; report which
+        port_pipe.send(server.SERVER_PORT)
+        port_pipe.close()
+
+        server.serverMain()
+
+
+# Server process CPU time (user + system) in seconds
+def processCpu(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as stat:
+        # Fields after the parenthesised command name; utime and stime are fields 14 and 15
+        fields = stat.read().rsplit(")", 1)[1].split()
+
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+
+    return sorted_values[index]
+
+
+async def receive(client: AsyncChatClient, measure_from: int, latencies: list, counts: dict) -> None:
+    async for _, text in client.messages():
+        # "<user> <send time ns>"; presence and other notices have no timestamp
+        sent = text.rsplit(" ", 1)[-1]
+
+        if not sent.isdigit():
+            continue
+
+        counts["received"] += 1
+        sent = int(sent)
+
+        if sent >= measure_from:
+            latencies.append(time.monotonic_ns() - sent)
+
+
+async def clientMain(port: int, users: range, rooms: int, rate: float, barrier, start_at, args) -> dict:
+    limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def connect(index: int):
+        async with limit:
+            client = await AsyncChatClient.connect(HOST, port, f"user{index}")
+            room_id = await client.join(roomName(index % rooms))
+
+            return client, room_id
+
+    members = await asyncio.gather(*(connect(index) for index in users))
+
+    # Every process is connected and joined; the second wait hands out the common start time
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+
+    start = start_at.value
+    measure_from = start + int(args.warmup * 1e9)
+    stop = start + int((args.warmup + args.duration) * 1e9)
+
+    latencies = []
+    counts = {"received": 0, "published": 0, "measured": 0}
+    receivers = [asyncio.create_task(receive(client, measure_from, latencies, counts)) for client, _ in members]
+
+    await asyncio.sleep(max(0.0, (start - time.monotonic_ns()) / 1e9))
+
+    # Publish at a fixed rate, round-robin over this process's users
+    interval = 1.0 / rate
+    sent = 0
+    next_member = 0
+
+    while time.monotonic_ns() < stop:
+        due = int((time.monotonic_ns() - start) / 1e9 / interval) + 1
+
+        while sent < due:
+            client, room_id = members[next_member]
+            next_member = (next_member + 1) % len(members)
+
+            now = time.monotonic_ns()
+            await client.publish(room_id, str(now))
+            sent += 1
+
+            if measure_from <= now < stop:
+                counts["measured"] += 1
+
+        await asyncio.sleep(interval)
+
+    counts["published"] = sent
+
+    # Let deliveries in flight arrive
+    await asyncio.sleep(args.drain)
+
+    for task in receivers:
+        task.cancel()
+
+    await asyncio.gather(*(client.close() for client, _ in members), return_exceptions=True)
+
+    return {"latencies": latencies, **counts}
+
+
+def runClients(port: int, users: range, rooms: int, rate: float, barrier, start_at, args, result_pipe) -> None:
+    result = asyncio.run(clientMain(port, users, rooms, rate, barrier, start_at, args))
+
+    result_pipe.send(result)
+    result_pipe.close()
+
+
+async def createRooms(port: int, rooms: int) -> None:
+    client = await AsyncChatClient.connect(HOST, port, "load-admin")
+
+    await asyncio.gather(*(client.createRoom(roomName(index)) for index in range(rooms)))
+    await client.close()
+
+
+def runLoad(args) -> dict:
+    context = multiprocessing.get_context("fork")
+
+    port_reader, port_writer = context.Pipe(duplex=False)
+    server = context.Process(target=runServer, args=(port_writer, args.log_dir), daemon=True)
+    server.start()
+    port = port_reader.recv()
+
+    try:
+        asyncio.run(createRooms(port, args.rooms))
+
+        # Each client process gets a contiguous slice of users and a share of the rate
+        procs = max(1, min(args.client_procs, args.users))
+        barrier = context.Barrier(procs + 1)
+        start_at = context.Value("q", 0)
+        clients = []
+
+        for proc in range(procs):
+            users = range(proc * args.users // procs, (proc + 1) * args.users // procs)
+            result_reader, result_writer = context.Pipe(duplex=False)
+
+            worker = context.Process(
+                target=runClients,
+                args=(port, users, args.rooms, args.rate / procs, barrier, start_at, args, result_writer),
+                daemon=True
+            )
+            worker.start()
+            clients.append((worker, result_reader))
+
+        # Start a moment after everyone is ready so the senders line up
+        barrier.wait()
+        start = time.monotonic_ns() + int(0.2e9)
+        start_at.value = start
+        barrier.wait()
+
+        # Server CPU is sampled over the measured window only
+        time.sleep(max(0.0, start / 1e9 + args.warmup - time.monotonic()))
+        cpu_before = processCpu(server.pid)
+        time.sleep(max(0.0, start / 1e9 + args.warmup + args.duration - time.monotonic()))
+        cpu_after = processCpu(server.pid)
+
+        results = [reader.recv() for _, reader in clients]
+
+        for worker, _ in clients:
+            worker.join()
+    finally:
+        server.terminate()
+        server.join()
+
+    latencies = sorted(latency for result in results for latency in result["latencies"])
+    published = sum(result["published"] for result in results)
+    received = sum(result["received"] for result in results)
+    cpu = cpu_after - cpu_before
+    members_per_room = args.users / args.rooms
+    measured_messages = max(sum(result["measured"] for result in results), 1)
+
+    return {
+        "published": published,
+        "deliveries": received,
+        "expected_deliveries": round(published * (members_per_room - 1)),
+        "deliveries_per_sec": round(len(latencies) / args.duration, 1),
+        "delivery_ratio": round(len(latencies) / (measured_messages * (members_per_room - 1)), 4),
+        "latency_p50_ms": round(percentile(latencies, 0.50) / 1e6, 3),
+        "latency_p99_ms": round(percentile(latencies, 0.99) / 1e6, 3),
+        "latency_p999_ms": round(percentile(latencies, 0.999) / 1e6, 3),
+        "latency_max_ms": round((latencies[-1] if latencies else 0) / 1e6, 3),
+        "server_cpu_seconds": round(cpu, 3),
+        "server_cpu_us_per_message": round(cpu / measured_messages * 1e6, 2),
+        "server_cpu_us_per_delivery": round(cpu / max(len(latencies), 1) * 1e6, 3)
+    }
+
+
+# Print each metric next to the baseline; returns the regressed metric names
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+
+    for name, higher_is_better in METRICS.items():
+        old = baseline["results"].get(name)
+        new = results[name]
+
+        if not old:
+            continue
+
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = ""
+
+        if worse > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+
+        print(f"{name:>28}: {new:>10} (baseline {old}, {change:+.1%}){flag}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated-user load test for the loop server")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=50.0, help="messages published per second, over all users")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds of load before measuring")
+    parser.add_argument("--drain", type=float, default=1.0, help="seconds to wait for deliveries after publishing stops")
+    parser.add_argument("--client-procs", type=int, default=max(1, min(4, (os.cpu_count() or 2) - 1)))
+    parser.add_argument("--log-dir", default="", help="room message log directory (empty disables logs)")
+    parser.add_argument("--save-baseline", metavar="PATH", help="write this run's results as the new baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="compare against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression per metric")
+    args = parser.parse_args()
+
+    config = {
+        "users": args.users,
+        "rooms": args.rooms,
+        "rate": args.rate,
+        "duration": args.duration,
+        "warmup": args.warmup,
+        "client_procs": args.client_procs,
+        "log_dir": args.log_dir
+    }
+
+    print(f"{args.users} users in {args.rooms} rooms, {args.rate:g} messages/s for {args.duration:g}s "
+          f"(+{args.warmup:g}s warmup, {args.client_procs} client processes)")
+
+    results = runLoad(args)
+
+    for name, value in results.items():
+        print(f"{name:>28}: {value}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as out:
+            json.dump({
+                "config": config,
+                "host": {"python": platform.python_version(), "cpus": os.cpu_count()},
+                "results": results
+            }, out, indent=4)
+            out.write("\n")
+
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as saved:
+            baseline = json.load(saved)
+
+        if baseline["config"] != config:
+            print(f"Warning: baseline was recorded with {baseline['config']}")
+
+        print(f"\nCompared with {args.baseline} (tolerance {args.tolerance:.0%}):")
+
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+
+# Federation benchmark: several loop server nodes on localhost, linked into a
+# full mesh. Members of one room are spread over the nodes; senders on every
+# node publish, and the report gives delivery latency to members on the
+# sender's own node and on the others, plus the relays each node sent (one per
+# link per message) and any duplicates dropped.
+#
+#   python3 benchmarks/mesh.py [--nodes 3] [--members 30] [--messages 300]
+
+import argparse
+import asyncio
+import io
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from asyncclient import AsyncChatClient
+from console import console
+from reactor import LoopServer
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def freePorts(count: int) -> list:
+    socks = [socket.socket() for _ in range(count)]
+
+    for sock in socks:
+        sock.bind(("127.0.0.1", 0))
+
+    ports = [sock.getsockname()[1] for sock in socks]
+
+    for sock in socks:
+        sock.close()
+
+    return ports
+
+
+async def run(servers: list, members: int, messages: int) -> dict:
+    room = servers[0].MAIN_ROOM
+    nodes = len(servers)
+
+    # Members round-robin over the nodes, then one sender per node
+    clients = []
+
+    for i in range(members):
+        client = await AsyncChatClient.connect("127.0.0.1", servers[i % nodes].SERVER_PORT, f"member{i}")
+        await client.join(room)
+        clients.append((i % nodes, client))
+
+    senders = []
+
+    for node, server in enumerate(servers):
+        sender = await AsyncChatClient.connect("127.0.0.1", server.SERVER_PORT, f"sender{node}")
+        senders.append((node, sender, await sender.join(room)))
+
+    local, remote = [], []
+
+    async def receive(node: int, client) -> None:
+        seen = 0
+
+        while seen < messages:
+            _, text = await client.nextMessage()
+
+            if not text.startswith("<sender"):
+                continue
+
+            # "<senderN> <perf counter>"
+            origin = int(text[7:text.index(">")])
+            latency = (time.perf_counter() - float(text.split()[-1])) * 1000
+            (local if origin == node else remote).append(latency)
+            seen += 1
+
+    async def send() -> None:
+        for i in range(messages):
+            node, sender, room_id = senders[i % nodes]
+            await sender.publish(room_id, f"{time.perf_counter()}")
+            await asyncio.sleep(0.001)
+
+    started = time.perf_counter()
+    await asyncio.gather(send(), *[receive(node, client) for node, client in clients])
+    elapsed = time.perf_counter() - started
+
+    for _, client in clients:
+        await client.close()
+
+    for _, sender, _ in senders:
+        await sender.close()
+
+    return {"seconds": elapsed, "local": local, "remote": remote}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure room delivery across federated nodes")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--members", type=int, default=30)
+    parser.add_argument("--messages", type=int, default=300)
+    args = parser.parse_args()
+
+    # Keep the servers' console output out of the report
+    console.stream = io.StringIO()
+
+    ports = freePorts(args.nodes)
+    servers = []
+
+    for node, port in enumerate(ports):
+        peers = [f"127.0.0.1:{other}" for other in ports if other != port]
+        server = LoopServer(port=port, log_dir="", node=f"node{node}", peers=peers)
+        server.CLIENT_MESSAGE_RATE = server.CLIENT_BYTE_RATE = None
+        server.ROOM_MESSAGE_RATE = server.ROOM_BYTE_RATE = None
+        threading.Thread(target=server.serverMain, daemon=True).start()
+        servers.append(server)
+
+    # Let the mesh come up
+    deadline = time.monotonic() + 10.0
+
+    while any(server.federation.linksUp() < args.nodes - 1 for server in servers) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    result = asyncio.run(run(servers, args.members, args.messages))
+
+    print(f"{args.messages} messages from {args.nodes} nodes to {args.members} members in {result['seconds']:.2f}s")
+    print(f"  same node:    p50 {percentile(result['local'], 0.5):.2f} ms, p99 {percentile(result['local'], 0.99):.2f} ms")
+    print(f"  other nodes:  p50 {percentile(result['remote'], 0.5):.2f} ms, p99 {percentile(result['remote'], 0.99):.2f} ms")
+
+    for server in servers:
+        stats = server.serverStats()
+        print(f"  {server.NODE_NAME}: {stats['relays_out']} relays sent, {stats['relays_in']} received, {stats['relay_duplicates']} duplicates")
+
+
+if __name__ == "__main__":
+    main()
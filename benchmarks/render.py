@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+# Client rendering benchmark. A burst of room messages arrives on a socket and
+# is shown on a pseudo-terminal, first the way the client used to (two prints
+# per message) and then through terminal.Renderer; reports how long the client
+# took to read the burst, how long until the last line was drawn, the terminal
+# writes it made and the lines it skipped to stay within its scrollback.
+#
+#   python3 benchmarks/render.py [--messages 10000] [--length 80] [--scrollback 1000]
+
+import argparse
+import os
+import pty
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from framing import FrameDecoder, encodeFrame, frameText
+from terminal import Renderer
+
+
+# Read the terminal side the way a terminal emulator would, until the last line shows up
+def drainTerminal(master: int, marker: bytes, done: threading.Event) -> None:
+    tail = b""
+
+    while not done.is_set():
+        tail = (tail + os.read(master, 65536))[-len(marker) * 2:]
+
+        if marker in tail:
+            done.set()
+
+
+# Counts the writes reaching the terminal
+class CountingStream:
+    def __init__(self, stream):
+        self.stream = stream
+        self.writes = 0
+
+
+    def write(self, text: str) -> int:
+        self.writes += 1
+
+        return self.stream.write(text)
+
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+
+def run(messages: int, length: int, scrollback: int, batched: bool) -> dict:
+    master, slave = pty.openpty()
+    terminal = CountingStream(open(slave, "w", buffering=1, closefd=True))
+
+    marker = b"last-message"
+    done = threading.Event()
+    threading.Thread(target=drainTerminal, args=(master, marker, done), daemon=True).start()
+
+    sender, receiver = socket.socketpair()
+    burst = b"".join(encodeFrame(f"{seq} <bob> " + "x" * length) for seq in range(1, messages)) + encodeFrame(f"{messages} last-message")
+    threading.Thread(target=sender.sendall, args=(burst,), daemon=True).start()
+
+    renderer = Renderer("<You> ", scrollback=scrollback, stream=terminal) if batched else None
+    decoder = FrameDecoder()
+    received = 0
+
+    started = time.perf_counter()
+
+    while received < messages:
+        decoder.feed(receiver)
+
+        for frame in decoder.frames():
+            _, _, text = frameText(frame).partition(" ")
+            received += 1
+
+            if renderer is not None:
+                renderer.show(text)
+            else:
+                print("\r" + text, file=terminal)
+                print("\r<You> ", end="", file=terminal)
+
+    read = time.perf_counter() - started
+    skipped = 0
+
+    if renderer is not None:
+        renderer.close()
+        skipped = renderer.skippedLines
+
+    done.wait()
+    drawn = time.perf_counter() - started
+
+    sender.close()
+    receiver.close()
+    terminal.stream.close()
+    os.close(master)
+
+    return {"read": read, "drawn": drawn, "writes": terminal.writes, "skipped": skipped}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how fast the client shows a burst of messages")
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--length", type=int, default=80)
+    parser.add_argument("--scrollback", type=int, default=1000)
+    args = parser.parse_args()
+
+    for name, batched in (("print per message", False), ("batched renderer", True)):
+        result = run(args.messages, args.length, args.scrollback, batched)
+
+        print(f"{name:18}: burst read in {result['read'] * 1000:7.1f} ms, last line drawn after {result['drawn'] * 1000:7.1f} ms, "
+              f"{result['writes']} terminal writes, {result['skipped']} lines skipped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+# Room scaling benchmark for the loop server.
+# Creates N rooms and reports the memory each one costs while idle and once
+# hibernated, then times CREATE_ROOM and JOIN round trips with N rooms open.
+#
+#   python3 benchmarks/rooms.py [--rooms 100000] [--samples 1000]
+
+import argparse
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from console import console
+from protocol import OP_CREATE_ROOM, ControlClient
+from reactor import LoopServer
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def timeRequests(request, count: int) -> list:
+    samples = []
+
+    for i in range(count):
+        start = time.perf_counter()
+        request(i)
+        samples.append(time.perf_counter() - start)
+
+    return samples
+
+
+def report(label: str, samples: list) -> None:
+    print(f"{label:>26}: mean {1e6 * sum(samples) / len(samples):7.1f} us, "
+          f"p99 {1e6 * percentile(samples, 0.99):7.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure memory and create/join cost with many rooms")
+    parser.add_argument("--rooms", type=int, default=100000)
+    parser.add_argument("--samples", type=int, default=1000)
+    args = parser.parse_args()
+
+    # Keep the server's per-room console output out of the report. It is written by the console's
+    # own thread, which may still be draining after the block; writes to the closed file are dropped.
+    with open(os.devnull, "w") as devnull:
+        console.stream = devnull
+        server = LoopServer(port=0, log_dir="")
+        server.MAX_ROOMS = args.rooms + args.samples + 1
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+
+        for i in range(args.rooms):
+            server.addRoom(f"room-{i}")
+
+        live = tracemalloc.get_traced_memory()[0]
+
+        # Hibernate every idle room at once
+        server.ROOM_IDLE_SECONDS = 0
+        server.hibernateIdleRooms()
+        server.ROOM_IDLE_SECONDS = 300.0
+
+        hibernated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        threading.Thread(target=server.serverMain, daemon=True).start()
+        client = ControlClient("127.0.0.1", server.SERVER_PORT, "bench")
+
+        create = timeRequests(lambda i: client.request(OP_CREATE_ROOM, f"new-{i}"), args.samples)
+
+        # First join wakes a hibernated room; joining it again after LEAVE finds it live
+        room_ids = []
+        wake = timeRequests(lambda i: room_ids.append(client.join(f"room-{i}")), args.samples)
+
+        for room_id in room_ids:
+            client.leave(room_id)
+
+        rejoin = timeRequests(lambda i: client.join(f"room-{i}"), args.samples)
+        client.pushed.clear()
+
+        client.close()
+
+        while server.connectedUsers:
+            time.sleep(0.01)
+        server.server.close()
+
+    print(f"{args.rooms} rooms, {args.samples} samples per request type")
+    print(f"{'idle room':>26}: {(live - before) / args.rooms:7.0f} bytes")
+    print(f"{'hibernated room':>26}: {(hibernated - before) / args.rooms:7.0f} bytes")
+
+    report("CREATE_ROOM", create)
+    report("JOIN (hibernated room)", wake)
+    report("JOIN (live room)", rejoin)
+
+
+if __name__ == "__main__":
+    main()
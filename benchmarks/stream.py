@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+# Streamed transfer benchmark for the loop server.
+# One member streams a large payload to a room while another publishes small
+# chat messages; reports transfer throughput, chat latency with and without
+# the transfer running, and the most bytes the server held queued for clients.
+#
+#   python3 benchmarks/stream.py [--members 10] [--megabytes 64] [--chat-interval 0.02]
+
+import argparse
+import asyncio
+import io
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from asyncclient import AsyncChatClient
+from console import console
+from reactor import LoopServer
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+# Most bytes queued for clients at any sample, read from the server thread's state
+def sampleQueues(server, peak: list, stop: threading.Event) -> None:
+    while not stop.is_set():
+        try:
+            queued = sum(conn.outbound.queuedBytes + conn.outbound.bulkBytes for conn in list(server.connectedUsers.values()))
+            peak[0] = max(peak[0], queued)
+        except RuntimeError:
+            pass
+
+        time.sleep(0.001)
+
+
+# Chat round trips from the chatter to a listener while `running` is set
+async def measureChat(chatter, listener, room_id: int, interval: float, running) -> list:
+    latencies = []
+
+    while running():
+        sent = time.perf_counter()
+        await chatter.publish(room_id, f"chat {sent}")
+
+        while True:
+            _, text = await listener.nextMessage()
+
+            if text.startswith("<chatter> chat"):
+                latencies.append((time.perf_counter() - float(text.split()[-1])) * 1000)
+                break
+
+        await asyncio.sleep(interval)
+
+    return latencies
+
+
+async def run(server, members: int, megabytes: int, interval: float) -> dict:
+    port, room = server.SERVER_PORT, server.MAIN_ROOM
+
+    sender = await AsyncChatClient.connect("127.0.0.1", port, "sender")
+    chatter = await AsyncChatClient.connect("127.0.0.1", port, "chatter")
+    receivers = [await AsyncChatClient.connect("127.0.0.1", port, f"member{i}") for i in range(members)]
+
+    room_id = await sender.join(room)
+    chat_room_id = await chatter.join(room)
+
+    for receiver in receivers:
+        await receiver.join(room)
+
+    # Chat latency on an idle room first
+    deadline = time.perf_counter() + 1.0
+    idle = await measureChat(chatter, receivers[0], chat_room_id, interval, lambda: time.perf_counter() < deadline)
+
+    payload = os.urandom(megabytes * 1024 * 1024)
+    received = []
+
+    async def receive(receiver):
+        stream = await receiver.nextStream()
+        size = 0
+
+        async for chunk in stream:
+            size += len(chunk)
+
+        received.append(size)
+
+    transferring = [True]
+
+    async def send():
+        await sender.sendStream(room_id, payload, "payload.bin")
+
+        # Done once every member has the whole payload
+        while len(received) < members:
+            await asyncio.sleep(0.01)
+
+        transferring[0] = False
+
+    started = time.perf_counter()
+    busy = (await asyncio.gather(
+        send(),
+        measureChat(chatter, receivers[0], chat_room_id, interval, lambda: transferring[0]),
+        *[receive(receiver) for receiver in receivers]
+    ))[1]
+    elapsed = time.perf_counter() - started
+
+    for client in [sender, chatter] + receivers:
+        await client.close()
+
+    return {
+        "seconds": elapsed,
+        "complete": all(size == len(payload) for size in received),
+        "idle": idle,
+        "busy": busy
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure streamed transfers and chat latency alongside them")
+    parser.add_argument("--members", type=int, default=10)
+    parser.add_argument("--megabytes", type=int, default=64)
+    parser.add_argument("--chat-interval", type=float, default=0.02)
+    args = parser.parse_args()
+
+    # Keep the server's console output out of the report
+    console.stream = io.StringIO()
+
+    server = LoopServer(port=0, log_dir="")
+    server.CLIENT_MESSAGE_RATE = server.CLIENT_BYTE_RATE = None
+    server.ROOM_MESSAGE_RATE = server.ROOM_BYTE_RATE = None
+    threading.Thread(target=server.serverMain, daemon=True).start()
+
+    peak = [0]
+    stop = threading.Event()
+    threading.Thread(target=sampleQueues, args=(server, peak, stop), daemon=True).start()
+
+    result = asyncio.run(run(server, args.members, args.megabytes, args.chat_interval))
+    stop.set()
+
+    delivered = args.megabytes * args.members / result["seconds"]
+
+    print(f"{args.megabytes} MB to {args.members} members in {result['seconds']:.2f}s "
+          f"({delivered:.1f} MB/s delivered, complete: {result['complete']})")
+    print(f"  chat latency idle:         p50 {percentile(result['idle'], 0.5):.2f} ms, p99 {percentile(result['idle'], 0.99):.2f} ms")
+    print(f"  chat latency during stream: p50 {percentile(result['busy'], 0.5):.2f} ms, p99 {percentile(result['busy'], 0.99):.2f} ms")
+    print(f"  peak bytes queued by the server: {peak[0]} (window {server.STREAM_WINDOW})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+# Profiler overhead benchmark for the loop server.
+# Publishes chat messages to a room of v2 members with the profiler off and then
+# on, and reports delivery throughput and the mean loop pass for each, with the
+# phase split the loop traces recorded while it was on.
+#
+#   python3 benchmarks/tracing.py [--members 20] [--messages 2000] [--rounds 3]
+
+import argparse
+import asyncio
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from asyncclient import AsyncChatClient
+from console import console
+from profiler import PHASES, profiler
+from reactor import LoopServer
+
+
+async def run(server, members: int, messages: int) -> dict:
+    port, room = server.SERVER_PORT, server.MAIN_ROOM
+
+    sender = await AsyncChatClient.connect("127.0.0.1", port, "sender", False)
+    clients = [await AsyncChatClient.connect("127.0.0.1", port, f"member{i}", False) for i in range(members)]
+    room_id = await sender.join(room)
+
+    for client in clients:
+        await client.join(room)
+
+    async def receive(client):
+        seen = 0
+
+        while seen < messages:
+            _, text = await client.nextMessage()
+            seen += text.startswith("<sender>")
+
+    passes, loop_seconds = server.stats.loopSeconds.count, server.stats.loopSeconds.sum
+    started = time.perf_counter()
+
+    for i in range(messages):
+        await sender.publish(room_id, f"message {i}")
+
+    await asyncio.gather(*[receive(client) for client in clients])
+    elapsed = time.perf_counter() - started
+
+    # Loop passes are timed from the end of their select, so waiting is not counted
+    passes = server.stats.loopSeconds.count - passes
+    loop_seconds = server.stats.loopSeconds.sum - loop_seconds
+
+    for client in [sender] + clients:
+        await client.close()
+
+    return {"rate": messages * members / elapsed, "pass": loop_seconds / max(passes, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure what profiling costs the loop server")
+    parser.add_argument("--members", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    # Keep the server's console output out of the report
+    console.stream = io.StringIO()
+
+    server = LoopServer(port=0, log_dir="")
+    server.CLIENT_MESSAGE_RATE = server.CLIENT_BYTE_RATE = server.ROOM_MESSAGE_RATE = server.ROOM_BYTE_RATE = None
+    threading.Thread(target=server.serverMain, daemon=True).start()
+
+    profiler.DIRECTORY = tempfile.mkdtemp()
+    results = {False: [], True: []}
+
+    # Alternate so drift over the run affects both alike
+    for _ in range(args.rounds):
+        for enabled in (False, True):
+            if enabled:
+                profiler.start()
+
+            results[enabled].append(asyncio.run(run(server, args.members, args.messages)))
+
+            if enabled:
+                status = profiler.status()
+                profiler.stop()
+
+    for enabled, label in ((False, "profiler off"), (True, "profiler on ")):
+        rate = sum(result["rate"] for result in results[enabled]) / args.rounds
+        mean_pass = sum(result["pass"] for result in results[enabled]) / args.rounds
+
+        print(f"{label}: {rate:9.0f} deliveries/s, mean loop pass {mean_pass * 1e6:7.1f} us")
+
+    phases = status["loops"]["loop"]
+    busy = sum(seconds for phase, seconds in phases.items() if phase != "wait") or 1.0
+    print("  last traced run, share of busy loop time: " + ", ".join(f"{phase} {phases[phase] / busy:.0%}" for phase in PHASES if phase != "wait"))
+
+
+if __name__ == "__main__":
+    main()
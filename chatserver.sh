@@ -17,6 +17,10 @@ DAEMON_NAME=sudochat_server
 
 DAEMON_USER=root
 
+# Loop mode with a live-upgrade socket, so `upgrade` can replace the server without dropping clients
+UPGRADE_SOCKET=/tmp/$DAEMON_NAME.upgrade
+DAEMON_ARGS="--loop --upgrade-socket $UPGRADE_SOCKET"
+
 PIDFILE=/tmp/$DAEMON_NAME.pid
 
 . /lib/lsb/init-functions
@@ -26,9 +30,17 @@ PIDFILE=/tmp/$DAEMON_NAME.pid
 
 do_start () {
     log_daemon_msg "Starting system $DAEMON_NAME daemon"
-    start-stop-daemon -–start –-startas $DAEMON -–user $DAEMON_USER -–background –-pidfile $PIDFILE –-make-pidfile 
+    start-stop-daemon -–start –-startas $DAEMON -–user $DAEMON_USER -–background –-pidfile $PIDFILE –-make-pidfile -- $DAEMON_ARGS
     log_end_msg $?
 }
+do_upgrade () {
+    # The new process takes the sockets and rooms over from the running one, which then exits
+    log_daemon_msg "Upgrading system $DAEMON_NAME daemon in place"
+    start-stop-daemon --start --startas $DAEMON --user $DAEMON_USER --background --pidfile $PIDFILE.next --make-pidfile -- $DAEMON_ARGS --takeover
+    status=$?
+    [ $status -eq 0 ] && mv $PIDFILE.next $PIDFILE
+    log_end_msg $status
+}
 do_stop () {
     log_daemon_msg "Stopping system $DAEMON_NAME daemon"
     start-stop-daemon -–stop –-pidfile $PIDFILE –-retry 10
@@ -46,12 +58,16 @@ case "$1" in
         do_start
         ;;
 
+    upgrade)
+        do_upgrade
+        ;;
+
     status)
         status_of_proc "$DAEMON_NAME" "$DAEMON" && exit 0 || exit $?
         ;;
 
     *)
-        echo "Usage: /etc/init.d/$DAEMON_NAME {start|stop|restart|status}"
+        echo "Usage: /etc/init.d/$DAEMON_NAME {start|stop|restart|upgrade|status}"
         exit 1
         ;;
 
@@ -1,31 +1,56 @@
 from enum import Enum, auto
 
+import queue
 import socket
 import threading
+import time
 
-import json
 import sys
 
+from config import CLIENT_SETTINGS, applySettings
+from framing import FrameDecoder, controlCommand, encodeFrame, frameText
+from terminal import Renderer
+from tls import LockedReader, TLSConnector, clientContext
+
+
+# TLS sessions for every connection this process opens, created with the first one
+tlsConnector = None
+
 
 # Base class with config options
 class Base:
     def __init__(self):
-        with open("config.json") as json_config:
-            config = json.load(json_config)
+        # Config constants from config.json, read once per process (see config.py): SERVER_IP,
+        # SERVER_PORT, HEADER_BYTES, DISCON_MSG, USER_EXIT_MSG, MAIN_ROOM and the commands
+        # b/w server and root client (CMD_LIST_ROOMS, CMD_GET_ROOM, CMD_CREATE_ROOM,
+        # CMD_JOIN_ROOM), the join with sequence numbered messages and a session that can
+        # be resumed after a drop (CMD_RESUME_ROOM), and the server heartbeat and the answer
+        # to it (CMD_PING, CMD_PONG); TLS to connect over TLS, verifying the server against
+        # TLS_CA_FILE (None trusts the system's CAs)
+        applySettings(self, CLIENT_SETTINGS)
 
-        # Config constants
-        self.SERVER_IP = config["server-ip"]
-        self.SERVER_PORT = config["server-port"]
-        self.HEADER_BYTES = config["header-bytes"]
-        self.DISCON_MSG = config["disconnect-msg"]
-        self.USER_EXIT_MSG = config["exit-msg"]
+        # The server's heartbeat and the answer, as control frames that never collide with room names or chat
+        self.PING_TEXT = controlCommand(self.CMD_PING)
+        self.PONG_TEXT = controlCommand(self.CMD_PONG)
 
-        commands = config["commands"]
-        
-        # Commands b/w server and root client
-        self.CMD_LIST_ROOMS = commands["list-rooms"]
-        self.CMD_GET_ROOM = commands["get-room"]
-        self.CMD_CREATE_ROOM = commands["create-room"]
+
+    # Wrap a connected socket in TLS when config.json asks for it. Every client in the process
+    # shares one connector, so entering a room resumes the lobby's session (see tls.py).
+    def secure(self, sock):
+        global tlsConnector
+
+        if not self.TLS:
+            return sock
+
+        if tlsConnector is None:
+            tlsConnector = TLSConnector(clientContext(self.TLS_CA_FILE))
+
+        return tlsConnector.wrap(sock, (self.SERVER_IP, self.SERVER_PORT))
+
+
+    # What the listening thread reads sock through: a TLS socket is read under the send lock
+    def reader(self, sock):
+        return LockedReader(sock, self.sendLock) if self.TLS else sock
 
 
 
@@ -62,6 +87,12 @@ class FSM_Client(Base):
 
         # Create main socket for client side application
         self.rootClient = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.decoder = FrameDecoder(self.HEADER_BYTES)
+
+        # Lobby replies, read by a background thread so the server's pings are answered
+        # while the menu waits on input (None once the connection has closed)
+        self.replies = queue.Queue()
+        self.sendLock = threading.Lock()
 
         # Connect to main chat server
         self.connectServer()
@@ -70,12 +101,17 @@ class FSM_Client(Base):
     def connectServer(self):
         try:
             self.rootClient.connect((self.SERVER_IP, self.SERVER_PORT))
+            self.rootClient = self.secure(self.rootClient)
         except:
             print("<Connection to server failed.>")
             return
 
+        self.rootReader = self.reader(self.rootClient)
+
         self.sendData(self.USERNAME)
 
+        threading.Thread(target=self.lobbyListen, daemon=True).start()
+
         self.stateMachine()
 
     
@@ -119,9 +155,10 @@ class FSM_Client(Base):
 
     def mainRoom(self):
         # Enter main chat room (remain here till user exits from the client object)
-        chat = ChatClient(self.SERVER_PORT + 1, self.USERNAME)
-        print("\n")
-        chat.enterChat()
+        try:
+            self.joinRoom(self.MAIN_ROOM)
+        except:
+            print(f"<Error in connecting to {self.MAIN_ROOM}>")
 
         # Return to main menu after exiting the chat room
         self.STATE = States.MAIN_MENU
@@ -165,20 +202,7 @@ class FSM_Client(Base):
             room = roomNames[int(choice) - 1]
 
             try:
-                self.sendData(self.CMD_GET_ROOM)
-
-                response = self.getData()
-                assert response == "ACK"
-
-                self.sendData(room)
-
-                port = self.getData()
-                assert port != "NACK"
-
-                # Enter the chat room
-                chat = ChatClient(int(port), self.USERNAME)
-                print("\n")
-                chat.enterChat()
+                self.joinRoom(room)
 
                 # Return to main menu after exiting the chat room
                 self.STATE = States.MAIN_MENU
@@ -212,7 +236,7 @@ class FSM_Client(Base):
             assert port != "NACK"
 
             # Enter the new chat room
-            chat = ChatClient(int(port), self.USERNAME)
+            chat = ChatClient(int(port), self.USERNAME, name)
             print("\n")
             chat.enterChat()
 
@@ -223,41 +247,98 @@ class FSM_Client(Base):
             self.STATE = States.MAIN_MENU
             return
 
+
+    # Ask the server where a room lives, then enter it
+    def joinRoom(self, room: str):
+        self.sendData(self.CMD_GET_ROOM)
+
+        response = self.getData()
+        assert response == "ACK"
+
+        self.sendData(room)
+
+        port = self.getData()
+        assert port != "NACK"
+
+        # Enter the chat room
+        chat = ChatClient(int(port), self.USERNAME, room)
+        print("\n")
+        chat.enterChat()
+
     
+    def lobbyListen(self):
+        while True:
+            try:
+                # Blocks until one whole message has arrived, however the bytes are split
+                frame = self.decoder.readFrame(self.rootReader)
+            except:
+                frame = None
+
+            if frame is None:
+                self.replies.put(None)
+                break
+
+            message = frameText(frame)
+
+            if message == self.PING_TEXT:
+                try:
+                    self.sendData(self.PONG_TEXT)
+                except:
+                    pass
+            else:
+                self.replies.put(message)
+
+
     def getData(self) -> str:
-        try:
-            # Read header packet which gives length of payload
-            msg_header = self.rootClient.recv(self.HEADER_BYTES)
-            msg_len = int.from_bytes(msg_header, byteorder="big")
-            
-            # Read message payload from client
-            payload = self.rootClient.recv(msg_len).decode("utf-8")
-
-            return payload
-        except:
-            return None
+        message = self.replies.get()
+
+        # Leave the closed marker for the next call
+        if message is None:
+            self.replies.put(None)
+
+        return message
 
 
     def sendData(self, message: str):
         if not message:
             return
 
-        header = len(message).to_bytes(self.HEADER_BYTES, byteorder="big")
-
-        self.rootClient.send(header + message.encode("utf-8"))
+        with self.sendLock:
+            self.rootClient.sendall(encodeFrame(message, self.HEADER_BYTES))
 
 
 
 class ChatClient(Base):
-    def __init__(self, room_port: int, username: str):
+    def __init__(self, room_port: int, username: str, room_name: str):
         super().__init__()
 
         # Set up attributes
         self.SERVER_PORT = room_port
         self.USERNAME = username
+        self.ROOM_NAME = room_name
 
         # Initialize the socket client
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.decoder = FrameDecoder(self.HEADER_BYTES)
+
+        # Pongs from the listening thread and messages from the input thread share the socket
+        self.sendLock = threading.Lock()
+        self.clientReader = self.client
+
+        # Session token from the room and the newest message sequence number seen, for resuming
+        # after a dropped connection; nothing is resumed once the user has exited
+        self.token = None
+        self.lastSeq = 0
+        self.exiting = False
+
+        # Seconds between attempts to reconnect after the connection drops
+        self.RECONNECT_DELAYS = (0.5, 1, 2, 4, 8, 15, 30)
+
+        # Incoming messages are drawn in batches, at most once per RENDER_FRAME_SECONDS, and at most
+        # SCROLLBACK_LINES of them wait to be drawn (see terminal.py)
+        self.RENDER_FRAME_SECONDS = 1 / 30
+        self.SCROLLBACK_LINES = 1000
+        self.renderer = Renderer("<You> ", self.RENDER_FRAME_SECONDS, self.SCROLLBACK_LINES)
 
         # Initialize threads for listening, sending data
         self.send_thread = threading.Thread(target=self.clientInput, daemon=True)
@@ -265,13 +346,58 @@ class ChatClient(Base):
 
         try:
             self.client.connect((self.SERVER_IP, self.SERVER_PORT))
-
-            # Send the username header and username to the server
-            self.sendData(self.USERNAME)
+            self.client = self.secure(self.client)
+            self.clientReader = self.reader(self.client)
+            self.joinRoom()
         except:
             print("<Connection to chat failed>")
 
 
+    def joinRoom(self):
+        # Send the username header and username to the server
+        self.sendData(self.USERNAME)
+
+        # Name the room, since a single server port may host every room
+        self.sendData(f"{self.CMD_RESUME_ROOM} {self.token or '-'} {self.lastSeq}")
+        self.sendData(self.ROOM_NAME)
+
+
+    # Connect again and resume the session: the room sends only the messages missed meanwhile
+    def reconnect(self) -> bool:
+        self.renderer.show("<Connection lost, reconnecting...>")
+
+        for delay in self.RECONNECT_DELAYS:
+            time.sleep(delay)
+
+            if self.exiting:
+                return False
+
+            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+            try:
+                client.connect((self.SERVER_IP, self.SERVER_PORT))
+                client = self.secure(client)
+            except OSError:
+                client.close()
+                continue
+
+            with self.sendLock:
+                self.client.close()
+                self.client = client
+                self.clientReader = self.reader(client)
+                self.decoder = FrameDecoder(self.HEADER_BYTES)
+
+            try:
+                self.joinRoom()
+            except OSError:
+                continue
+
+            return True
+
+        self.renderer.show("<Could not reconnect to the chat room>")
+        return False
+
+
     def __del__(self):
         # Disconnect from the chatroom
         try:
@@ -301,42 +427,76 @@ class ChatClient(Base):
             if message is None:
                 continue
             elif message == self.USER_EXIT_MSG:
+                self.exiting = True
                 self.sendData(self.DISCON_MSG)
 
+                # Messages still waiting to be drawn go out before the goodbye
+                self.renderer.close()
                 print("<You have exited the chat room.>")
                 self.__del__()
                 break
 
+            # While the connection is being resumed the message is lost, not the chat
             try:
                 self.sendData(message)
             except:
                 print("<Message send failed>")
-                break
 
 
     def clientListen(self):
         while True:
             try:
-                # Read length of incoming message from server
-                msg_header = self.client.recv(self.HEADER_BYTES)
-                msg_len = int.from_bytes(msg_header, byteorder="big")
+                # Read everything available and queue each complete message in it for the next frame
+                if self.decoder.feed(self.clientReader) == 0:
+                    raise ConnectionError("Room closed the connection")
+
+                for frame in self.decoder.frames():
+                    message = frameText(frame)
+
+                    # Server heartbeat: answer it without showing it
+                    if message == self.PING_TEXT:
+                        self.sendData(self.PONG_TEXT)
+                        continue
 
-                # Read message payload from server
-                payload = self.client.recv(msg_len).decode("utf-8")
+                    self.showMessage(message)
             except:
-                break
+                if self.exiting or not self.reconnect():
+                    break
+
+
+    # Room messages arrive as "<seq> <message>"; notices have sequence number 0
+    def showMessage(self, message: str):
+        seq, _, text = message.partition(" ")
+
+        # A frame without a sequence number (from an older server) is a notice
+        if not seq.isdigit():
+            seq, text = 0, message
+
+        seq = int(seq)
+
+        if seq == 0:
+            kind, _, token = text.partition(" ")
+
+            # Session notices are kept, not shown
+            if kind in ("SESSION", "RESUMED"):
+                self.token = token
+                return
+        elif seq <= self.lastSeq:
+            return
+        else:
+            self.lastSeq = seq
 
-            print("\r" + payload)
-            print("\r<You> ", end="")
+        self.renderer.show(text)
 
     
     def sendData(self, message: str):
         if not message:
             return
 
-        header = len(message).to_bytes(self.HEADER_BYTES, byteorder="big")
-        self.client.send(header + message.encode("utf-8"))
+        with self.sendLock:
+            self.client.sendall(encodeFrame(message, self.HEADER_BYTES))
 
 
 
-start = FSM_Client()
\ No newline at end of file
+if __name__ == "__main__":
+    start = FSM_Client()
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+# Per-message compression for v2 connections, negotiated in the HELLO handshake.
+#
+# A client lists the codecs it accepts as a "compress=<codec>,..." HELLO field and
+# the server names the one it picked in its OK. Frames of at least
+# COMPRESS_MIN_BYTES are then sent to it wrapped in a COMPRESSED message whose
+# one field inflates to one or more whole frames (see protocol.py).
+#
+# Every message is deflated on its own, primed with a dictionary of text that
+# recurs in chat traffic, rather than through a stream context kept per
+# connection: a broadcast is then compressed once and the same bytes are queued
+# to every member that negotiated the codec, and frames can still be dropped from
+# a slow member's queue without corrupting the ones after them.
+
+import zlib
+
+
+# Preset dictionary for deflate-dict/1. zlib favours matches near the end of the
+# window, so the most common strings come last. Never change it: it is part of
+# the codec, and a new dictionary needs a new codec name.
+CHAT_DICTIONARY = (
+    b"https://www. .com/ .org/ .html http:// thanks please sorry would could should "
+    b"because about think there their they're people really something anyone "
+    b"everyone tomorrow today tonight morning meeting question problem message "
+    b"what when where which while with have this that from your will just like "
+    b"know the and for you not are but all can was yes okay lol haha :) "
+    b"\"sudochat/2\" {\"users\": \"rooms\": \"messages_in\": \"messages_out\": "
+    b" joined, - left ( users online)> has disconnected ( users online)> "
+    b"has entered the chat! ( users online)><Welcome to the  Room!>"
+)
+
+
+
+class Codec:
+    def __init__(self, name: str, dictionary: bytes, level: int = 6):
+        self.NAME = name
+        self.DICTIONARY = dictionary
+        self.LEVEL = level
+
+
+    def compress(self, data: bytes) -> bytes:
+        # A fresh compressor per message: memLevel 6 keeps its setup (most of the cost for chat-sized
+        # messages) small without costing ratio at these sizes
+        deflate = zlib.compressobj(self.LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, 6, zlib.Z_DEFAULT_STRATEGY, self.DICTIONARY)
+
+        return deflate.compress(data) + deflate.flush()
+
+
+    # Raises ValueError for corrupt data or data inflating to more than max_bytes
+    def decompress(self, data: bytes, max_bytes: int) -> bytes:
+        inflate = zlib.decompressobj(-zlib.MAX_WBITS, self.DICTIONARY)
+
+        try:
+            inflated = inflate.decompress(data, max_bytes)
+        except zlib.error as e:
+            raise ValueError(f"Corrupt compressed message: {e}") from None
+
+        if inflate.unconsumed_tail:
+            raise ValueError(f"Compressed message inflates past {max_bytes} bytes")
+
+        return inflated
+
+
+
+# Codecs by name, in the server's order of preference
+CODECS = {
+    "deflate-dict/1": Codec("deflate-dict/1", CHAT_DICTIONARY)
+}
+
+COMPRESS_EXTENSION = "compress="
+
+
+# HELLO field offering the given codecs
+def compressOffer(names) -> str:
+    return COMPRESS_EXTENSION + ",".join(names)
+
+
+# Codec to use for a client whose HELLO carried these extension fields, out of the
+# enabled ones (in preference order), or None
+def pickCodec(extensions: list, enabled):
+    offered = set()
+
+    for field in extensions:
+        field = bytes(field).decode("utf-8", "replace")
+
+        if field.startswith(COMPRESS_EXTENSION):
+            offered.update(field[len(COMPRESS_EXTENSION):].split(","))
+
+    for name in enabled:
+        if name in offered and name in CODECS:
+            return CODECS[name]
+
+    return None
+
+
+# Codec the server named in its HELLO response fields, or None
+def acceptedCodec(fields: list):
+    for field in fields[1:]:
+        field = bytes(field).decode("utf-8", "replace")
+
+        if field.startswith(COMPRESS_EXTENSION):
+            return CODECS.get(field[len(COMPRESS_EXTENSION):])
+
+    return None
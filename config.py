@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+
+# Settings from config.json, shared by the server and the clients.
+#
+# The file is read once per process and cached. Every Base applies the entries
+# of the schema it uses on top of its own defaults, so the file only needs the
+# settings that differ from them (the client has no defaults and needs all of
+# its own). Values are checked against the schema when the file is read, and a
+# bad one is reported by its key instead of failing somewhere later.
+#
+# Settings marked reloadable are runtime tunables: a loop server reads the file
+# again on SIGHUP and applies them to the rooms and connections it already
+# has (see LoopServer.reloadConfig). The others (addresses, framing, paths,
+# commands) take effect on restart.
+
+import json
+import os
+import selectors
+import signal
+import socket
+
+from outbound import SlowConsumerPolicy
+
+
+# config.json next to this module, unless SUDOCHAT_CONFIG names another file
+CONFIG_PATH = os.environ.get("SUDOCHAT_CONFIG") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
+
+
+
+class ConfigError(ValueError):
+    pass
+
+
+
+# Value parsers: each returns the value to use or raises ValueError saying what was expected
+def integer(value) -> int:
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValueError(f"expected a whole number, got {value!r}")
+
+    return value
+
+
+def number(value) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        raise ValueError(f"expected a number, got {value!r}")
+
+    return float(value)
+
+
+# Tokens per second for a flood limit: a bucket refilling at 0 would never get out of debt
+def rate(value) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        raise ValueError(f"expected a number above 0, got {value!r}")
+
+    return float(value)
+
+
+def text(value) -> str:
+    if not isinstance(value, str):
+        raise ValueError(f"expected a string, got {value!r}")
+
+    return value
+
+
+def flag(value) -> bool:
+    if not isinstance(value, bool):
+        raise ValueError(f"expected true or false, got {value!r}")
+
+    return value
+
+
+def texts(value) -> tuple:
+    if not isinstance(value, list):
+        raise ValueError(f"expected a list of strings, got {value!r}")
+
+    return tuple(text(item) for item in value)
+
+
+def policy(value) -> SlowConsumerPolicy:
+    try:
+        return SlowConsumerPolicy(text(value))
+    except ValueError:
+        raise ValueError(f"expected one of {', '.join(p.value for p in SlowConsumerPolicy)}, got {value!r}") from None
+
+
+# Parser that also takes null
+def optional(parse):
+    def parseOptional(value):
+        return None if value is None else parse(value)
+
+    return parseOptional
+
+
+
+# One entry of config.json: its key ("section.key" inside an object), the attribute
+# it sets, how its value is parsed and whether a running server picks up changes
+class Setting:
+    __slots__ = ("KEY", "NAME", "PARSE", "RELOADABLE")
+
+    def __init__(self, key: str, name: str, parse, reloadable: bool = False):
+        self.KEY = key
+        self.NAME = name
+        self.PARSE = parse
+        self.RELOADABLE = reloadable
+
+
+    # (whether the file sets it, parsed value)
+    def read(self, document: dict):
+        value = document
+
+        for part in self.KEY.split("."):
+            if not isinstance(value, dict) or part not in value:
+                return False, None
+
+            value = value[part]
+
+        try:
+            return True, self.PARSE(value)
+        except ValueError as e:
+            raise ConfigError(f"config.json {self.KEY}: {e}") from None
+
+
+
+# Entries read by the clients and the server alike
+SHARED_SETTINGS = (
+    Setting("server-port", "SERVER_PORT", integer),
+    Setting("header-bytes", "HEADER_BYTES", integer),
+    Setting("disconnect-msg", "DISCON_MSG", text),
+    Setting("main-room", "MAIN_ROOM", text),
+    Setting("commands.list-rooms", "CMD_LIST_ROOMS", text),
+    Setting("commands.get-room", "CMD_GET_ROOM", text),
+    Setting("commands.create-room", "CMD_CREATE_ROOM", text),
+    Setting("commands.join-room", "CMD_JOIN_ROOM", text),
+    Setting("commands.resume-room", "CMD_RESUME_ROOM", text),
+    Setting("commands.ping", "CMD_PING", text),
+    Setting("commands.pong", "CMD_PONG", text)
+)
+
+CLIENT_SETTINGS = SHARED_SETTINGS + (
+    Setting("server-ip", "SERVER_IP", text),
+    Setting("exit-msg", "USER_EXIT_MSG", text),
+    Setting("tls.enabled", "TLS", flag),
+    Setting("tls.ca-file", "TLS_CA_FILE", optional(text))
+)
+
+# The server's own entries live in the "server" object, apart from the threaded server's room cap
+SERVER_SETTINGS = SHARED_SETTINGS + (
+    Setting("max-chat-rooms", "THREADED_MAX_ROOMS", integer),
+    Setting("commands.history", "CMD_HISTORY", text),
+    Setting("commands.stats", "CMD_STATS", text),
+    Setting("commands.profile", "CMD_PROFILE", text),
+    Setting("server.bind-ip", "SERVER_IP", text),
+    Setting("server.max-rooms", "MAX_ROOMS", integer, True),
+    Setting("server.room-idle-seconds", "ROOM_IDLE_SECONDS", number, True),
+    Setting("server.presence-window", "PRESENCE_WINDOW", number, True),
+    Setting("server.high-watermark", "HIGH_WATERMARK", integer, True),
+    Setting("server.low-watermark", "LOW_WATERMARK", integer, True),
+    Setting("server.slow-consumer-policy", "SLOW_CONSUMER_POLICY", policy, True),
+    Setting("server.coalesce-writes", "COALESCE_WRITES", flag, True),
+    Setting("server.room-cache-messages", "ROOM_CACHE_MESSAGES", integer, True),
+    Setting("server.join-backfill-messages", "JOIN_BACKFILL_MESSAGES", integer, True),
+    Setting("server.log-dir", "LOG_DIR", text),
+    Setting("server.segment-bytes", "SEGMENT_BYTES", integer),
+    Setting("server.log-sync-seconds", "LOG_SYNC_SECONDS", number, True),
+    Setting("server.history-page-max", "HISTORY_PAGE_MAX", integer, True),
+    Setting("server.handshake-timeout", "HANDSHAKE_TIMEOUT", number, True),
+    Setting("server.step-timeout", "STEP_TIMEOUT", number, True),
+    Setting("server.heartbeat-interval", "HEARTBEAT_INTERVAL", optional(number), True),
+    Setting("server.heartbeat-timeout", "HEARTBEAT_TIMEOUT", number, True),
+    Setting("server.client-message-rate", "CLIENT_MESSAGE_RATE", optional(rate), True),
+    Setting("server.client-message-burst", "CLIENT_MESSAGE_BURST", integer, True),
+    Setting("server.client-byte-rate", "CLIENT_BYTE_RATE", optional(rate), True),
+    Setting("server.client-byte-burst", "CLIENT_BYTE_BURST", integer, True),
+    Setting("server.room-message-rate", "ROOM_MESSAGE_RATE", optional(rate), True),
+    Setting("server.room-message-burst", "ROOM_MESSAGE_BURST", integer, True),
+    Setting("server.room-byte-rate", "ROOM_BYTE_RATE", optional(rate), True),
+    Setting("server.room-byte-burst", "ROOM_BYTE_BURST", integer, True),
+    Setting("server.resume-window", "RESUME_WINDOW", number, True),
+    Setting("server.resume-max-messages", "RESUME_MAX_MESSAGES", integer, True),
+    Setting("server.stream-chunk-bytes", "STREAM_CHUNK_BYTES", integer, True),
+    Setting("server.stream-window", "STREAM_WINDOW", integer, True),
+    Setting("server.stream-max-bytes", "STREAM_MAX_BYTES", integer, True),
+    Setting("server.stream-max-open", "STREAM_MAX_OPEN", integer, True),
+    Setting("server.stream-stall-seconds", "STREAM_STALL_SECONDS", number, True),
+    Setting("server.compression-codecs", "COMPRESSION_CODECS", texts, True),
+    Setting("server.compress-min-bytes", "COMPRESS_MIN_BYTES", integer, True),
+    Setting("server.node-name", "NODE_NAME", optional(text)),
+    Setting("server.peers", "PEERS", texts),
+    Setting("server.peer-queue-bytes", "PEER_QUEUE_BYTES", integer),
+    Setting("server.metrics-port", "METRICS_PORT", optional(integer)),
+    Setting("server.metrics-room-limit", "METRICS_ROOM_LIMIT", integer, True),
+    Setting("server.log-queue-records", "LOG_QUEUE_RECORDS", integer),
+    Setting("server.log-batch", "LOG_BATCH", integer),
+    Setting("server.log-message-sample", "LOG_MESSAGE_SAMPLE", integer, True),
+    Setting("server.log-format", "LOG_FORMAT", text),
+    Setting("server.profile-interval", "PROFILE_INTERVAL", number, True),
+    Setting("server.profile-samples", "PROFILE_SAMPLES", integer, True),
+    Setting("server.profile-spans", "PROFILE_SPANS", integer, True),
+    Setting("server.profile-dir", "PROFILE_DIR", text, True),
+    Setting("server.tls-cert-file", "TLS_CERT_FILE", optional(text)),
+    Setting("server.tls-key-file", "TLS_KEY_FILE", optional(text)),
+    Setting("server.tls-required", "TLS_REQUIRED", flag, True),
+    Setting("server.upgrade-socket", "UPGRADE_SOCKET", optional(text)),
+    Setting("server.upgrade-timeout", "UPGRADE_TIMEOUT", number, True)
+)
+
+# Keys whose value must not be above the one paired with it
+ORDERED_SETTINGS = (
+    ("server.low-watermark", "server.high-watermark"),
+)
+
+
+
+# config.json, parsed on first use and kept until reloaded
+class ConfigFile:
+    def __init__(self, path: str):
+        self.PATH = path
+        self.document = None
+
+        # Documents adopted since the first load, so threads holding their own copy of the
+        # settings can tell that theirs is out of date
+        self.generation = 0
+
+
+    def load(self) -> dict:
+        if self.document is None:
+            self.document = self.read()
+
+        return self.document
+
+
+    # Read the file again; the cached copy is kept if it cannot be read
+    def reload(self) -> dict:
+        self.document = self.read()
+
+        return self.document
+
+
+    # Cache a document read with read() once it has been applied without error
+    def adopt(self, document: dict) -> None:
+        self.document = document
+        self.generation += 1
+
+
+    def read(self) -> dict:
+        try:
+            with open(self.PATH) as json_config:
+                document = json.load(json_config)
+        except OSError as e:
+            raise ConfigError(f"Cannot read {self.PATH}: {e.strerror}") from None
+        except json.JSONDecodeError as e:
+            raise ConfigError(f"{self.PATH} is not valid JSON: {e}") from None
+
+        if not isinstance(document, dict):
+            raise ConfigError(f"{self.PATH} does not hold a JSON object")
+
+        return document
+
+
+configFile = ConfigFile(CONFIG_PATH)
+
+
+# Set target's attributes from the file's entries. Entries the file leaves out take their
+# value from defaults (attribute name -> value) when given, otherwise keep the attribute's
+# current value; the client has none, so they are required. Nothing is set unless every
+# entry parses. Returns the names of the attributes that changed.
+def applySettings(target, settings, document: dict = None, defaults: dict = None) -> list:
+    document = configFile.load() if document is None else document
+    values = {}
+
+    for setting in settings:
+        present, value = setting.read(document)
+
+        if present:
+            values[setting.NAME] = value
+        elif defaults is not None and setting.NAME in defaults:
+            values[setting.NAME] = defaults[setting.NAME]
+        elif not hasattr(target, setting.NAME):
+            raise ConfigError(f"config.json is missing {setting.KEY}")
+
+    names = {setting.KEY: setting.NAME for setting in settings}
+
+    for low_key, high_key in ORDERED_SETTINGS:
+        if low_key not in names or high_key not in names:
+            continue
+
+        low = values.get(names[low_key], getattr(target, names[low_key], None))
+        high = values.get(names[high_key], getattr(target, names[high_key], None))
+
+        if low is not None and high is not None and low > high:
+            raise ConfigError(f"config.json {low_key}: {low} is above {high_key} ({high})")
+
+    changed = []
+
+    for name, value in values.items():
+        if getattr(target, name, None) != value:
+            setattr(target, name, value)
+            changed.append(name)
+
+    return changed
+
+
+# Reloadable settings, with their values before the file was applied
+def reloadableDefaults(target, settings) -> dict:
+    return {setting.NAME: getattr(target, setting.NAME) for setting in settings if setting.RELOADABLE}
+
+
+
+# Sets `pending` when SIGHUP arrives and wakes the owner's selector, so the reload runs
+# between events rather than inside whatever the handler interrupted. Main thread only.
+class ReloadSignal:
+    def __init__(self, selector):
+        self.pending = False
+        self.selector = selector
+
+        # The interpreter writes every signal number it catches to the wakeup socket
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+
+        signal.set_wakeup_fd(self.writer.fileno(), warn_on_full_buffer=False)
+        signal.signal(signal.SIGHUP, self.handle)
+        selector.register(self.reader, selectors.EVENT_READ, self)
+
+
+    def handle(self, signum, frame) -> None:
+        self.pending = True
+
+
+    def handleEvent(self, mask: int) -> None:
+        try:
+            while self.reader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+
+    def close(self) -> None:
+        signal.set_wakeup_fd(-1)
+        self.selector.unregister(self.reader)
+        self.reader.close()
+        self.writer.close()
@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+
+# Server console log written by a background thread.
+# Room loops only append a record to a bounded in-memory queue; the writer
+# thread drains it in batches, one write and flush per batch, so a slow
+# terminal or daemon log never holds up fan-out. When the queue is full new
+# records are counted and dropped rather than waited on, and the writer
+# reports how many were lost. Chat message bodies can be sampled.
+
+from collections import deque
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+
+class ConsoleLog:
+    def __init__(self):
+        # Most records held for the writer, records written per batch, and one chat
+        # message body logged in every SAMPLE_EVERY (0 logs none)
+        self.CAPACITY = 65536
+        self.BATCH = 512
+        self.SAMPLE_EVERY = 1
+
+        # "text" writes each record's text as a line, "json" one object per line
+        self.FORMAT = "text"
+
+        # Seconds the writer sleeps between drains while the queue is short
+        self.INTERVAL = 0.05
+
+        # Output stream (None writes to whatever sys.stdout is at the time)
+        self.stream = None
+
+        # Records dropped because the queue was full, and how many of those were reported
+        self.dropped = 0
+        self.reportedDrops = 0
+
+        # Chat messages seen, for sampling
+        self.messageCount = 0
+
+        self.closed = False
+        self.reset()
+
+
+    # Fresh queue and no writer thread (also run in a forked child, which has no writer)
+    def reset(self) -> None:
+        # (timestamp, event, text) records waiting for the writer
+        self.records = deque()
+
+        self.writer = None
+        self.starting = threading.Lock()
+        self.wake = threading.Event()
+
+
+    def configure(self, capacity: int, batch: int, sample_every: int, fmt: str) -> None:
+        self.CAPACITY = capacity
+        self.BATCH = batch
+        self.SAMPLE_EVERY = sample_every
+        self.FORMAT = fmt
+
+
+    # Queue a record without blocking; the writer thread is started on first use
+    def write(self, event: str, text: str) -> None:
+        # Once closed there is no writer left, so write in place
+        if self.closed:
+            self.emit([(time.time(), event, text)])
+            return
+
+        if self.writer is None:
+            self.start()
+
+        # A single writer pops from the left while any thread appends, which deque allows without a lock
+        if len(self.records) >= self.CAPACITY:
+            self.dropped += 1
+            return
+
+        self.records.append((time.time(), event, text))
+
+        # A full batch is waiting: do not leave it for the end of the interval
+        if len(self.records) == self.BATCH:
+            self.wake.set()
+
+
+    def info(self, text: str, event: str = "server") -> None:
+        self.write(event, text)
+
+
+    # Chat message bodies, subject to sampling
+    def message(self, text: str) -> None:
+        self.messageCount += 1
+
+        if not self.SAMPLE_EVERY or self.messageCount % self.SAMPLE_EVERY:
+            return
+
+        self.write("message", text)
+
+
+    def start(self) -> None:
+        with self.starting:
+            if self.writer is not None:
+                return
+
+            self.writer = threading.Thread(target=self.run, name="console-log", daemon=True)
+            self.writer.start()
+
+
+    def run(self) -> None:
+        while not self.closed:
+            self.wake.wait(self.INTERVAL)
+            self.wake.clear()
+            self.drain()
+
+
+    def drain(self) -> None:
+        while self.records:
+            batch = []
+
+            while self.records and len(batch) < self.BATCH:
+                batch.append(self.records.popleft())
+
+            self.emit(batch)
+
+        if self.dropped != self.reportedDrops:
+            lost = self.dropped - self.reportedDrops
+            self.reportedDrops += lost
+            self.emit([(time.time(), "log", f"<Console log queue full: {lost} records dropped>")])
+
+
+    def emit(self, batch: list) -> None:
+        if self.FORMAT == "json":
+            lines = [json.dumps({"ts": round(ts, 6), "event": event, "text": text}) for ts, event, text in batch]
+        else:
+            lines = [text for _, _, text in batch]
+
+        stream = self.stream or sys.stdout
+
+        try:
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+
+
+    # Write out everything queued; later records are written in place
+    def close(self) -> None:
+        if self.closed:
+            return
+
+        self.closed = True
+        self.wake.set()
+
+        if self.writer is not None and self.writer is not threading.current_thread():
+            self.writer.join(timeout=1.0)
+
+        self.drain()
+
+
+
+# Shared by every server in the process
+console = ConsoleLog()
+
+atexit.register(console.close)
+os.register_at_fork(after_in_child=console.reset)
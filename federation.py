@@ -0,0 +1,374 @@
+#!/usr/bin/python3
+
+# Federation of loop servers ("nodes") sharing rooms.
+#
+# Every node keeps one outgoing link to each of its peers. A link is an
+# ordinary v2 connection whose HELLO names the node and carries a
+# "peer=<incarnation>" field, where the incarnation is a random id picked each
+# time the node starts. Over it the node sends:
+#   DIRECTORY <room name>...           rooms it hosts, all of them when the link comes up and new ones as they open
+#   RELAY <room name> <seq u64> <text> each message published in one of those rooms by its own clients
+# A node that is asked for a room only a peer hosts opens a replica of it and
+# announces it, after which its peers relay that room's traffic to it.
+#
+# Nodes are expected to form a full mesh (every node lists every other one as
+# a peer), so a message crosses each link once, straight from the node it was
+# published on, and is fanned out locally by each receiver. Relayed messages
+# are never relayed again, which keeps routing free of loops whatever the
+# configuration. Links are TCP, so each origin's messages arrive in order; a
+# message is dropped as a duplicate unless its sequence number is past the
+# last one taken from that origin (and incarnation) for the room, which covers
+# frames sent again after a link reconnects and nodes listed twice.
+#
+# While a link is down its frames wait in its queue (up to PEER_QUEUE_BYTES,
+# oldest dropped first) and it is reconnected with backoff. Relays published
+# while it is down or still in its handshake are held back until the peer has
+# answered its HELLO, since the peer's node name says which of them it hosts.
+
+from collections import deque
+
+import errno
+import secrets
+import selectors
+import socket
+
+from console import console
+from framing import FrameDecoder
+from outbound import OutboundQueue, SlowConsumerPolicy
+from protocol import OP_DIRECTORY, OP_ERROR, OP_HELLO, OP_OK, OP_PING, OP_PONG, OP_RELAY, PROTOCOL_ID, decodeMessage, encodeMessage, fieldText, packU64
+from timerwheel import TimerWheel
+
+
+# HELLO field marking a connection as another node's link
+PEER_EXTENSION = "peer="
+
+# Seconds between attempts to bring a link back up, doubling up to the last
+RECONNECT_DELAYS = (1.0, 2.0, 4.0, 8.0, 16.0, 30.0)
+
+
+# "host:port" -> (host, port)
+def parsePeer(address: str):
+    host, _, port = address.rpartition(":")
+
+    return host or "127.0.0.1", int(port)
+
+
+# Incarnation a HELLO's extension fields name, or None for a client that is not a node
+def peerIncarnation(extensions: list):
+    for field in extensions:
+        field = bytes(field).decode("utf-8", "replace")
+
+        if field.startswith(PEER_EXTENSION):
+            return field[len(PEER_EXTENSION):]
+
+    return None
+
+
+
+# Outgoing link to one peer, driven by the server's selector
+class PeerLink:
+    def __init__(self, federation, address: str):
+        self.federation = federation
+        self.ADDRESS = parsePeer(address)
+
+        # Node name the peer gave in its HELLO response, once it has answered one
+        self.node = None
+
+        self.sock = None
+        self.decoder = None
+        self.connecting = False
+        self.up = False
+        self.attempts = 0
+
+        # Frames for the peer, kept across reconnects
+        queue_bytes = federation.server.PEER_QUEUE_BYTES
+        self.outbound = OutboundQueue(queue_bytes, queue_bytes // 2, SlowConsumerPolicy.DROP_OLDEST)
+
+        # Relays held while the link is not up, as (room name, frame), and their bytes
+        self.held = deque()
+        self.heldBytes = 0
+
+        # Set while the link is waiting for the end-of-iteration flush
+        self.dirty = False
+
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.connecting = True
+
+        error = self.sock.connect_ex(self.ADDRESS)
+
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.fail(errno.errorcode.get(error, str(error)))
+            return
+
+        self.federation.server.selector.register(self.sock, selectors.EVENT_WRITE, self)
+
+
+    def handleEvent(self, mask: int) -> None:
+        try:
+            if self.connecting:
+                self.connected()
+                return
+
+            if mask & selectors.EVENT_READ:
+                self.read()
+
+            if mask & selectors.EVENT_WRITE and self.sock is not None:
+                self.flush()
+        except (OSError, ValueError) as error:
+            self.fail(str(error))
+
+
+    # Connection attempt finished: introduce this node, then send what waited for the link
+    def connected(self) -> None:
+        error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+        if error:
+            self.fail(errno.errorcode.get(error, str(error)))
+            return
+
+        federation = self.federation
+        self.connecting = False
+        self.decoder = FrameDecoder()
+
+        hello = encodeMessage(OP_HELLO, 1, PROTOCOL_ID, federation.NODE, PEER_EXTENSION + federation.INCARNATION)
+        directory = encodeMessage(OP_DIRECTORY, 0, *federation.server.localRoomNames())
+        self.outbound.restart(hello, directory)
+
+        self.flush()
+
+
+    def read(self) -> None:
+        if self.decoder.feed(self.sock) == 0:
+            self.fail("closed by peer")
+            return
+
+        for frame in self.decoder.frames():
+            opcode, request_id, fields = decodeMessage(frame)
+
+            if opcode == OP_PING:
+                self.send(encodeMessage(OP_PONG, request_id))
+            elif opcode == OP_OK and request_id == 1:
+                self.accepted([fieldText(field) for field in fields])
+            elif opcode == OP_ERROR:
+                self.fail(fieldText(fields[0]) if fields else "refused")
+                return
+
+
+    # HELLO answered with OK <protocol> <peer=node name>
+    def accepted(self, fields: list) -> None:
+        for field in fields[1:]:
+            if field.startswith(PEER_EXTENSION):
+                self.node = field[len(PEER_EXTENSION):]
+
+        self.up = True
+        self.attempts = 0
+        console.info(f"<Federation link to {self.node} at {self.ADDRESS[0]}:{self.ADDRESS[1]} up>")
+
+        # Send the held relays for the rooms the peer hosts, behind the frames already queued
+        directory = self.federation.directory
+
+        while self.held:
+            room_name, frame = self.held.popleft()
+
+            if self.node in directory.get(room_name, ()):
+                self.send(frame)
+                self.federation.server.stats.relaysOut += 1
+
+        self.heldBytes = 0
+
+
+    # Keep a relay until the link is up, dropping the oldest past PEER_QUEUE_BYTES like the queue does
+    def hold(self, room_name: str, frame: bytes) -> None:
+        self.held.append((room_name, frame))
+        self.heldBytes += len(frame)
+
+        while self.heldBytes > self.outbound.HIGH_WATERMARK and len(self.held) > 1:
+            self.heldBytes -= len(self.held.popleft()[1])
+            self.outbound.dropped += 1
+
+
+    def send(self, frame: bytes) -> None:
+        if not self.outbound.push(frame):
+            return
+
+        if not self.dirty:
+            self.dirty = True
+            self.federation.dirtyLinks.append(self)
+
+
+    # Write what the socket accepts now; watch for writability while anything is left
+    def flush(self) -> None:
+        if self.sock is None or self.connecting:
+            return
+
+        done = self.outbound.flush(self.sock)
+        self.federation.server.selector.modify(self.sock, selectors.EVENT_READ if done else selectors.EVENT_READ | selectors.EVENT_WRITE, self)
+
+
+    # Drop the connection and try again later; queued frames wait for the next one
+    def fail(self, reason: str) -> None:
+        if self.up or self.attempts == 0:
+            console.info(f"<Federation link to {self.ADDRESS[0]}:{self.ADDRESS[1]} down: {reason}>")
+
+        self.close()
+        self.federation.retry.schedule(self, RECONNECT_DELAYS[min(self.attempts, len(RECONNECT_DELAYS) - 1)])
+        self.attempts += 1
+
+
+    def close(self) -> None:
+        if self.sock is not None:
+            try:
+                self.federation.server.selector.unregister(self.sock)
+            except (KeyError, ValueError):
+                pass
+
+            self.sock.close()
+
+        self.sock = None
+        self.connecting = self.up = False
+
+
+
+class Federation:
+    def __init__(self, server, node: str, peers: list):
+        self.server = server
+        self.NODE = node
+
+        # Changes every time the node starts, so peers know its sequence numbers start over
+        self.INCARNATION = secrets.token_hex(8)
+
+        self.links = [PeerLink(self, address) for address in peers]
+
+        # Room name -> names of the peers hosting it
+        self.directory = {}
+
+        # Peer node name -> incarnation it last introduced itself with, and its incoming link connection
+        self.incarnations = {}
+        self.peers = {}
+
+        # Peer node name -> room name -> last sequence number taken from it
+        self.lastSeqs = {}
+
+        # Links waiting to be reconnected, and links with frames queued this loop iteration
+        self.retry = TimerWheel()
+        self.dirtyLinks = []
+
+
+    def start(self) -> None:
+        for link in self.links:
+            link.connect()
+
+
+    def wait(self, timeout: float = None):
+        return self.retry.wait(timeout)
+
+
+    # Reconnect the links whose backoff is over
+    def reconnect(self) -> None:
+        for link in self.retry.advance():
+            link.connect()
+
+
+    def flush(self) -> None:
+        dirty_links = self.dirtyLinks
+        self.dirtyLinks = []
+
+        for link in dirty_links:
+            link.dirty = False
+
+            try:
+                link.flush()
+            except OSError as error:
+                link.fail(str(error))
+
+
+    def close(self) -> None:
+        for link in self.links:
+            self.retry.cancel(link)
+            link.close()
+
+
+    # Tell every peer about rooms opened here
+    def announce(self, names: list) -> None:
+        frame = encodeMessage(OP_DIRECTORY, 0, *names)
+
+        for link in self.links:
+            link.send(frame)
+
+
+    # A message published here by a local client goes to every peer hosting the room, once.
+    # Returns the relays queued; those held for links that are not up count once they are sent.
+    def relay(self, room_name: str, message: str, seq: int) -> int:
+        hosts = self.directory.get(room_name)
+
+        if not hosts:
+            return 0
+
+        frame = encodeMessage(OP_RELAY, 0, room_name, packU64(seq), message)
+        sent = 0
+
+        for link in self.links:
+            # A link that has never been up does not know its peer's node name yet
+            if not link.up and (link.node is None or link.node in hosts):
+                link.hold(room_name, frame)
+            elif link.node in hosts:
+                link.send(frame)
+                sent += 1
+
+        return sent
+
+
+    # Incoming link from a peer. Returns the link it replaces, if any, for the caller to close.
+    def addPeer(self, node: str, incarnation: str, conn):
+        # A restarted peer numbers its messages afresh
+        if self.incarnations.get(node) != incarnation:
+            self.incarnations[node] = incarnation
+            self.lastSeqs[node] = {}
+
+        replaced = self.peers.get(node)
+        self.peers[node] = conn
+
+        return replaced if replaced is not conn else None
+
+
+    def removePeer(self, node: str, conn) -> None:
+        if self.peers.get(node) is conn:
+            del self.peers[node]
+
+
+    def hostedBy(self, node: str, names: list) -> None:
+        for name in names:
+            self.directory.setdefault(name, set()).add(node)
+
+
+    # Whether a relayed message is new: past the last sequence number taken from its origin for the room
+    def isNew(self, node: str, room_name: str, seq: int) -> bool:
+        return seq > self.lastSeqs.get(node, {}).get(room_name, 0)
+
+
+    # Record a relayed message as taken, once it has been delivered to the room
+    def taken(self, node: str, room_name: str, seq: int) -> None:
+        self.lastSeqs.setdefault(node, {})[room_name] = seq
+
+
+    def linksUp(self) -> int:
+        return sum(1 for link in self.links if link.up)
+
+
+    # JSON-able state for a successor process; its own links connect afresh
+    def handoffState(self) -> dict:
+        return {
+            "directory": {name: sorted(nodes) for name, nodes in self.directory.items()},
+            "incarnations": self.incarnations,
+            "lastSeqs": self.lastSeqs
+        }
+
+
+    # Incoming links are registered again as their connections are adopted
+    def restore(self, state: dict) -> None:
+        self.directory = {name: set(nodes) for name, nodes in state["directory"].items()}
+        self.incarnations = state["incarnations"]
+        self.lastSeqs = state["lastSeqs"]
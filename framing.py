@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+
+# Framing shared by the server and client: every message is a big-endian
+# length header followed by that many bytes of UTF-8 payload.
+
+HEADER_BYTES = 4
+
+# Largest payload a peer may announce before the connection is treated as broken
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+
+# Leads the control frames (heartbeats) of the string-command protocol, so they never match a
+# room name or a line of chat: typed input cannot start with a NUL, and room names that do are refused
+CONTROL_PREFIX = "\x00"
+
+
+def controlCommand(command: str) -> str:
+    return CONTROL_PREFIX + command
+
+
+def encodeFrame(message: str, header_bytes: int = HEADER_BYTES) -> bytes:
+    data = message.encode("utf-8")
+
+    # Header carries the byte length so multibyte characters frame correctly
+    return len(data).to_bytes(header_bytes, byteorder="big") + data
+
+
+def frameText(frame) -> str:
+    return str(frame, "utf-8")
+
+
+
+# Incremental decoder holding the receive buffer for one socket.
+# Frames are handed out as memoryview slices of the buffer and stay valid
+# until the next call to feed(), so handlers decode (or copy) only what they keep.
+class FrameDecoder:
+    def __init__(self, header_bytes: int = HEADER_BYTES, buffer_bytes: int = 64 * 1024):
+        self.HEADER_BYTES = header_bytes
+
+        # Reusable receive buffer and a view over it for zero-copy slicing
+        self.buffer = bytearray(buffer_bytes)
+        self.view = memoryview(self.buffer)
+
+        # Unconsumed bytes live in buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+
+    # Read whatever the socket has into the buffer with a single recv_into.
+    # Returns the number of bytes read (0 means the peer closed the connection).
+    def feed(self, sock) -> int:
+        self.makeRoom()
+
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+
+        return n
+
+
+    # Pop the next complete frame, or None if only a partial frame is buffered
+    def nextFrame(self):
+        available = self.end - self.start
+
+        if available < self.HEADER_BYTES:
+            return None
+
+        header_end = self.start + self.HEADER_BYTES
+        msg_len = int.from_bytes(self.view[self.start:header_end], byteorder="big")
+
+        if msg_len > MAX_FRAME_BYTES:
+            raise ValueError(f"Frame of {msg_len} bytes exceeds limit")
+
+        if available - self.HEADER_BYTES < msg_len:
+            return None
+
+        self.start = header_end + msg_len
+
+        return self.view[header_end:self.start]
+
+
+    # Yield every complete frame currently buffered
+    def frames(self):
+        while True:
+            frame = self.nextFrame()
+
+            if frame is None:
+                return
+
+            yield frame
+
+
+    # Blocking read of exactly one frame (for request/response exchanges).
+    # Returns None if the peer closes before a whole frame arrives.
+    def readFrame(self, sock):
+        while True:
+            frame = self.nextFrame()
+
+            if frame is not None:
+                return frame
+
+            if self.feed(sock) == 0:
+                return None
+
+
+    # Bytes received but not handed out as frames yet
+    def buffered(self) -> bytes:
+        return bytes(self.view[self.start:self.end])
+
+
+    # Start from bytes another decoder had buffered (when a socket changes hands)
+    def preload(self, data: bytes) -> None:
+        if len(data) > len(self.buffer):
+            self.buffer = bytearray(len(data))
+            self.view = memoryview(self.buffer)
+
+        self.view[:len(data)] = data
+        self.start, self.end = 0, len(data)
+
+
+    # Make sure there is free space after the buffered bytes before reading
+    def makeRoom(self) -> None:
+        if self.start == self.end:
+            self.start = self.end = 0
+            return
+
+        # Size needed to hold the frame currently being received
+        needed = self.HEADER_BYTES
+        if self.end - self.start >= self.HEADER_BYTES:
+            needed += int.from_bytes(self.view[self.start:self.start + self.HEADER_BYTES], byteorder="big")
+
+        pending = self.end - self.start
+
+        # Slide the partial frame back to the front of the buffer
+        if self.start > 0 and (self.end == len(self.buffer) or len(self.buffer) - self.start < needed):
+            self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+
+        # Grow into a fresh buffer; views handed out earlier keep the old one alive
+        if needed > len(self.buffer) or self.end == len(self.buffer):
+            buffer = bytearray(max(needed, 2 * len(self.buffer)))
+            buffer[:pending] = self.view[self.start:self.end]
+
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+            self.start, self.end = 0, pending
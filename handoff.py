@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+# Live handoff of a loop server to a new process on the same host.
+#
+# A server started with an upgrade socket (a Unix socket path) listens on it for
+# a successor. The successor connects and receives, in order:
+#   header: state length (u64) | descriptor count (u32)
+#   the server state as JSON (rooms, members, lobby steps, unread and unsent bytes)
+#   the descriptors (listening sockets first, then one per client), passed with
+#   SCM_RIGHTS at most MAX_FDS_PER_MESSAGE at a time, each batch on one byte
+# It rebuilds the server around those sockets and confirms with one byte. Only
+# then does the old process exit; until the confirmation it reads nothing from
+# its clients, and if the successor fails it simply keeps serving.
+
+import json
+import os
+import selectors
+import socket
+import struct
+
+
+HANDOFF_HEADER = struct.Struct(">QI")
+
+# Descriptors per SCM_RIGHTS message (the kernel allows at most 253)
+MAX_FDS_PER_MESSAGE = 250
+
+# Byte the successor sends once it has taken over
+CONFIRM = b"K"
+
+
+
+def recvExact(sock, size: int) -> bytes:
+    data = bytearray()
+
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1024 * 1024))
+
+        if not chunk:
+            raise ConnectionError("Handoff peer closed the connection")
+
+        data += chunk
+
+    return bytes(data)
+
+
+# Old process: send the state and every descriptor to the successor
+def sendHandoff(sock, state: dict, fds: list) -> None:
+    payload = json.dumps(state).encode("utf-8")
+    sock.sendall(HANDOFF_HEADER.pack(len(payload), len(fds)) + payload)
+
+    for first in range(0, len(fds), MAX_FDS_PER_MESSAGE):
+        socket.send_fds(sock, [b"F"], fds[first:first + MAX_FDS_PER_MESSAGE])
+
+
+# Old process: True once the successor has confirmed the takeover
+def awaitConfirmation(sock) -> bool:
+    try:
+        return sock.recv(1) == CONFIRM
+    except OSError:
+        return False
+
+
+# New process: connect to the running server's upgrade socket and receive
+# (state, descriptors, handoff socket); confirm on the socket once running
+def receiveHandoff(path: str, timeout: float):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(path)
+
+    state_len, fd_count = HANDOFF_HEADER.unpack(recvExact(sock, HANDOFF_HEADER.size))
+    state = json.loads(recvExact(sock, state_len))
+    fds = []
+
+    while len(fds) < fd_count:
+        data, batch, _, _ = socket.recv_fds(sock, 1, MAX_FDS_PER_MESSAGE)
+
+        if not data:
+            raise ConnectionError("Handoff ended before every descriptor arrived")
+
+        fds.extend(batch)
+
+    return state, fds, sock
+
+
+
+# Unix socket a successor connects to, served by the owner's selector
+class UpgradeListener:
+    def __init__(self, selector, path: str, handOff, sock=None):
+        self.selector = selector
+        self.PATH = path
+
+        # Called with the connected successor socket
+        self.handOff = handOff
+
+        # A successor inherits the listening socket, so the path is never unbound
+        if sock is None:
+            if os.path.exists(path):
+                os.unlink(path)
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(path)
+            sock.listen(1)
+
+        self.sock = sock
+        self.sock.setblocking(False)
+
+        selector.register(self.sock, selectors.EVENT_READ, self)
+
+
+    def handleEvent(self, mask: int) -> None:
+        try:
+            successor, _ = self.sock.accept()
+        except BlockingIOError:
+            return
+
+        successor.setblocking(True)
+        self.handOff(successor)
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+from enum import Enum
+from heapq import heapify, heappop, heappush
+from itertools import count
+
+import time
+
+
+# Step of the string-command lobby protocol a connection is at.
+# Every state except IDLE waits on the client and has a deadline.
+class LobbyState(Enum):
+    # Waiting for the first frame: the username (or a v2 HELLO)
+    HANDSHAKE = "handshake"
+
+    # Waiting for the next command
+    IDLE = "idle"
+
+    # LIST_ROOMS: sent ACK and the room count, waiting for the client's ACK
+    LIST_ACK = "list-ack"
+
+    # GET_ROOM: sent ACK, waiting for the room name
+    GET_ROOM_NAME = "get-room-name"
+
+    # CREATE_ROOM: sent ACK, waiting for the new room's name
+    CREATE_ROOM_NAME = "create-room-name"
+
+    # Room client: sent its username, waiting for JOIN_ROOM
+    JOIN_ROOM = "join-room"
+
+    # JOIN_ROOM: waiting for the name of the room being entered
+    JOIN_ROOM_NAME = "join-room-name"
+
+
+
+# Deadlines for the connections currently waiting on a protocol step.
+# Deadlines sit in a heap, so a loop pass only looks at the ones that are due however
+# many connections are stalled. Disarming or re-arming a key leaves its old heap entry
+# behind; entries that no longer match the key's deadline are skipped when they reach
+# the top, and the heap is rebuilt once they outnumber the live ones.
+class StepTimers:
+    def __init__(self):
+        # Connection key -> monotonic deadline
+        self.deadlines = {}
+
+        # (deadline, tie breaker, key), including stale entries
+        self.heap = []
+        self.order = count()
+
+
+    def arm(self, key, seconds: float) -> None:
+        self.armAt(key, time.monotonic() + seconds)
+
+
+    # Arm with a deadline already on the monotonic clock (shared by every process on the host)
+    def armAt(self, key, deadline: float) -> None:
+        self.deadlines[key] = deadline
+        heappush(self.heap, (deadline, next(self.order), key))
+
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.compact()
+
+
+    def disarm(self, key) -> None:
+        self.deadlines.pop(key, None)
+
+
+    # Drop the stale entries from the heap
+    def compact(self) -> None:
+        self.heap = [entry for entry in self.heap if self.deadlines.get(entry[2]) == entry[0]]
+        heapify(self.heap)
+
+
+    # Discard stale entries from the top, so it holds the earliest live deadline
+    def prune(self) -> None:
+        heap = self.heap
+
+        while heap and self.deadlines.get(heap[0][2]) != heap[0][0]:
+            heappop(heap)
+
+
+    # How long the loop may wait before the next deadline, capped at timeout (None means no cap)
+    def wait(self, timeout: float = None):
+        self.prune()
+
+        if not self.heap:
+            return timeout
+
+        remaining = max(0.0, self.heap[0][0] - time.monotonic())
+
+        return remaining if timeout is None else min(timeout, remaining)
+
+
+    # Remove and return every key whose deadline has passed
+    def expired(self) -> list:
+        now = time.monotonic()
+        keys = []
+
+        self.prune()
+
+        while self.heap and self.heap[0][0] <= now:
+            _, _, key = heappop(self.heap)
+            del self.deadlines[key]
+            keys.append(key)
+            self.prune()
+
+        return keys
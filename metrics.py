@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+
+# Server telemetry: plain counters on slotted records and fixed-bucket histograms,
+# updated inline on the loop's hot path. Gauges (users, queue depths, history
+# sizes) are read from live state only when stats are requested, so they cost
+# nothing in between. Exposed through the STATS command and, when METRICS_PORT
+# is set, as Prometheus text on http://127.0.0.1:<METRICS_PORT>/metrics.
+
+from bisect import bisect_left
+
+import selectors
+import socket
+
+
+# Bucket upper bounds (seconds) for work done inside one loop pass
+DURATION_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# Bucket upper bounds (bytes) for outbound queue depths
+QUEUE_BUCKETS = (0, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+
+# Histogram with fixed bucket bounds; observing only increments existing slots
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+
+        # One count per bound plus the +Inf bucket (counts are per bucket, not cumulative)
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    # Smallest bucket bound covering the given fraction of observations (an upper estimate)
+    def quantile(self, fraction: float) -> float:
+        if not self.count:
+            return 0.0
+
+        target = fraction * self.count
+        seen = 0
+
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+
+            if seen >= target:
+                return bound
+
+        return float("inf")
+
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99)
+        }
+
+
+
+# Counters kept for every room
+class RoomStats:
+    __slots__ = ("messagesIn", "messagesOut", "bytesIn", "bytesOut", "throttles")
+
+    def __init__(self):
+        # Messages published to the room, and copies queued to its members
+        self.messagesIn = 0
+        self.messagesOut = 0
+
+        # Payload bytes of those messages and framed bytes of those copies
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+        # Senders throttled because the room as a whole was over its flood limit
+        self.throttles = 0
+
+
+
+# Server-wide counters and histograms
+class ServerStats:
+    __slots__ = (
+        "connections", "disconnections", "bytesIn", "closedBytesOut", "messagesIn", "messagesOut",
+        "requests", "requestErrors", "pings", "reaped", "throttles", "streams", "streamBytes",
+        "compressed", "compressionSaved", "relaysOut", "relaysIn", "relayDuplicates", "tlsHandshakes", "tlsResumed",
+        "tlsFailures", "fanoutSeconds", "loopSeconds"
+    )
+
+    def __init__(self):
+        # Connections accepted and closed
+        self.connections = 0
+        self.disconnections = 0
+
+        # Bytes read from clients; bytes written are counted by each outbound queue and
+        # folded in here when its connection closes
+        self.bytesIn = 0
+        self.closedBytesOut = 0
+
+        # Room messages published, and copies queued to members
+        self.messagesIn = 0
+        self.messagesOut = 0
+
+        # Lobby commands and v2 requests handled, and the ones answered with an error
+        self.requests = 0
+        self.requestErrors = 0
+
+        # Heartbeat pings sent, and connections closed for not answering one
+        self.pings = 0
+        self.reaped = 0
+
+        # Times a client was left unread for going over a flood limit
+        self.throttles = 0
+
+        # Streamed transfers opened, and chunk bytes relayed for them
+        self.streams = 0
+        self.streamBytes = 0
+
+        # Compressed pushes encoded (a broadcast counts once per codec), and bytes they
+        # saved over every copy queued
+        self.compressed = 0
+        self.compressionSaved = 0
+
+        # Room messages sent to federation links (one per link), taken from them, and dropped
+        # from them as already seen
+        self.relaysOut = 0
+        self.relaysIn = 0
+        self.relayDuplicates = 0
+
+        # TLS handshakes completed, how many of them resumed a session, and handshakes that failed
+        self.tlsHandshakes = 0
+        self.tlsResumed = 0
+        self.tlsFailures = 0
+
+        # Time spent fanning one message out to a room, and handling one loop pass
+        self.fanoutSeconds = Histogram(DURATION_BUCKETS)
+        self.loopSeconds = Histogram(DURATION_BUCKETS)
+
+
+
+def escapeLabel(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+# Prometheus text exposition format (version 0.0.4)
+class Exposition:
+    def __init__(self):
+        self.lines = []
+
+
+    def family(self, name: str, kind: str, help_text: str) -> None:
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+
+
+    def sample(self, name: str, value, labels: str = "") -> None:
+        self.lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+
+    def metric(self, name: str, kind: str, help_text: str, value) -> None:
+        self.family(name, kind, help_text)
+        self.sample(name, value)
+
+
+    def histogram(self, name: str, help_text: str, histogram: Histogram) -> None:
+        self.family(name, "histogram", help_text)
+        cumulative = 0
+
+        for bound, count in zip(histogram.bounds, histogram.counts):
+            cumulative += count
+            self.sample(f"{name}_bucket", cumulative, f"le=\"{bound}\"")
+
+        self.sample(f"{name}_bucket", histogram.count, "le=\"+Inf\"")
+        self.sample(f"{name}_sum", histogram.sum)
+        self.sample(f"{name}_count", histogram.count)
+
+
+    def text(self) -> bytes:
+        return ("\n".join(self.lines) + "\n").encode("utf-8")
+
+
+
+# One HTTP scrape: read the request line, answer with the rendered metrics, close
+class Scrape:
+    # Largest request header accepted
+    MAX_REQUEST_BYTES = 8192
+
+    def __init__(self, sock, endpoint):
+        self.sock = sock
+        self.endpoint = endpoint
+        self.request = bytearray()
+        self.response = None
+
+
+    def handleEvent(self, mask: int) -> None:
+        try:
+            if self.response is None:
+                self.readRequest()
+            else:
+                self.writeResponse()
+        except OSError:
+            self.close()
+
+
+    def readRequest(self) -> None:
+        data = self.sock.recv(4096)
+
+        if not data:
+            self.close()
+            return
+
+        self.request += data
+
+        if b"\r\n\r\n" not in self.request and len(self.request) < self.MAX_REQUEST_BYTES:
+            return
+
+        parts = bytes(self.request).split(b" ", 2)
+
+        if len(parts) == 3 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+            status, body = "200 OK", self.endpoint.render()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+
+        head = (
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+
+        self.response = memoryview(head.encode("ascii") + body)
+        self.endpoint.selector.modify(self.sock, selectors.EVENT_WRITE, self)
+        self.writeResponse()
+
+
+    def writeResponse(self) -> None:
+        try:
+            sent = self.sock.send(self.response)
+        except (BlockingIOError, InterruptedError):
+            return
+
+        self.response = self.response[sent:]
+
+        if not self.response:
+            self.close()
+
+
+    def close(self) -> None:
+        try:
+            self.endpoint.selector.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+
+        self.sock.close()
+
+
+
+# Listening socket for Prometheus scrapes, served by the owner's selector.
+# Bound to localhost only: metrics are for the host's collector, not for clients.
+class MetricsEndpoint:
+    def __init__(self, selector, port: int, render, sock=None):
+        self.selector = selector
+
+        # Returns the exposition text for a scrape
+        self.render = render
+
+        # A listening socket may be inherited from the process being replaced
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("127.0.0.1", port))
+            sock.listen()
+
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.PORT = self.sock.getsockname()[1]
+
+        selector.register(self.sock, selectors.EVENT_READ, self)
+
+
+    def handleEvent(self, mask: int) -> None:
+        try:
+            client_socket, _ = self.sock.accept()
+        except BlockingIOError:
+            return
+
+        client_socket.setblocking(False)
+        self.selector.register(client_socket, selectors.EVENT_READ, Scrape(client_socket, self))
+
+
+    def close(self) -> None:
+        self.selector.unregister(self.sock)
+        self.sock.close()
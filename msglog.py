@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+
+import bisect
+import mmap
+import os
+import struct
+import urllib.parse
+
+from framing import HEADER_BYTES
+
+
+# Each index entry is the byte position of one record in its segment's log file
+INDEX_ENTRY = struct.Struct(">Q")
+
+
+def roomLogDir(log_dir: str, room_name: str) -> str:
+    return os.path.join(log_dir, urllib.parse.quote(room_name, safe=""))
+
+
+
+# One segment: <base seq>.log holds the records back to back and <base seq>.idx
+# holds one fixed-size entry per record, so record n is found with one index read
+class Segment:
+    def __init__(self, directory: str, base_seq: int):
+        self.BASE_SEQ = base_seq
+        self.logPath = os.path.join(directory, f"{base_seq:020d}.log")
+        self.idxPath = os.path.join(directory, f"{base_seq:020d}.idx")
+
+        # Records and log bytes written to disk so far
+        self.count = 0
+        self.size = 0
+
+        # Read-only maps of the files, re-mapped when the files have grown
+        self.logMap = None
+        self.idxMap = None
+
+
+    def load(self) -> None:
+        self.count = os.path.getsize(self.idxPath) // INDEX_ENTRY.size if os.path.exists(self.idxPath) else 0
+        self.size = os.path.getsize(self.logPath) if os.path.exists(self.logPath) else 0
+
+
+    # Maps are replaced rather than closed: views handed out earlier keep the old map alive
+    def maps(self):
+        if self.idxMap is None or len(self.idxMap) < self.count * INDEX_ENTRY.size:
+            with open(self.idxPath, "rb") as idx_file:
+                self.idxMap = mmap.mmap(idx_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.logMap is None or len(self.logMap) < self.size:
+            with open(self.logPath, "rb") as log_file:
+                self.logMap = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self.idxMap, self.logMap
+
+
+    def position(self, seq: int) -> int:
+        idx_map, _ = self.maps()
+
+        return INDEX_ENTRY.unpack_from(idx_map, (seq - self.BASE_SEQ) * INDEX_ENTRY.size)[0]
+
+
+    # Byte range in the log file covering records first..last (inclusive)
+    def span(self, first: int, last: int):
+        _, log_map = self.maps()
+
+        start = self.position(first)
+        end = self.position(last)
+        end += HEADER_BYTES + int.from_bytes(log_map[end:end + HEADER_BYTES], byteorder="big")
+
+        return start, end
+
+
+
+# Segmented append-only log of one room's messages. Records are stored as the
+# exact frames sent to clients, so history pages go out straight from the mmap.
+# Sequence numbers start at 1 and never repeat.
+class MessageLog:
+    def __init__(self, directory: str, segment_bytes: int = 16 * 1024 * 1024, readonly: bool = False):
+        self.DIRECTORY = directory
+        self.SEGMENT_BYTES = segment_bytes
+        self.READONLY = readonly
+
+        # Segments ordered by base sequence number
+        self.segments = []
+        self.baseSeqs = []
+
+        # Appended records not yet written to the active segment
+        self.logPending = bytearray()
+        self.idxPending = bytearray()
+        self.pendingCount = 0
+
+        # Set when records were written since the last fsync
+        self.unsynced = False
+
+        self.logFile = None
+        self.idxFile = None
+
+        if not readonly:
+            os.makedirs(directory, exist_ok=True)
+
+        self.loadSegments()
+
+        if not readonly:
+            self.recover()
+            self.openActive()
+
+
+    def loadSegments(self) -> None:
+        names = os.listdir(self.DIRECTORY) if os.path.isdir(self.DIRECTORY) else []
+        base_seqs = sorted(int(name[:-4]) for name in names if name.endswith(".log"))
+
+        # Keep existing Segment objects (and their maps) for segments already known
+        known = {segment.BASE_SEQ: segment for segment in self.segments}
+        self.segments = [known.get(base_seq) or Segment(self.DIRECTORY, base_seq) for base_seq in base_seqs]
+        self.baseSeqs = base_seqs
+
+        for segment in self.segments:
+            segment.load()
+
+
+    # Drop a torn write at the tail of the last segment: index entries whose record is
+    # not fully in the log, and log bytes that no index entry points to
+    def recover(self) -> None:
+        if not self.segments:
+            return
+
+        segment = self.segments[-1]
+
+        with open(segment.idxPath, "ab+") as idx_file, open(segment.logPath, "ab+") as log_file:
+            idx_file.seek(0)
+            index = idx_file.read(segment.count * INDEX_ENTRY.size)
+            log_file.seek(0)
+            log = log_file.read()
+
+            count = segment.count
+            end = 0
+
+            while count > 0:
+                position = INDEX_ENTRY.unpack_from(index, (count - 1) * INDEX_ENTRY.size)[0]
+                header = log[position:position + HEADER_BYTES]
+
+                if len(header) == HEADER_BYTES:
+                    end = position + HEADER_BYTES + int.from_bytes(header, byteorder="big")
+
+                    if end <= len(log):
+                        break
+
+                count -= 1
+                end = 0
+
+            idx_file.truncate(count * INDEX_ENTRY.size)
+            log_file.truncate(end)
+
+        segment.count = count
+        segment.size = end
+        segment.idxMap = segment.logMap = None
+
+
+    def openActive(self) -> None:
+        if not self.segments:
+            self.addSegment(1)
+
+        segment = self.segments[-1]
+        self.logFile = open(segment.logPath, "ab", buffering=0)
+        self.idxFile = open(segment.idxPath, "ab", buffering=0)
+
+
+    def addSegment(self, base_seq: int) -> None:
+        segment = Segment(self.DIRECTORY, base_seq)
+        open(segment.logPath, "ab").close()
+        open(segment.idxPath, "ab").close()
+
+        self.segments.append(segment)
+        self.baseSeqs.append(base_seq)
+
+
+    def lastSeq(self) -> int:
+        if not self.segments:
+            return 0
+
+        segment = self.segments[-1]
+
+        return segment.BASE_SEQ + segment.count + self.pendingCount - 1
+
+
+    # Buffer one frame for the log and return its sequence number; it reaches disk on writePending()
+    def append(self, frame: bytes) -> int:
+        segment = self.segments[-1]
+        seq = self.lastSeq() + 1
+
+        self.idxPending += INDEX_ENTRY.pack(segment.size + len(self.logPending))
+        self.logPending += frame
+        self.pendingCount += 1
+
+        # Seal the segment once it is full; the next record starts a new one
+        if segment.size + len(self.logPending) >= self.SEGMENT_BYTES:
+            self.sync()
+            self.logFile.close()
+            self.idxFile.close()
+            self.addSegment(seq + 1)
+            self.openActive()
+
+        return seq
+
+
+    # One write per file for everything appended since the last call
+    def writePending(self) -> None:
+        if not self.pendingCount:
+            return
+
+        segment = self.segments[-1]
+
+        # Log bytes first, so an index entry on disk always points at a written record
+        self.logFile.write(self.logPending)
+        self.idxFile.write(self.idxPending)
+
+        segment.size += len(self.logPending)
+        segment.count += self.pendingCount
+
+        self.logPending = bytearray()
+        self.idxPending = bytearray()
+        self.pendingCount = 0
+        self.unsynced = True
+
+
+    # Group commit: write everything pending and fsync both files once
+    def sync(self) -> None:
+        self.writePending()
+
+        if self.unsynced:
+            os.fsync(self.logFile.fileno())
+            os.fsync(self.idxFile.fileno())
+            self.unsynced = False
+
+
+    def dirty(self) -> bool:
+        return self.pendingCount > 0 or self.unsynced
+
+
+    def close(self) -> None:
+        if self.logFile is not None:
+            self.sync()
+            self.logFile.close()
+            self.idxFile.close()
+            self.logFile = self.idxFile = None
+
+
+    def segmentFor(self, seq: int) -> Segment:
+        return self.segments[bisect.bisect_right(self.baseSeqs, seq) - 1]
+
+
+    def refresh(self) -> None:
+        # Readers follow a log written by another process
+        if self.READONLY:
+            self.loadSegments()
+        else:
+            self.writePending()
+
+
+    # Page backwards through history: up to count records before before_seq (0 means the newest).
+    # Returns the first sequence number, the number of records and memoryviews over the mapped
+    # log files that hold those records as ready-to-send frames (one view per segment touched).
+    def page(self, before_seq: int, count: int):
+        self.refresh()
+
+        last = self.lastSeq()
+
+        if before_seq <= 0 or before_seq > last + 1:
+            before_seq = last + 1
+
+        first = max(1, before_seq - count)
+
+        # Nothing older than the oldest segment is kept
+        if self.segments:
+            first = max(first, self.segments[0].BASE_SEQ)
+
+        if first >= before_seq:
+            return before_seq, 0, []
+
+        chunks = []
+        seq = first
+
+        while seq < before_seq:
+            segment = self.segmentFor(seq)
+            last_in_segment = min(before_seq - 1, segment.BASE_SEQ + segment.count - 1)
+
+            start, end = segment.span(seq, last_in_segment)
+            _, log_map = segment.maps()
+            chunks.append(memoryview(log_map)[start:end])
+
+            seq = last_in_segment + 1
+
+        return first, before_seq - first, chunks
+
+
+    # Payloads of the newest records (oldest first), as views over the mapped log
+    def tail(self, count: int) -> list:
+        first, _, chunks = self.page(0, count)
+        records = []
+
+        for chunk in chunks:
+            offset = 0
+
+            while offset < len(chunk):
+                msg_len = int.from_bytes(chunk[offset:offset + HEADER_BYTES], byteorder="big")
+                records.append(chunk[offset + HEADER_BYTES:offset + HEADER_BYTES + msg_len])
+                offset += HEADER_BYTES + msg_len
+
+        return records
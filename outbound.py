@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+
+from collections import deque
+from enum import Enum
+from itertools import islice
+
+import os
+import socket
+import ssl
+
+from framing import HEADER_BYTES, encodeFrame
+
+
+# Most buffers one sendmsg call may gather
+try:
+    IOV_MAX = min(os.sysconf("SC_IOV_MAX"), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+
+# What to do with a client whose outbound queue grows past the high watermark
+class SlowConsumerPolicy(Enum):
+    # Discard the oldest queued frames until the queue is back under the low watermark
+    DROP_OLDEST = "drop-oldest"
+
+    # Close the connection
+    DISCONNECT = "disconnect"
+
+    # Stop queueing until the backlog drains, then send one notice of what was skipped
+    SUMMARY = "summary"
+
+    # Keep every frame; the owner stops reading requests from the client until the queue drains
+    BACKPRESSURE = "backpressure"
+
+
+
+# Bytes of stream chunks moved up for writing at once while nothing else is waiting
+BULK_GATHER_BYTES = 64 * 1024
+
+# Most bytes of small frames joined into one TLS write: one full record
+TLS_RECORD_BYTES = 16 * 1024
+
+
+
+# Frames waiting to be written to one non-blocking socket.
+# Frames are shared bytes objects, so queueing a broadcast never copies it.
+# Chunks of streamed transfers wait in a separate bulk lane that is only written
+# from when no other frame is queued, so a transfer never delays chat by more
+# than BULK_GATHER_BYTES; they are flow controlled by the sender's window and
+# never dropped.
+class OutboundQueue:
+    def __init__(self, high_watermark: int, low_watermark: int, policy: SlowConsumerPolicy, header_bytes: int = HEADER_BYTES):
+        self.HIGH_WATERMARK = high_watermark
+        self.LOW_WATERMARK = low_watermark
+        self.POLICY = policy
+        self.HEADER_BYTES = header_bytes
+
+        # Queued frames; the first one may be partially sent
+        self.frames = deque()
+        self.offset = 0
+
+        # Bytes still to be written across all queued frames
+        self.queuedBytes = 0
+
+        # Stream chunks waiting for the frames to run out, their bytes, and how many of the
+        # frames at the front are chunks already moved up (which the drop policy must keep)
+        self.bulk = deque()
+        self.bulkBytes = 0
+        self.promoted = 0
+
+        # Set while the consumer is over the high watermark (summary policy)
+        self.lagging = False
+
+        # Frames discarded or skipped because the consumer fell behind
+        self.dropped = 0
+        self.skipped = 0
+
+        # Frames the catch-up notice; multiplexed connections replace it with their own encoding
+        self.encodeNotice = lambda message: encodeFrame(message, header_bytes)
+
+        # Set once the socket is a TLS socket, which cannot gather buffers (see flushRecords)
+        self.tls = False
+
+        # TLS write the socket did not take, to be offered again as it is, and how many
+        # of the frames at the front it holds (which the drop policy must keep)
+        self.retry = None
+        self.retryFrames = 0
+
+        # Write syscalls made, whole frames they delivered and bytes written
+        self.writeCalls = 0
+        self.framesWritten = 0
+        self.bytesWritten = 0
+
+
+    # Sequenced room clients read "<seq> <message>" frames, so their catch-up notice goes out
+    # with sequence number 0 like the room's other notices
+    def sequenceNotices(self) -> None:
+        self.encodeNotice = lambda message: encodeFrame(f"0 {message}", self.HEADER_BYTES)
+
+
+    def pending(self) -> bool:
+        return len(self.frames) > 0 or len(self.bulk) > 0
+
+
+    # Over the high watermark: a backpressured client is not read from until the queue is flushed
+    def backlogged(self) -> bool:
+        return self.queuedBytes > self.HIGH_WATERMARK
+
+
+    # Queue a frame for sending. Returns False if the consumer should be disconnected.
+    def push(self, frame: bytes) -> bool:
+        if self.lagging:
+            self.skipped += 1
+            return True
+
+        self.frames.append(frame)
+        self.queuedBytes += len(frame)
+
+        if self.queuedBytes <= self.HIGH_WATERMARK or self.POLICY == SlowConsumerPolicy.BACKPRESSURE:
+            return True
+
+        if self.POLICY == SlowConsumerPolicy.DISCONNECT:
+            return False
+
+        if self.POLICY == SlowConsumerPolicy.SUMMARY:
+            # Keep what is queued but add nothing until the client catches up
+            self.lagging = True
+            return True
+
+        # Drop the oldest whole frames, keeping a partially written head frame, a TLS write
+        # waiting to be offered again, the stream chunks moved up for writing and the newest frame
+        kept = [self.frames.popleft() for _ in range(max(self.promoted, self.retryFrames, 1 if self.offset > 0 else 0))]
+
+        while self.queuedBytes > self.LOW_WATERMARK and len(self.frames) > 1:
+            old = self.frames.popleft()
+            self.queuedBytes -= len(old)
+            self.dropped += 1
+
+        self.frames.extendleft(reversed(kept))
+
+        return True
+
+
+    # Queue a stream chunk behind everything else
+    def pushBulk(self, frame: bytes) -> None:
+        self.bulk.append(frame)
+        self.bulkBytes += len(frame)
+
+
+    # Nothing else is waiting: move up to BULK_GATHER_BYTES of chunks into the frames to be written
+    def promoteBulk(self) -> None:
+        gathered = 0
+
+        while self.bulk and gathered < BULK_GATHER_BYTES:
+            frame = self.bulk.popleft()
+            self.bulkBytes -= len(frame)
+            gathered += len(frame)
+
+            self.frames.append(frame)
+            self.queuedBytes += len(frame)
+            self.promoted += 1
+
+
+    # Write as much as the socket accepts without blocking, gathering every queued frame
+    # into one sendmsg call. Returns True once the queue is empty.
+    # Socket errors other than a full send buffer are raised to the caller.
+    def flush(self, sock) -> bool:
+        if self.tls:
+            return self.flushRecords(sock)
+
+        while self.frames or self.bulk:
+            if not self.frames:
+                self.promoteBulk()
+
+            head = self.frames[0]
+
+            if self.offset:
+                head = memoryview(head)[self.offset:]
+
+            try:
+                if HAS_SENDMSG and len(self.frames) > 1:
+                    buffers = [head]
+                    buffers.extend(islice(self.frames, 1, IOV_MAX))
+                    sent = sock.sendmsg(buffers)
+                else:
+                    buffers = None
+                    sent = sock.send(head)
+            except (BlockingIOError, InterruptedError):
+                return False
+
+            self.writeCalls += 1
+            self.bytesWritten += sent
+            self.queuedBytes -= sent
+
+            # Short write: the socket buffer is full, the rest waits for the next writable event
+            full = sent < (len(head) if buffers is None else sum(len(buffer) for buffer in buffers))
+
+            # Retire every frame the write covered; what is left is the offset into the new head
+            sent += self.offset
+
+            while self.frames and sent >= len(self.frames[0]):
+                sent -= len(self.frames.popleft())
+                self.framesWritten += 1
+                self.promoted = max(0, self.promoted - 1)
+
+                if self.lagging and self.queuedBytes <= self.LOW_WATERMARK:
+                    self.catchUp()
+
+            self.offset = sent
+
+            if full:
+                return False
+
+        return True
+
+
+    # flush for a TLS socket. A TLS write is all or nothing: the socket takes the whole
+    # buffer, or nothing more until it is writable and the same bytes are offered again.
+    # Small frames are joined into writes of up to TLS_RECORD_BYTES, so a burst of chat
+    # goes out as a few full records instead of a record and a syscall per frame; a
+    # frame that fills a record by itself is written from the queue without a copy.
+    def flushRecords(self, sock) -> bool:
+        while self.frames or self.bulk:
+            if not self.frames:
+                self.promoteBulk()
+
+            if self.retry is None:
+                head = self.frames[0]
+
+                if self.offset:
+                    head = memoryview(head)[self.offset:]
+
+                buffers = [head]
+                size = len(head)
+
+                for frame in islice(self.frames, 1, None):
+                    if size + len(frame) > TLS_RECORD_BYTES:
+                        break
+
+                    buffers.append(frame)
+                    size += len(frame)
+
+                self.retry = head if len(buffers) == 1 else b"".join(buffers)
+                self.retryFrames = len(buffers)
+
+            try:
+                sent = sock.send(self.retry)
+            except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError, InterruptedError):
+                return False
+
+            frames = self.retryFrames
+            self.retry = None
+            self.retryFrames = 0
+            self.offset = 0
+
+            self.writeCalls += 1
+            self.bytesWritten += sent
+            self.queuedBytes -= sent
+
+            for _ in range(frames):
+                self.frames.popleft()
+                self.framesWritten += 1
+                self.promoted = max(0, self.promoted - 1)
+
+                if self.lagging and self.queuedBytes <= self.LOW_WATERMARK:
+                    self.catchUp()
+
+        return True
+
+
+    # Bytes still to be written, as one buffer (when the socket changes hands)
+    def unsent(self) -> bytes:
+        if not self.frames:
+            return b"".join(self.bulk)
+
+        return bytes(memoryview(self.frames[0])[self.offset:]) + b"".join(islice(self.frames, 1, None)) + b"".join(self.bulk)
+
+
+    # The socket is gone and a new connection carries on with the queue: the given frames
+    # (such as a new handshake) go first, and a partly written head frame is sent again whole
+    def restart(self, *first) -> None:
+        if self.frames:
+            self.queuedBytes += self.offset
+
+        self.offset = 0
+        self.promoted = 0
+        self.retry = None
+        self.retryFrames = 0
+
+        for frame in reversed(first):
+            self.frames.appendleft(frame)
+            self.queuedBytes += len(frame)
+
+
+    # Leave summary mode and tell the client how much it missed
+    def catchUp(self) -> None:
+        self.lagging = False
+
+        if self.skipped:
+            notice = self.encodeNotice(f"<{self.skipped} messages skipped while your connection was behind>")
+            self.skipped = 0
+
+            self.frames.append(notice)
+            self.queuedBytes += len(notice)
@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+
+# Join/leave announcements for one room, batched so a reconnect storm costs one
+# broadcast per window instead of one per event. The first event after a quiet
+# spell is announced at once and opens a window; events inside the window are
+# counted and announced together when it closes.
+class PresenceWindow:
+    __slots__ = ("joined", "left", "username", "sock", "due")
+
+    def __init__(self):
+        # Events counted since the last announcement
+        self.joined = 0
+        self.left = 0
+
+        # User and socket of the latest event, for announcing a lone event by name
+        self.username = None
+        self.sock = None
+
+        # When the open window closes (None while no window is open)
+        self.due = None
+
+
+    # Count an event. Returns True if no window is open, so the caller should announce now.
+    def note(self, username: str, sock, joined: bool) -> bool:
+        if joined:
+            self.joined += 1
+        else:
+            self.left += 1
+
+        self.username = username
+        self.sock = sock
+
+        return self.due is None
+
+
+    # Announcement for the counted events and the socket to leave out of its broadcast,
+    # or (None, None) if nothing happened. Resets the counts.
+    def take(self, online: int):
+        joined, left = self.joined, self.left
+        self.joined = self.left = 0
+
+        if joined + left == 0:
+            return None, None
+
+        # A lone event reads as before and is not echoed to the user who joined
+        if joined == 1 and left == 0:
+            return f"<{self.username} has entered the chat! ({online} users online)>", self.sock
+
+        if left == 1 and joined == 0:
+            return f"<{self.username} has disconnected ({online} users online)>", self.sock
+
+        return f"<+{joined} joined, -{left} left ({online} users online)>", None
@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+
+# Opt-in profiling for the server loops, turned on and off at runtime with
+# SIGUSR2 or the PROFILE command. While it is on:
+#   - a sampler thread records the stack of every other thread once every
+#     PROFILE_INTERVAL seconds
+#   - every loop records how each of its passes spent its time, split into
+#     phases: waiting in select, reading sockets, decoding and handling frames,
+#     fanning room messages out, writing sockets, and the rest
+# Both are kept in fixed-size ring buffers (the last PROFILE_SAMPLES samples and
+# PROFILE_SPANS passes), so a long session costs no more memory than a short one.
+#
+# Turning it off writes both to PROFILE_DIR as folded stacks, one
+# "frame;frame;...;frame count" line per distinct stack, which flamegraph.pl,
+# inferno and speedscope read as they are. Stack samples are counted per stack;
+# passes are folded as "loop;phase" with the microseconds spent in the phase.
+#
+# When it is off, a loop pays one attribute check per pass and per instrumented call.
+
+from array import array
+from collections import Counter, deque
+
+import os
+import sys
+import threading
+import time
+
+from console import console
+
+
+# Phases of a loop pass, in the order their durations are stored
+PHASES = ("wait", "read", "decode", "fanout", "write", "other")
+PHASE_WAIT, PHASE_READ, PHASE_DECODE, PHASE_FANOUT, PHASE_WRITE, PHASE_OTHER = range(len(PHASES))
+
+
+
+# Per-pass phase durations for every loop, in one flat array of doubles:
+# loop id, start time, then one duration per phase for each pass
+class SpanRing:
+    WIDTH = 2 + len(PHASES)
+
+    def __init__(self, capacity: int):
+        self.CAPACITY = capacity
+        self.records = array("d", bytes(8 * capacity * self.WIDTH))
+
+        # Passes recorded in all; the newest CAPACITY of them are kept
+        self.count = 0
+        self.lock = threading.Lock()
+
+
+    def record(self, loop: int, started: float, durations: list) -> None:
+        with self.lock:
+            offset = (self.count % self.CAPACITY) * self.WIDTH
+            self.records[offset] = loop
+            self.records[offset + 1] = started
+            self.records[offset + 2:offset + self.WIDTH] = array("d", durations)
+            self.count += 1
+
+
+    def __len__(self) -> int:
+        return min(self.count, self.CAPACITY)
+
+
+    # (loop id, start time, durations) for each pass kept, oldest first
+    def passes(self):
+        with self.lock:
+            first = self.count - len(self)
+            records = self.records[:]
+
+        for index in range(first, first + len(self)):
+            offset = (index % self.CAPACITY) * self.WIDTH
+            yield int(records[offset]), records[offset + 1], records[offset + 2:offset + self.WIDTH]
+
+
+
+# Phase timing for the passes of one loop. begin() opens a pass in the wait phase and
+# switch() charges the time since the last switch to the current phase before moving
+# to another; it returns the phase left, so nested work can switch back when done.
+class LoopTrace:
+    __slots__ = ("profiler", "LOOP", "active", "current", "mark", "started", "durations")
+
+    def __init__(self, profiler, loop: int):
+        self.profiler = profiler
+        self.LOOP = loop
+
+        # Whether the current pass is traced: fixed when the pass begins
+        self.active = False
+
+        self.current = PHASE_WAIT
+        self.mark = self.started = 0.0
+        self.durations = None
+
+
+    def begin(self) -> None:
+        self.active = self.profiler.enabled
+
+        if self.active:
+            self.started = self.mark = time.perf_counter()
+            self.current = PHASE_WAIT
+            self.durations = [0.0] * len(PHASES)
+
+
+    def switch(self, phase: int) -> int:
+        now = time.perf_counter()
+        self.durations[self.current] += now - self.mark
+        self.mark = now
+
+        previous = self.current
+        self.current = phase
+
+        return previous
+
+
+    def end(self) -> None:
+        if self.active:
+            self.switch(PHASE_OTHER)
+            self.profiler.spans.record(self.LOOP, self.started, self.durations)
+            self.active = False
+
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+
+        self.INTERVAL = 0.005
+        self.SAMPLES = 100000
+        self.SPANS = 65536
+        self.DIRECTORY = "profiles"
+
+        # Loop names by loop id
+        self.loops = []
+
+        # Folded stacks sampled, and loop passes, since profiling was last turned on
+        self.samples = deque(maxlen=self.SAMPLES)
+        self.spans = SpanRing(1)
+
+        # "file:line function" labels by code object, so a frame is only formatted once
+        self.labels = {}
+
+        self.sampler = None
+        self.startedAt = None
+
+        # Files written by the last dump
+        self.dumped = []
+
+        # Set by SIGUSR2 until the server's main loop toggles profiling between passes
+        self.togglePending = False
+
+
+    # Limits and the dump directory take effect the next time profiling is turned on
+    def configure(self, interval: float, samples: int, spans: int, directory: str) -> None:
+        self.INTERVAL = interval
+        self.SAMPLES = samples
+        self.SPANS = spans
+        self.DIRECTORY = directory
+
+
+    def loopTrace(self, name: str) -> LoopTrace:
+        self.loops.append(name.replace(";", ":"))
+
+        return LoopTrace(self, len(self.loops) - 1)
+
+
+    def start(self) -> None:
+        if self.enabled:
+            return
+
+        self.samples = deque(maxlen=self.SAMPLES)
+        self.spans = SpanRing(self.SPANS)
+        self.startedAt = time.time()
+        self.enabled = True
+
+        self.sampler = threading.Thread(target=self.sampleLoop, name="profiler", daemon=True)
+        self.sampler.start()
+        console.info(f"<Profiling on: a stack sample every {self.INTERVAL * 1000:g} ms>")
+
+
+    # Stop and write out what was recorded; returns the files written
+    def stop(self) -> list:
+        if not self.enabled:
+            return []
+
+        self.enabled = False
+
+        if self.sampler is not threading.current_thread():
+            self.sampler.join()
+
+        self.sampler = None
+        self.dumped = self.dump()
+        console.info(f"<Profiling off: {len(self.samples)} samples, {len(self.spans)} loop passes written to {', '.join(self.dumped)}>")
+
+        return self.dumped
+
+
+    def toggle(self) -> None:
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+
+    def sampleLoop(self) -> None:
+        own = threading.get_ident()
+
+        while self.enabled:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.samples.append(self.fold(names.get(ident, str(ident)), frame))
+
+            time.sleep(self.INTERVAL)
+
+
+    # "thread;outermost frame;...;innermost frame"
+    def fold(self, thread: str, frame) -> str:
+        labels = []
+
+        while frame is not None:
+            code = frame.f_code
+            label = self.labels.get(code)
+
+            if label is None:
+                label = self.labels[code] = f"{os.path.basename(code.co_filename)}:{code.co_firstlineno} {code.co_name}".replace(";", ":")
+
+            labels.append(label)
+            frame = frame.f_back
+
+        labels.append(thread.replace(";", ":"))
+        labels.reverse()
+
+        return ";".join(labels)
+
+
+    # Write the samples and loop passes recorded as folded stacks; returns the files written
+    def dump(self) -> list:
+        os.makedirs(self.DIRECTORY, exist_ok=True)
+        prefix = os.path.join(self.DIRECTORY, f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.startedAt))}-{os.getpid()}")
+
+        stacks = Counter(self.samples)
+
+        # Microseconds per loop and phase
+        phases = Counter()
+
+        for loop, _, durations in self.spans.passes():
+            for phase, seconds in zip(PHASES, durations):
+                phases[f"{self.loops[loop]};{phase}"] += seconds
+
+        paths = [prefix + "-stacks.folded", prefix + "-loops.folded"]
+
+        with open(paths[0], "w") as out:
+            out.writelines(f"{stack} {samples}\n" for stack, samples in stacks.most_common())
+
+        with open(paths[1], "w") as out:
+            out.writelines(f"{stack} {round(seconds * 1000000)}\n" for stack, seconds in phases.most_common() if seconds > 0)
+
+        return paths
+
+
+    # Summary for the PROFILE command: state, what has been recorded and per-phase totals (seconds) by loop
+    def status(self) -> dict:
+        totals = {}
+
+        for loop, _, durations in self.spans.passes():
+            phases = totals.setdefault(self.loops[loop], dict.fromkeys(PHASES, 0.0))
+
+            for phase, seconds in zip(PHASES, durations):
+                phases[phase] += seconds
+
+        return {
+            "profiling": self.enabled,
+            "samples": len(self.samples),
+            "passes": len(self.spans),
+            "loops": {name: {phase: round(seconds, 6) for phase, seconds in phases.items()} for name, phases in totals.items()},
+            "dumped": self.dumped
+        }
+
+
+profiler = Profiler()
+
+
+# SIGUSR2 handler. Toggling joins the sampler thread and writes files, so the handler only
+# asks for it and the main loop, woken by the signal, does it between passes.
+def toggleProfiling(signum, frame) -> None:
+    profiler.togglePending = True
@@ -0,0 +1,433 @@
+#!/usr/bin/python3
+
+# Binary control protocol (version 2).
+#
+# Messages travel inside the usual length-prefixed frames. A message body is
+#   opcode (u8) | request id (u32) | fields...
+# where every field is a u32 byte length followed by that many bytes. Integers
+# are sent as fixed-width big-endian fields and text as UTF-8.
+#
+# A client selects v2 by making its first frame a HELLO whose first field is
+# PROTOCOL_ID; any other first frame is a legacy username. Every request gets
+# exactly one OK or ERROR response carrying the same request id, and clients
+# may send several requests before reading the responses. Request id 0 asks
+# for no OK response (errors are still reported, with request id 0).
+#
+# One connection can subscribe to any number of rooms: JOIN answers with the
+# room's id, and room traffic arrives as MESSAGE pushes (request id 0) tagged
+# with that id. Room id 0 carries notices about the connection itself.
+# Chat messages carry the room's sequence number as a third field (u64);
+# notices have none. JOIN may add a resume token and the last sequence number
+# seen, to resume a session lost with an earlier connection (see resume.py).
+#
+# Either side may send PING; the other answers PONG with the same request id
+# (request id 0 included). The server pings connections that have sent
+# nothing for a while and disconnects the ones that stay silent.
+#
+# Large messages and attachments are streamed as binary chunks instead of one
+# frame: STREAM_OPEN <room id> <name> <size u64> answers with a stream id,
+# a window of bytes the sender may send and the largest chunk allowed.
+# STREAM_DATA <stream id> <chunk> (request id 0) carries the bytes, and
+# STREAM_END <stream id> [<reason>] finishes (or, with a reason, aborts) it.
+# WINDOW pushes return credit as the recipients take the data, so the server
+# never holds more than a window or so of any stream. The room's other v2 members get STREAM_START, STREAM_CHUNK
+# and STREAM_FINISH pushes; chunks are sent only when no other frame is
+# waiting for the connection, so chat does not queue up behind a transfer.
+# An empty name marks a long text message rather than a file.
+#
+# Federated nodes link to each other with v2 connections too, sending
+# DIRECTORY and RELAY requests with request id 0 (see federation.py).
+#
+# HELLO may carry extension fields after the username. With a
+# "compress=<codec>,..." field the server may pick a codec (see compression.py)
+# and name it as a second field of its OK as "compress=<codec>". From then on
+# it may send any run of frames to the client as one COMPRESSED push, whose
+# only field is the compressed bytes of the whole frames, length headers
+# included.
+
+from collections import deque
+
+import json
+import socket
+import struct
+
+from compression import CODECS, acceptedCodec, compressOffer
+from framing import HEADER_BYTES, MAX_FRAME_BYTES, FrameDecoder
+
+
+PROTOCOL_ID = b"sudochat/2"
+
+# Requests
+OP_HELLO = 0x00
+OP_LIST_ROOMS = 0x01
+OP_GET_ROOM = 0x02
+OP_CREATE_ROOM = 0x03
+OP_HISTORY = 0x04
+OP_BYE = 0x05
+OP_JOIN = 0x06
+OP_LEAVE = 0x07
+OP_PUBLISH = 0x08
+OP_STATS = 0x09
+
+# Keepalive, sent in either direction
+OP_PING = 0x0A
+OP_PONG = 0x0B
+
+# Streamed transfers, from the sender
+OP_STREAM_OPEN = 0x0C
+OP_STREAM_DATA = 0x0D
+OP_STREAM_END = 0x0E
+
+# Between federated nodes: DIRECTORY <room name>... and RELAY <room name> <seq u64> <text>
+OP_DIRECTORY = 0x0F
+OP_RELAY = 0x10
+
+# PROFILE [on|off] -> OK <JSON profiler state>, for clients on the server's host
+OP_PROFILE = 0x11
+
+# Responses
+OP_OK = 0x80
+OP_ERROR = 0x81
+
+# Server pushes
+OP_MESSAGE = 0x82
+
+# Streamed transfers: to the recipients STREAM_START <room id> <stream id> <sender> <name> <size u64>,
+# STREAM_CHUNK <stream id> <chunk> and STREAM_FINISH <stream id> [<abort reason>]; to the sender
+# WINDOW <stream id> <credit u32> (and STREAM_FINISH if the server aborts the stream)
+OP_STREAM_START = 0x83
+OP_STREAM_CHUNK = 0x84
+OP_STREAM_FINISH = 0x85
+OP_WINDOW = 0x86
+
+# COMPRESSED <deflated frames>, to a client that negotiated a codec
+OP_COMPRESSED = 0x87
+
+# Room id of notices that are not about a room
+NOTICE_ROOM_ID = 0
+
+MESSAGE_HEADER = struct.Struct(">BI")
+FIELD_LEN = struct.Struct(">I")
+U32 = struct.Struct(">I")
+U64 = struct.Struct(">Q")
+
+
+
+# Raised by request handlers (and by clients on an ERROR response)
+class RequestError(Exception):
+    pass
+
+
+
+def packU32(value: int) -> bytes:
+    return U32.pack(value)
+
+
+def packU64(value: int) -> bytes:
+    return U64.pack(value)
+
+
+def unpackInt(field) -> int:
+    return int.from_bytes(field, byteorder="big")
+
+
+def fieldText(field) -> str:
+    return str(field, "utf-8")
+
+
+def toField(value) -> bytes:
+    return value.encode("utf-8") if isinstance(value, str) else value
+
+
+# Whole frame (length header included) for one message
+def encodeMessage(opcode: int, request_id: int, *fields) -> bytes:
+    parts = [MESSAGE_HEADER.pack(opcode, request_id)]
+
+    for field in fields:
+        field = toField(field)
+        parts.append(FIELD_LEN.pack(len(field)))
+        parts.append(field)
+
+    body = b"".join(parts)
+
+    return len(body).to_bytes(HEADER_BYTES, byteorder="big") + body
+
+
+# Frame header, message header and leading fields of a message whose remaining
+# `tail_bytes` bytes (already laid out as fields) are sent separately
+def encodeMessageHead(opcode: int, request_id: int, tail_bytes: int, *fields) -> bytes:
+    head = encodeMessage(opcode, request_id, *fields)[HEADER_BYTES:]
+
+    return (len(head) + tail_bytes).to_bytes(HEADER_BYTES, byteorder="big") + head
+
+
+# Split a frame payload into (opcode, request id, fields). Fields are memoryview
+# slices of the frame, so they share its lifetime.
+def decodeMessage(frame):
+    frame = memoryview(frame)
+
+    if len(frame) < MESSAGE_HEADER.size:
+        raise RequestError("Truncated message header")
+
+    opcode, request_id = MESSAGE_HEADER.unpack_from(frame)
+    fields = []
+    offset = MESSAGE_HEADER.size
+
+    while offset < len(frame):
+        if offset + FIELD_LEN.size > len(frame):
+            raise RequestError("Truncated field header")
+
+        field_len = FIELD_LEN.unpack_from(frame, offset)[0]
+        offset += FIELD_LEN.size
+
+        if offset + field_len > len(frame):
+            raise RequestError("Truncated field")
+
+        fields.append(frame[offset:offset + field_len])
+        offset += field_len
+
+    return opcode, request_id, fields
+
+
+# Room traffic for a multiplexed connection: MESSAGE <room id u32> <text> [<seq u64>]
+def encodeRoomMessage(room_field: bytes, message: str, seq: int = 0) -> bytes:
+    if seq:
+        return encodeMessage(OP_MESSAGE, 0, room_field, message, packU64(seq))
+
+    return encodeMessage(OP_MESSAGE, 0, room_field, message)
+
+
+# One COMPRESSED push carrying the given whole frames
+def encodeCompressed(codec, frames: bytes) -> bytes:
+    return encodeMessage(OP_COMPRESSED, 0, codec.compress(frames))
+
+
+# Frame payloads packed in a COMPRESSED push's field. Raises ValueError if they do not inflate to whole frames.
+def expandCompressed(codec, field) -> list:
+    data = memoryview(codec.decompress(bytes(field), MAX_FRAME_BYTES))
+    frames = []
+    offset = 0
+
+    while offset < len(data):
+        if offset + HEADER_BYTES > len(data):
+            raise ValueError("Truncated compressed frame header")
+
+        msg_len = int.from_bytes(data[offset:offset + HEADER_BYTES], byteorder="big")
+        offset += HEADER_BYTES
+
+        if offset + msg_len > len(data):
+            raise ValueError("Truncated compressed frame")
+
+        frames.append(data[offset:offset + msg_len])
+        offset += msg_len
+
+    return frames
+
+
+# First frame of a v2 connection: (request id, username, extension fields), or None for a legacy client
+def parseHello(frame):
+    if len(frame) < MESSAGE_HEADER.size or frame[0] != OP_HELLO:
+        return None
+
+    try:
+        _, request_id, fields = decodeMessage(frame)
+    except RequestError:
+        return None
+
+    if len(fields) < 2 or fields[0] != PROTOCOL_ID:
+        return None
+
+    return request_id, fieldText(fields[1]), fields[2:]
+
+
+
+# Blocking v2 control client for the lobby, with request pipelining. Given a
+# tls.TLSConnector it connects over TLS, resuming the connector's session for the server.
+class ControlClient:
+    def __init__(self, host: str, port: int, username: str, compress: bool = True, tls=None):
+        self.sock = tls.connect((host, port)) if tls is not None else socket.create_connection((host, port))
+        self.decoder = FrameDecoder()
+        self.nextRequestId = 1
+
+        # Frames unpacked from a COMPRESSED push and not read yet
+        self.inflated = deque()
+
+        # (room id, text) pushes read while waiting for responses
+        self.pushed = deque()
+
+        # Resume token and newest sequence number read, by room id, for resuming each
+        # session on a later connection
+        self.tokens = {}
+        self.lastSeqs = {}
+
+        # Offer every codec this client knows; the server picks one or none
+        if compress:
+            self.codec = acceptedCodec(self.request(OP_HELLO, PROTOCOL_ID, username, compressOffer(CODECS)))
+        else:
+            self.codec = None
+            self.request(OP_HELLO, PROTOCOL_ID, username)
+
+
+    def close(self) -> None:
+        try:
+            self.sock.sendall(encodeMessage(OP_BYE, 0))
+        finally:
+            self.sock.close()
+
+
+    def newRequestId(self) -> int:
+        request_id = self.nextRequestId
+
+        # Request id 0 is reserved for requests that want no response
+        self.nextRequestId = self.nextRequestId % 0xFFFFFFFF + 1
+
+        return request_id
+
+
+    # Read one response: (opcode, request id, fields as bytes). Server pings are
+    # answered on the way, and unrequested PONGs skipped.
+    def receive(self):
+        while True:
+            if self.inflated:
+                frame = self.inflated.popleft()
+            else:
+                frame = self.decoder.readFrame(self.sock)
+
+                if frame is None:
+                    raise ConnectionError("Server closed the connection")
+
+            opcode, request_id, fields = decodeMessage(frame)
+
+            # Read the frames packed in a compressed push in order, before the next one from the socket
+            if opcode == OP_COMPRESSED and self.codec is not None and fields:
+                self.inflated.extend(expandCompressed(self.codec, fields[0]))
+                continue
+
+            if opcode == OP_PING:
+                self.sock.sendall(encodeMessage(OP_PONG, request_id))
+            elif opcode != OP_PONG or request_id != 0:
+                return opcode, request_id, [bytes(field) for field in fields]
+
+
+    def request(self, opcode: int, *fields) -> list:
+        return self.pipeline([(opcode, *fields)])[0]
+
+
+    # Send every request in one write, then collect the responses in request order.
+    # Raises RequestError for the first request the server rejected.
+    def pipeline(self, requests: list) -> list:
+        request_ids = []
+        frames = []
+
+        for opcode, *fields in requests:
+            request_id = self.newRequestId()
+            request_ids.append(request_id)
+            frames.append(encodeMessage(opcode, request_id, *fields))
+
+        self.sock.sendall(b"".join(frames))
+
+        responses = {}
+
+        while len(responses) < len(request_ids):
+            opcode, request_id, fields = self.receive()
+
+            if request_id == 0:
+                self.pushed.append((opcode, fields))
+            else:
+                responses[request_id] = (opcode, fields)
+
+        results = []
+
+        for request_id in request_ids:
+            opcode, fields = responses[request_id]
+
+            if opcode == OP_ERROR:
+                raise RequestError(fieldText(fields[0]) if fields else "Request failed")
+
+            results.append(fields)
+
+        return results
+
+
+    def listRooms(self) -> list:
+        return [fieldText(field) for field in self.request(OP_LIST_ROOMS)]
+
+
+    def getRoom(self, name: str) -> int:
+        return unpackInt(self.request(OP_GET_ROOM, name)[0])
+
+
+    def createRoom(self, name: str) -> int:
+        return unpackInt(self.request(OP_CREATE_ROOM, name)[0])
+
+
+    # (first sequence number, message texts oldest first)
+    def history(self, room: str, before_seq: int, count: int):
+        fields = self.request(OP_HISTORY, room, packU64(before_seq), packU32(count))
+
+        return unpackInt(fields[0]), [fieldText(field) for field in fields[1:]]
+
+
+    # Subscribe to a room on this connection; returns its room id. With the token and last
+    # sequence number of a session from an earlier connection, only the missed messages follow.
+    def join(self, name: str, token: str = None, last_seq: int = 0) -> int:
+        if token is not None:
+            fields = self.request(OP_JOIN, name, token, packU64(last_seq))
+        else:
+            fields = self.request(OP_JOIN, name)
+
+        room_id = unpackInt(fields[0])
+        self.tokens[room_id] = fieldText(fields[1])
+
+        return room_id
+
+
+    def leave(self, room_id: int) -> None:
+        self.request(OP_LEAVE, packU32(room_id))
+
+
+    # Server stats, or one room's stats if a room name is given
+    def stats(self, room: str = None) -> dict:
+        fields = self.request(OP_STATS, room) if room is not None else self.request(OP_STATS)
+
+        return json.loads(fields[0])
+
+
+    # Turn the server's profiler on or off (None leaves it as it is); returns its state
+    def profile(self, action: str = None) -> dict:
+        fields = self.request(OP_PROFILE, action) if action is not None else self.request(OP_PROFILE)
+
+        return json.loads(fields[0])
+
+
+    # Round trip to the server and back
+    def ping(self) -> None:
+        self.request(OP_PING)
+
+
+    # Fire and forget: only a failure is answered
+    def publish(self, room_id: int, message: str) -> None:
+        self.sock.sendall(encodeMessage(OP_PUBLISH, 0, packU32(room_id), message))
+
+
+    # Next room message as (room id, text), blocking until one arrives.
+    # Raises RequestError for a failed fire-and-forget request. Streamed
+    # transfers are skipped (AsyncChatClient receives them).
+    def nextMessage(self):
+        opcode = None
+
+        while opcode not in (OP_MESSAGE, OP_ERROR):
+            if self.pushed:
+                opcode, fields = self.pushed.popleft()
+            else:
+                opcode, _, fields = self.receive()
+
+        if opcode == OP_ERROR:
+            raise RequestError(fieldText(fields[0]) if fields else "Request failed")
+
+        room_id = unpackInt(fields[0])
+
+        if len(fields) > 2:
+            self.lastSeqs[room_id] = unpackInt(fields[2])
+
+        return room_id, fieldText(fields[1])
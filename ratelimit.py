@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+
+# Token buckets for flood control. A bucket refills at RATE tokens per second up
+# to BURST. Charging never refuses: a message that has already been read is
+# delivered and may take the bucket into debt, and the debt says how long the
+# sender must go unread before it may send again.
+
+
+class TokenBucket:
+    __slots__ = ("RATE", "BURST", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.RATE = rate
+        self.BURST = burst
+
+        # Tokens left as of the monotonic time in stamp (negative while in debt)
+        self.tokens = burst
+        self.stamp = now
+
+
+    # Take amount tokens; returns the seconds until the bucket is out of debt (0.0 if it is not)
+    def charge(self, amount: float, now: float) -> float:
+        self.tokens = min(self.BURST, self.tokens + (now - self.stamp) * self.RATE)
+        self.stamp = now
+        self.tokens -= amount
+
+        return -self.tokens / self.RATE if self.tokens < 0 else 0.0
+
+
+
+# Message and byte buckets for one sender or one room (a rate of None leaves that dimension unlimited)
+class FloodLimit:
+    __slots__ = ("messages", "bytes")
+
+    def __init__(self, message_rate, message_burst, byte_rate, byte_burst, now: float):
+        self.messages = TokenBucket(message_rate, message_burst, now) if message_rate is not None else None
+        self.bytes = TokenBucket(byte_rate, byte_burst, now) if byte_rate is not None else None
+
+
+    # Charge messages (one by default) totalling size bytes; returns the seconds before more may be accepted
+    def charge(self, size: int, now: float, messages: int = 1) -> float:
+        wait = self.messages.charge(messages, now) if self.messages is not None and messages else 0.0
+
+        if self.bytes is not None:
+            wait = max(wait, self.bytes.charge(size, now))
+
+        return wait
@@ -0,0 +1,2405 @@
+#!/usr/bin/python3
+
+from base64 import b64decode, b64encode
+from collections import OrderedDict, deque
+from heapq import heappop, heappush, nlargest
+from itertools import count, islice
+
+import json
+import os
+import selectors
+import socket
+import ssl
+import time
+
+from compression import CODECS, COMPRESS_EXTENSION, pickCodec
+from config import SERVER_SETTINGS, ConfigError, ReloadSignal, applySettings, configFile
+from console import console
+from federation import PEER_EXTENSION, Federation, peerIncarnation
+from framing import CONTROL_PREFIX, HEADER_BYTES, FrameDecoder, encodeFrame, frameText
+from handoff import CONFIRM, UpgradeListener, awaitConfirmation, receiveHandoff, sendHandoff
+from lobby import LobbyState, StepTimers
+from metrics import QUEUE_BUCKETS, Exposition, Histogram, MetricsEndpoint, RoomStats, ServerStats, escapeLabel
+from msglog import MessageLog, roomLogDir
+from outbound import OutboundQueue, SlowConsumerPolicy
+from presence import PresenceWindow
+from ratelimit import FloodLimit
+from resume import SessionTable, cachedSince
+from streaming import Stream
+from protocol import OP_BYE, OP_CREATE_ROOM, OP_ERROR, OP_GET_ROOM, OP_HISTORY, OP_JOIN, OP_LEAVE, OP_LIST_ROOMS, OP_OK, OP_PING, OP_PONG, OP_PUBLISH, OP_STATS
+from protocol import OP_DIRECTORY, OP_PROFILE, OP_RELAY, OP_STREAM_CHUNK, OP_STREAM_DATA, OP_STREAM_END, OP_STREAM_FINISH, OP_STREAM_OPEN, OP_STREAM_START, OP_WINDOW
+from protocol import NOTICE_ROOM_ID, PROTOCOL_ID, RequestError
+from protocol import decodeMessage, encodeCompressed, encodeMessage, encodeMessageHead, encodeRoomMessage, fieldText, packU32, packU64, parseHello, unpackInt
+from profiler import PHASE_DECODE, PHASE_FANOUT, PHASE_OTHER, PHASE_READ, PHASE_WRITE, profiler
+from server import Base, profileCommand
+from timerwheel import Heartbeats
+from tls import ServerHandshake, serverContext
+
+
+# Notices about a multiplexed connection itself (such as skipped messages) travel on room id 0
+NOTICE_FIELD = packU32(NOTICE_ROOM_ID)
+
+
+def encodeNotice(message: str) -> bytes:
+    return encodeRoomMessage(NOTICE_FIELD, message)
+
+
+# State for one client socket driven by the event loop
+class Connection:
+    def __init__(self, sock, config: Base):
+        self.sock = sock
+
+        # Receive buffer that frames whatever each read returns
+        self.decoder = FrameDecoder(config.HEADER_BYTES)
+
+        # Frames waiting for the socket to become writable. Lobby replies are never dropped:
+        # the client is not read from until they are written. Room members use the configured policy.
+        self.outbound = OutboundQueue(config.HIGH_WATERMARK, config.LOW_WATERMARK, SlowConsumerPolicy.BACKPRESSURE, config.HEADER_BYTES)
+
+        # Set while the selector is also watching for writability
+        self.writing = False
+
+        # Set while the connection is waiting for the end-of-iteration flush
+        self.dirty = False
+
+        # Set while requests are left unread because the client's replies are backlogged
+        self.paused = False
+
+        # Flood control for the room messages this client sends (created with the first one),
+        # the wait its last message ran up, and whether it is unread until that wait is over
+        self.limit = None
+        self.throttleFor = 0.0
+        self.throttled = False
+
+        # Step of the lobby protocol the client is at
+        self.lobbyState = LobbyState.HANDSHAKE
+
+        # Username sent as the first frame after connecting
+        self.username = None
+
+        # Control protocol picked by the first frame: 1 for string commands, 2 for binary requests
+        self.protocol = 1
+
+        # Room this socket has joined (None while it is a lobby client)
+        self.room = None
+
+        # Rooms a multiplexed (v2) connection subscribes to, by room id
+        self.rooms = {}
+
+        # Resumable sessions for the rooms it is in, by room id; a string-command room
+        # client that asked for one gets sequence-numbered frames ("<seq> <text>")
+        self.sessions = {}
+        self.sequenced = False
+
+        # RESUME_ROOM arguments (token, last seen seq) until the room name arrives
+        self.resume = None
+
+        # Room names counted in a LIST_ROOMS reply, sent once the client ACKs the count
+        self.listing = None
+
+        # Streams this connection is sending, by stream id
+        self.streams = {}
+
+        # Compression codec negotiated in a v2 HELLO (see compression.py), or None
+        self.codec = None
+
+        # Node name, for another federation node's link to this one
+        self.peer = None
+
+        # Whether the client speaks TLS (see tls.py): None until its first byte says
+        self.tls = False
+
+        # Set once the socket has been closed and unregistered
+        self.closed = False
+
+
+
+# Chat room hosted inside the event loop: no thread or listening socket of its own.
+# Rooms are plain records (no per-room config copy) so an idle room costs a few hundred bytes.
+class Room:
+    __slots__ = ("server", "msgCache", "lastSeq", "members", "presence", "stats", "limit", "PORT", "NAME", "ROOM_ID", "ROOM_FIELD", "log")
+
+    def __init__(self, server, name: str):
+        # Loop server that owns the room sockets
+        self.server = server
+
+        # Ring of previous messages (limit of ROOM_CACHE_MESSAGES), the newest having sequence number lastSeq
+        self.msgCache = deque(maxlen=server.ROOM_CACHE_MESSAGES)
+        self.lastSeq = 0
+
+        # Room -> subscribers index: connected sockets -> Connection objects, for room
+        # sockets and for multiplexed connections subscribed to this room alike
+        self.members = {}
+
+        # Join/leave announcements batched over PRESENCE_WINDOW
+        self.presence = PresenceWindow()
+
+        # Message and byte counters
+        self.stats = RoomStats()
+
+        # Flood control for everything published to the room, created with the first message
+        self.limit = None
+
+        # Rooms share the port of the loop server
+        self.PORT = server.SERVER_PORT
+        self.NAME = name
+
+        # Id tagging this room's traffic on multiplexed connections
+        self.ROOM_ID = server.newRoomId()
+        self.ROOM_FIELD = packU32(self.ROOM_ID)
+
+        # On-disk message log, opened on first use; recent messages survive a restart through it
+        self.log = None
+
+        if server.LOG_DIR and os.path.isdir(roomLogDir(server.LOG_DIR, name)):
+            self.msgCache.extend(frameText(record) for record in self.openLog().tail(server.ROOM_CACHE_MESSAGES))
+            self.lastSeq = self.log.lastSeq()
+
+
+    def openLog(self):
+        if self.log is None and self.server.LOG_DIR:
+            self.log = MessageLog(roomLogDir(self.server.LOG_DIR, self.NAME), self.server.SEGMENT_BYTES)
+
+        return self.log
+
+
+    # Write out and close the log when the room hibernates
+    def closeLog(self) -> None:
+        if self.log is not None:
+            self.server.dirtyLogs.discard(self.log)
+            self.log.close()
+            self.log = None
+
+
+    # A client that names the last message it saw (after_seq) gets every message since,
+    # otherwise the previous JOIN_BACKFILL_MESSAGES
+    def joinClient(self, conn: Connection, after_seq: int = 0) -> None:
+        # Welcome message for the new client
+        self.sendData(conn, f"<Welcome to the {self.NAME} Room!>")
+
+        # Send notif to new client of how many users in the chat
+        notif = self.chatUsersNotif()
+        self.sendData(conn, notif)
+
+        self.replay(conn, after_seq if after_seq > 0 else self.lastSeq - self.server.JOIN_BACKFILL_MESSAGES)
+
+        if not self.addClient(conn):
+            return
+
+        # Notify the other clients in the room
+        self.notePresence(conn.username, conn.sock, True)
+
+
+    # Resumed session: only the missed messages, and no announcement
+    def rejoinClient(self, conn: Connection, after_seq: int) -> None:
+        self.replay(conn, after_seq)
+        self.addClient(conn)
+
+
+    def addClient(self, conn: Connection) -> bool:
+        if conn.closed:
+            return False
+
+        if conn.protocol == 2:
+            conn.rooms[self.ROOM_ID] = self
+        else:
+            conn.room = self
+
+        if not self.members:
+            self.server.roomBusy(self)
+        self.members[conn.sock] = conn
+
+        return True
+
+
+    # Send the messages after after_seq, each with its sequence number. A connection
+    # that negotiated compression gets them all in one compressed push.
+    def replay(self, conn: Connection, after_seq: int) -> None:
+        first_seq, messages = self.messagesSince(after_seq)
+
+        if conn.codec is not None:
+            if messages:
+                self.server.queuePacked(conn, b"".join(encodeRoomMessage(self.ROOM_FIELD, msg, first_seq + offset) for offset, msg in enumerate(messages)))
+
+            return
+
+        for offset, msg in enumerate(messages):
+            self.sendData(conn, msg, first_seq + offset)
+
+
+    # (first seq, texts) of up to RESUME_MAX_MESSAGES of the newest messages after after_seq,
+    # from the cache when it reaches back far enough and from the log otherwise
+    def messagesSince(self, after_seq: int):
+        limit = self.server.RESUME_MAX_MESSAGES
+        wanted = min(self.lastSeq - max(after_seq, 0), limit)
+
+        if wanted > len(self.msgCache) and self.openLog() is not None:
+            return self.lastSeq - wanted + 1, [frameText(record) for record in self.log.tail(wanted)]
+
+        return cachedSince(self.msgCache, self.lastSeq, after_seq, limit)
+
+
+    def handleMessage(self, conn: Connection, message: str) -> None:
+        msg_prefix = f"<{conn.username}> "
+
+        # Data to send clients
+        msg_data = (msg_prefix + message)
+        seq = self.publish(msg_data, conn)
+
+        # Other federation nodes hosting the room get it once each, and fan it out themselves
+        if self.server.federation is not None:
+            self.server.stats.relaysOut += self.server.federation.relay(self.NAME, msg_data, seq)
+
+
+    # Store and broadcast a message formatted for clients; returns its sequence number. conn is
+    # the sender, None for a message relayed from another node (charged where it was sent).
+    def publish(self, msg_data: str, conn: Connection = None) -> int:
+        console.message(msg_data)
+        frame = encodeFrame(msg_data, self.server.HEADER_BYTES)
+
+        # Store message in cache
+        self.msgCache.append(msg_data)
+        seq = self.lastSeq + 1
+
+        self.stats.messagesIn += 1
+        self.stats.bytesIn += len(frame)
+        self.server.stats.messagesIn += 1
+
+        if conn is not None:
+            self.server.chargeMessage(conn, self, len(frame))
+
+        # The log stores the same frame; it is written and fsynced in batches by the loop
+        log = self.openLog()
+
+        if log is not None:
+            seq = log.append(frame)
+            self.server.dirtyLogs.add(log)
+
+        self.lastSeq = seq
+
+        # Broadcast message
+        self.broadcastFrame(conn.sock if conn is not None else None, frame, msg_data, seq)
+
+        return seq
+
+
+    # Notices go out with sequence number 0
+    def sendData(self, conn: Connection, message: str, seq: int = 0) -> None:
+        if conn.protocol == 2:
+            frame = encodeRoomMessage(self.ROOM_FIELD, message, seq)
+        elif conn.sequenced:
+            frame = encodeFrame(f"{seq} {message}", self.server.HEADER_BYTES)
+        else:
+            frame = encodeFrame(message, self.server.HEADER_BYTES)
+
+        if not self.server.queueFrame(conn, frame):
+            self.server.closeClient(conn)
+
+
+    def broadcast(self, sender_socket, message: str) -> None:
+        self.broadcastFrame(sender_socket, encodeFrame(message, self.server.HEADER_BYTES), message)
+
+
+    # frame is the message framed for room sockets; multiplexed subscribers share one
+    # MESSAGE frame carrying the room id, and sequenced room sockets one frame carrying
+    # the sequence number, each encoded on first use. Subscribers that negotiated
+    # compression share one compressed copy per codec.
+    def broadcastFrame(self, sender_socket, frame: bytes, message: str, seq: int = 0) -> None:
+        trace = self.server.trace
+
+        if trace.active:
+            previous = trace.switch(PHASE_FANOUT)
+
+        started = time.perf_counter()
+        room_frame = seq_frame = None
+        packed = {}
+        slow_members = []
+
+        # Copies queued of each framing, bytes of the multiplexed copies and bytes compression saved
+        frames_out = room_frames_out = seq_frames_out = 0
+        room_bytes_out = saved = 0
+
+        # Only queues the frame: members are written to when their sockets are writable
+        for sock, conn in self.members.items():
+            if sock == sender_socket:
+                continue
+
+            if conn.protocol == 2:
+                if room_frame is None:
+                    room_frame = encodeRoomMessage(self.ROOM_FIELD, message, seq)
+
+                out_frame = room_frame
+
+                if conn.codec is not None:
+                    out_frame = packed.get(conn.codec)
+
+                    if out_frame is None:
+                        out_frame = packed[conn.codec] = self.server.packFrames(conn.codec, room_frame)
+
+                    saved += len(room_frame) - len(out_frame)
+
+                queued = self.server.queueFrame(conn, out_frame)
+                room_frames_out += 1
+                room_bytes_out += len(out_frame)
+            elif conn.sequenced:
+                if seq_frame is None:
+                    seq_frame = encodeFrame(f"{seq} {message}", self.server.HEADER_BYTES)
+
+                queued = self.server.queueFrame(conn, seq_frame)
+                seq_frames_out += 1
+            else:
+                queued = self.server.queueFrame(conn, frame)
+                frames_out += 1
+
+            if not queued:
+                slow_members.append(conn)
+
+        self.stats.messagesOut += frames_out + room_frames_out + seq_frames_out
+        self.stats.bytesOut += frames_out * len(frame) + room_bytes_out
+        self.stats.bytesOut += seq_frames_out * len(seq_frame) if seq_frames_out else 0
+        self.server.stats.messagesOut += frames_out + room_frames_out + seq_frames_out
+        self.server.stats.compressionSaved += saved
+        self.server.stats.fanoutSeconds.observe(time.perf_counter() - started)
+
+        if trace.active:
+            trace.switch(previous)
+
+        for conn in slow_members:
+            self.server.closeClient(conn)
+
+
+    # A client whose session is kept for a resume is only announced as gone if the session expires
+    def disconnectClient(self, exit_socket, announce: bool = True) -> None:
+        # If socket has already been removed then exit
+        if exit_socket not in self.members:
+            return
+
+        user = self.members.pop(exit_socket).username
+
+        if not self.members:
+            self.server.roomIdle(self)
+
+        if announce:
+            self.notePresence(user, exit_socket, False)
+
+
+    # Announce a join or leave now, or count it into the open presence window
+    def notePresence(self, username: str, sock, joined: bool) -> None:
+        if self.presence.note(username, sock, joined):
+            self.announcePresence()
+
+
+    # Broadcast what has been counted and open a new window; with nothing counted the window closes
+    def announcePresence(self) -> None:
+        notif, skip_socket = self.presence.take(len(self.members))
+
+        if notif is None:
+            self.presence.due = None
+            return
+
+        console.info(notif, "presence")
+        self.broadcast(skip_socket, notif)
+        self.server.openPresenceWindow(self)
+
+
+    def chatUsersNotif(self) -> str:
+        numUsers = len(self.members)
+
+        # At most three names are shown, so only those are looked at
+        users = [conn.username for conn in islice(self.members.values(), 3)]
+
+        if numUsers == 0:
+            return "<You are the only user in the room!>"
+        elif numUsers == 1:
+            return f"<{users[0]} is in the room!>"
+        elif numUsers == 2:
+            return f"<{users[0]} and {users[1]} are in the room!>"
+        elif numUsers == 3:
+            return f"<{users[0]}, {users[1]} and {users[2]} are in the room!>"
+        else:
+            return f"<{users[0]}, {users[1]} and {numUsers - 2} others are in the room!>"
+
+
+
+# Single event loop (epoll on Linux via selectors) serving the lobby and every room
+class LoopServer(Base):
+    # Whether the main chat room is opened at startup
+    HOSTS_MAIN_ROOM = True
+
+    def __init__(self, port: int = None, log_dir: str = None, metrics_port: int = None, upgrade_socket: str = None, takeover: bool = False,
+                 node: str = None, peers: list = None, tls_cert: str = None, tls_key: str = None):
+        super().__init__()
+        # Port to serve on (0 picks a free one)
+        if port is not None:
+            self.SERVER_PORT = port
+
+        # Where room message logs live ("" disables them)
+        if log_dir is not None:
+            self.LOG_DIR = log_dir
+
+        # Localhost port for Prometheus scrapes (0 picks a free one)
+        if metrics_port is not None:
+            self.METRICS_PORT = metrics_port
+
+        # Unix socket for live upgrades
+        if upgrade_socket is not None:
+            self.UPGRADE_SOCKET = upgrade_socket
+
+        # Name of this node in a federation, and the other nodes' addresses
+        if node is not None:
+            self.NODE_NAME = node
+
+        if peers is not None:
+            self.PEERS = peers
+
+        # Certificate chain and private key for TLS clients
+        if tls_cert is not None:
+            self.TLS_CERT_FILE = tls_cert
+
+        if tls_key is not None:
+            self.TLS_KEY_FILE = tls_key
+
+        # Legacy and v2 clients share the port and its frame decoder, and the v2 protocol and the
+        # room logs frame everything with a HEADER_BYTES-wide length, so no other width will do here
+        if self.HEADER_BYTES != HEADER_BYTES:
+            raise ConfigError(f"config.json header-bytes: the loop server needs {HEADER_BYTES}, got {self.HEADER_BYTES}")
+
+        # Counters and histograms reported by STATS and the metrics endpoint
+        self.stats = ServerStats()
+        self.startedAt = time.monotonic()
+
+        console.configure(self.LOG_QUEUE_RECORDS, self.LOG_BATCH, self.LOG_MESSAGE_SAMPLE, self.LOG_FORMAT)
+        profiler.configure(self.PROFILE_INTERVAL, self.PROFILE_SAMPLES, self.PROFILE_SPANS, self.PROFILE_DIR)
+
+        # Phase timing of each loop pass while profiling
+        self.trace = profiler.loopTrace("loop")
+
+        # Readiness selector for the listening socket and every client socket
+        self.selector = selectors.DefaultSelector()
+
+        # Dictionary of sockets -> Connection objects
+        self.connectedUsers = {}
+
+        # Dict of Room name -> Room objects, and room id -> Room for multiplexed connections
+        self.openRooms = {}
+        self.roomIds = {}
+        self.lastRoomId = NOTICE_ROOM_ID
+
+        # Rooms without members by name -> when they emptied, oldest first; they hibernate after ROOM_IDLE_SECONDS
+        self.idleRooms = OrderedDict()
+
+        # Rooms with an open presence window, in the order the windows close
+        self.presenceWindows = deque()
+
+        # Hibernated room names -> cached messages to restore (empty when the room log holds them)
+        self.hibernated = {}
+
+        # Connections with frames queued during this loop iteration
+        self.dirtyConns = []
+
+        # Room logs with records not yet fsynced, and when the last group commit ran
+        self.dirtyLogs = set()
+        self.lastLogSync = time.monotonic()
+
+        # Longest wait for socket activity before onTick runs (None waits indefinitely)
+        self.TICK_SECONDS = None
+
+        # Deadlines for connections waiting on a handshake or lobby protocol step
+        self.timers = StepTimers()
+
+        # Pings for connections that have gone quiet, so half-open ones are noticed and closed
+        self.heartbeats = Heartbeats(self.HEARTBEAT_INTERVAL, self.HEARTBEAT_TIMEOUT)
+
+        # Resumable room sessions by token, kept for RESUME_WINDOW after their connection drops
+        self.sessions = SessionTable(self.RESUME_WINDOW)
+
+        # Connections over a flood limit, not read from until they may send again:
+        # heap of (resume time, tie breaker, connection)
+        self.throttled = []
+        self.throttleOrder = count()
+
+        # Set by watchReloads: SIGHUP reloads config.json's runtime tunables
+        self.reloadSignal = None
+
+        # Room hosts behind a control plane create rooms on the first JOIN_ROOM for them
+        self.CREATE_ON_JOIN = False
+
+        # Lobby commands are matched on the raw frame bytes, without decoding
+        self.DISCON_FRAME = self.DISCON_MSG.encode("utf-8")
+        self.PONG_FRAME = self.PONG_TEXT.encode("utf-8")
+
+        # Heartbeats as sent to string-command and multiplexed connections
+        self.PING_FRAME = encodeFrame(self.PING_TEXT, self.HEADER_BYTES)
+        self.PING_MESSAGE = encodeMessage(OP_PING, 0)
+        self.lobbyCommands = {
+            self.CMD_LIST_ROOMS.encode("utf-8"): self.listChatRooms,
+            self.CMD_GET_ROOM.encode("utf-8"): self.sendPort,
+            self.CMD_CREATE_ROOM.encode("utf-8"): self.openChatRoom,
+            self.CMD_JOIN_ROOM.encode("utf-8"): self.joinRoom,
+            self.CMD_STATS.encode("utf-8"): self.sendStats,
+            self.CMD_PROFILE.encode("utf-8"): self.sendProfile
+        }
+
+        # Lobby commands followed by space separated arguments
+        self.lobbyArgCommands = {
+            self.CMD_HISTORY.encode("utf-8"): self.sendHistory,
+            self.CMD_STATS.encode("utf-8"): self.sendStats,
+            self.CMD_PROFILE.encode("utf-8"): self.sendProfile,
+            self.CMD_RESUME_ROOM.encode("utf-8"): self.resumeRoom
+        }
+
+        # Second steps of the multi-step lobby commands, by the state they wait in
+        self.stepHandlers = {
+            LobbyState.LIST_ACK: self.finishListRooms,
+            LobbyState.GET_ROOM_NAME: self.finishSendPort,
+            LobbyState.CREATE_ROOM_NAME: self.finishOpenChatRoom,
+            LobbyState.JOIN_ROOM_NAME: self.finishJoinRoom
+        }
+
+        # Binary (v2) lobby requests by opcode; each handler returns the response frame
+        self.requestHandlers = {
+            OP_LIST_ROOMS: self.requestListRooms,
+            OP_GET_ROOM: self.requestGetRoom,
+            OP_CREATE_ROOM: self.requestCreateRoom,
+            OP_HISTORY: self.requestHistory,
+            OP_JOIN: self.requestJoin,
+            OP_LEAVE: self.requestLeave,
+            OP_PUBLISH: self.requestPublish,
+            OP_STATS: self.requestStats,
+            OP_PROFILE: self.requestProfile,
+            OP_PING: self.requestPing,
+            OP_STREAM_OPEN: self.requestStreamOpen,
+            OP_STREAM_DATA: self.requestStreamData,
+            OP_STREAM_END: self.requestStreamEnd,
+            OP_DIRECTORY: self.requestDirectory,
+            OP_RELAY: self.requestRelay
+        }
+
+        # Streamed transfers: last stream id handed out, and streams whose sender is owed credit
+        self.lastStreamId = 0
+        self.owingStreams = set()
+
+        # Scrapes and successors are answered by this loop between client events
+        self.metricsEndpoint = None
+        self.upgradeListener = None
+
+        # Handshakes for TLS clients on the server port (see tls.py), None when it only serves plaintext
+        self.tlsContext = serverContext(self.TLS_CERT_FILE, self.TLS_KEY_FILE) if self.TLS_CERT_FILE else None
+
+        # Links to the other nodes sharing rooms with this one (see federation.py)
+        self.federation = Federation(self, self.NODE_NAME, self.PEERS) if self.NODE_NAME else None
+
+        # Sockets, rooms and members come from the server being replaced
+        if takeover:
+            self.takeOver()
+            return
+
+        # Init server socket object for internet interface
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((self.SERVER_IP, self.SERVER_PORT))
+        self.server.listen()
+        self.server.setblocking(False)
+        self.SERVER_PORT = self.server.getsockname()[1]
+        self.selector.register(self.server, selectors.EVENT_READ)
+
+        console.info("<SudoChat>")
+
+        if self.METRICS_PORT is not None:
+            self.metricsEndpoint = MetricsEndpoint(self.selector, self.METRICS_PORT, self.renderMetrics)
+            console.info(f"<Metrics on http://127.0.0.1:{self.metricsEndpoint.PORT}/metrics>")
+
+        if self.UPGRADE_SOCKET is not None:
+            self.upgradeListener = UpgradeListener(self.selector, self.UPGRADE_SOCKET, self.handOff)
+
+        # The main chat room is just another entry in openRooms
+        if self.HOSTS_MAIN_ROOM:
+            self.openRooms[self.MAIN_ROOM] = self.createRoom(self.MAIN_ROOM)
+
+
+    def __del__(self):
+        console.info("Loop server closing...")
+        self.server.close()
+
+
+    def serverMain(self):
+        if self.federation is not None:
+            self.federation.start()
+
+        trace = self.trace
+
+        while True:
+            # Only sockets with pending activity are returned, however many are registered
+            # Wake up in time for the next group commit while logs have unsynced records
+            timeout = self.TICK_SECONDS
+            if self.dirtyLogs and (timeout is None or timeout > self.LOG_SYNC_SECONDS):
+                timeout = self.LOG_SYNC_SECONDS
+            timeout = self.sessions.wait(self.heartbeats.wait(self.timers.wait(timeout)))
+
+            # Wake up to bring federation links back up
+            if self.federation is not None:
+                timeout = self.federation.wait(timeout)
+
+            # Wake up to read from the next throttled client again
+            if self.throttled:
+                due = max(0.0, self.throttled[0][0] - time.monotonic())
+                timeout = due if timeout is None else min(timeout, due)
+
+            # Wake up to close the next presence window
+            if self.presenceWindows:
+                due = max(0.0, self.presenceWindows[0].presence.due - time.monotonic())
+                timeout = due if timeout is None else min(timeout, due)
+
+            # Wake up to drop recipients that hold a stream up
+            if self.owingStreams and (timeout is None or timeout > self.STREAM_STALL_SECONDS):
+                timeout = self.STREAM_STALL_SECONDS
+
+            # Wake up when the longest idle room is due to hibernate
+            if self.idleRooms:
+                due = max(0.0, next(iter(self.idleRooms.values())) + self.ROOM_IDLE_SECONDS - time.monotonic())
+                timeout = due if timeout is None else min(timeout, due)
+
+            trace.begin()
+            events = self.selector.select(timeout)
+            started = time.perf_counter()
+
+            if trace.active:
+                trace.switch(PHASE_DECODE)
+
+            for key, mask in events:
+                if key.fileobj is self.server:
+                    self.acceptClient()
+                    continue
+
+                conn = key.data
+
+                # Metrics endpoint and scrapes handle their own sockets
+                if conn.__class__ is not Connection:
+                    conn.handleEvent(mask)
+                    continue
+
+                if mask & selectors.EVENT_WRITE:
+                    if trace.active:
+                        trace.switch(PHASE_WRITE)
+
+                    self.flushClient(conn)
+
+                    if trace.active:
+                        trace.switch(PHASE_DECODE)
+
+                if mask & selectors.EVENT_READ and not conn.closed:
+                    self.readClient(conn)
+
+            if trace.active:
+                trace.switch(PHASE_OTHER)
+
+            self.resumeThrottled()
+            self.closePresenceWindows()
+            self.checkHeartbeats()
+            self.expireSessions()
+
+            # Everything queued for a socket this iteration goes out in one gathered write
+            if trace.active:
+                trace.switch(PHASE_WRITE)
+
+            self.flushDirty()
+
+            if trace.active:
+                trace.switch(PHASE_OTHER)
+
+            self.grantStreamCredit()
+            self.syncLogs()
+
+            # Relayed messages go out to each federation link in one write too
+            if self.federation is not None:
+                self.federation.reconnect()
+                self.federation.flush()
+
+            self.expireSteps()
+            self.hibernateIdleRooms()
+            self.onTick()
+
+            if self.reloadSignal is not None and self.reloadSignal.pending:
+                self.reloadSignal.pending = False
+                self.reloadConfig()
+
+            # SIGUSR2 wakes the selector through the same wakeup socket
+            if profiler.togglePending:
+                profiler.togglePending = False
+                self.toggleProfiling()
+
+            self.stats.loopSeconds.observe(time.perf_counter() - started)
+            trace.end()
+
+
+    # Reload config.json on SIGHUP; must be called from the main thread
+    def watchReloads(self) -> None:
+        self.reloadSignal = ReloadSignal(self.selector)
+
+
+    # Turn profiling on, or off and dump it, as SIGUSR2 asked
+    def toggleProfiling(self) -> None:
+        profiler.toggle()
+
+
+    # Apply the reloadable settings in config.json to the running server. A file that
+    # does not parse changes nothing.
+    def reloadConfig(self) -> None:
+        try:
+            changed = applySettings(self, [setting for setting in SERVER_SETTINGS if setting.RELOADABLE], configFile.reload(), self.configDefaults)
+        except ConfigError as e:
+            console.info(f"<Config not reloaded: {e}>")
+            return
+
+        if changed:
+            self.retune(set(changed))
+
+        console.info(f"<Config reloaded ({', '.join(changed) or 'no changes'})>")
+
+
+    # Carry changed settings over to the rooms and connections already open. Settings read
+    # where they are used (room caps, timeouts, stream and compression limits) need nothing.
+    def retune(self, changed: set) -> None:
+        conns = list(self.connectedUsers.values())
+        rooms = [room for room in self.openRooms.values() if isinstance(room, Room)]
+
+        # Queue limits for every connection, and the slow consumer policy for room members
+        if changed & {"HIGH_WATERMARK", "LOW_WATERMARK", "SLOW_CONSUMER_POLICY"}:
+            for conn in conns:
+                conn.outbound.HIGH_WATERMARK = self.HIGH_WATERMARK
+                conn.outbound.LOW_WATERMARK = self.LOW_WATERMARK
+
+                if conn.room is not None or conn.rooms:
+                    conn.outbound.POLICY = self.SLOW_CONSUMER_POLICY
+
+        # Flood limits are rebuilt with the new rates on the next message; debts run up so far are forgiven
+        if any(name.startswith(("CLIENT_", "ROOM_MESSAGE", "ROOM_BYTE")) for name in changed):
+            for conn in conns:
+                conn.limit = None
+
+            for room in rooms:
+                room.limit = None
+
+        if "ROOM_CACHE_MESSAGES" in changed:
+            for room in rooms:
+                room.msgCache = deque(room.msgCache, maxlen=self.ROOM_CACHE_MESSAGES)
+
+        # Watch every connection again, on the new interval (or not at all once disabled)
+        if changed & {"HEARTBEAT_INTERVAL", "HEARTBEAT_TIMEOUT"}:
+            self.heartbeats.INTERVAL = self.HEARTBEAT_INTERVAL
+            self.heartbeats.TIMEOUT = self.HEARTBEAT_TIMEOUT
+
+            for conn in conns:
+                self.heartbeats.forget(conn)
+
+                if conn.lobbyState != LobbyState.HANDSHAKE:
+                    self.heartbeats.watch(conn)
+
+        # Sessions from now on are kept for the new window
+        self.sessions.WINDOW = self.RESUME_WINDOW
+        console.SAMPLE_EVERY = self.LOG_MESSAGE_SAMPLE
+        profiler.configure(self.PROFILE_INTERVAL, self.PROFILE_SAMPLES, self.PROFILE_SPANS, self.PROFILE_DIR)
+
+
+    # Drop clients that have not completed a handshake or lobby step in time
+    def expireSteps(self) -> None:
+        for conn in self.timers.expired():
+            if not conn.closed:
+                console.info(f"<Client timed out in {conn.lobbyState.value} step>", "client")
+                self.closeClient(conn)
+
+
+    # Ping connections that have gone quiet and close the ones that never answered,
+    # which takes them out of every room they were in
+    def checkHeartbeats(self) -> None:
+        ping_conns, dead_conns = self.heartbeats.expired()
+
+        for conn in dead_conns:
+            console.info(f"<{conn.username} stopped answering, disconnecting>", "client")
+            self.stats.reaped += 1
+            self.closeClient(conn)
+
+        for conn in ping_conns:
+            self.stats.pings += 1
+
+            if not self.queueFrame(conn, self.PING_MESSAGE if conn.protocol == 2 else self.PING_FRAME):
+                self.closeClient(conn)
+
+
+    # Sessions nobody resumed in time: their users are announced as gone
+    def expireSessions(self) -> None:
+        for session in self.sessions.expired():
+            room = self.openRooms.get(session.ROOM)
+
+            if isinstance(room, Room):
+                room.notePresence(session.USERNAME, None, False)
+
+
+    # Charge a room message to its sender's and its room's flood limits (messages=0 charges
+    # bytes only, as for a stream chunk). Any wait they run up is served once the message
+    # is handled, by not reading from the sender.
+    def chargeMessage(self, conn: Connection, room: Room, size: int, messages: int = 1) -> None:
+        now = time.monotonic()
+
+        if conn.limit is None:
+            conn.limit = FloodLimit(self.CLIENT_MESSAGE_RATE, self.CLIENT_MESSAGE_BURST, self.CLIENT_BYTE_RATE, self.CLIENT_BYTE_BURST, now)
+
+        if room.limit is None:
+            room.limit = FloodLimit(self.ROOM_MESSAGE_RATE, self.ROOM_MESSAGE_BURST, self.ROOM_BYTE_RATE, self.ROOM_BYTE_BURST, now)
+
+        wait = conn.limit.charge(size, now, messages)
+        room_wait = room.limit.charge(size, now, messages)
+
+        if room_wait > wait:
+            room.stats.throttles += 1
+            wait = room_wait
+
+        conn.throttleFor = max(conn.throttleFor, wait)
+
+
+    # Stop reading from a client until the wait its messages ran up is over; what it sends
+    # meanwhile stays in the kernel's buffers, so TCP slows the sender down
+    def throttle(self, conn: Connection) -> None:
+        conn.throttled = True
+        heappush(self.throttled, (time.monotonic() + conn.throttleFor, next(self.throttleOrder), conn))
+        conn.throttleFor = 0.0
+
+        self.stats.throttles += 1
+        self.updateInterest(conn)
+
+
+    # Read from throttled clients again once their wait is over, starting with what is buffered
+    def resumeThrottled(self) -> None:
+        now = time.monotonic()
+
+        while self.throttled and self.throttled[0][0] <= now:
+            conn = heappop(self.throttled)[2]
+
+            if conn.closed:
+                continue
+
+            conn.throttled = False
+            self.updateInterest(conn)
+
+            if not conn.paused:
+                self.handleFrames(conn)
+
+
+    # One write per room log per loop pass, and one fsync per log every LOG_SYNC_SECONDS
+    def syncLogs(self) -> None:
+        if not self.dirtyLogs:
+            return
+
+        now = time.monotonic()
+
+        if now - self.lastLogSync < self.LOG_SYNC_SECONDS:
+            for log in self.dirtyLogs:
+                log.writePending()
+            return
+
+        for log in self.dirtyLogs:
+            log.sync()
+
+        self.dirtyLogs.clear()
+        self.lastLogSync = now
+
+
+    # Periodic work run after every pass of the loop
+    def onTick(self) -> None:
+        pass
+
+
+    def createRoom(self, name: str):
+        room = Room(self, name)
+        self.roomIds[room.ROOM_ID] = room
+        self.roomIdle(room)
+
+        return room
+
+
+    # Room by name, waking it up if it is hibernating
+    def findRoom(self, name: str):
+        room = self.openRooms.get(name)
+
+        if room is None and name in self.hibernated:
+            last_seq, cache = self.hibernated.pop(name)
+            room = self.createRoom(name)
+            room.msgCache.extend(cache)
+
+            # Sequence numbers carry on where they stopped, log or no log
+            room.lastSeq = max(room.lastSeq, last_seq)
+            self.openRooms[name] = room
+
+        # A room another federation node hosts gets a replica here
+        if room is None and self.federation is not None and name in self.federation.directory:
+            room = self.openReplica(name)
+
+        return room
+
+
+    # Open a room hosted elsewhere in the federation and have its traffic relayed here
+    def openReplica(self, name: str):
+        if self.roomCount() >= self.MAX_ROOMS:
+            return None
+
+        room = self.createRoom(name)
+        self.openRooms[name] = room
+        self.federation.announce([name])
+        console.info(f"<Joined the federation's {name} Room>", "room")
+
+        return room
+
+
+    # Rooms hosted here, open or hibernating
+    def localRoomNames(self) -> list:
+        return list(self.openRooms.keys()) + list(self.hibernated.keys())
+
+
+    # Rooms hosted here, then rooms only other federation nodes host so far
+    def roomNames(self) -> list:
+        names = self.localRoomNames()
+
+        if self.federation is not None:
+            names += [name for name in self.federation.directory if name not in self.openRooms and name not in self.hibernated]
+
+        return names
+
+
+    def roomCount(self) -> int:
+        return len(self.openRooms) + len(self.hibernated)
+
+
+    def openPresenceWindow(self, room: Room) -> None:
+        room.presence.due = time.monotonic() + self.PRESENCE_WINDOW
+        self.presenceWindows.append(room)
+
+
+    # Announce the joins and leaves counted in every window that has closed
+    def closePresenceWindows(self) -> None:
+        now = time.monotonic()
+
+        while self.presenceWindows and self.presenceWindows[0].presence.due <= now:
+            self.presenceWindows.popleft().announcePresence()
+
+
+    def roomBusy(self, room: Room) -> None:
+        self.idleRooms.pop(room.NAME, None)
+
+
+    def roomIdle(self, room: Room) -> None:
+        self.idleRooms.pop(room.NAME, None)
+        self.idleRooms[room.NAME] = time.monotonic()
+
+
+    # Rooms left without members for ROOM_IDLE_SECONDS give up their memory and log files:
+    # only the name and last sequence number stay (plus the message cache when there is no log
+    # to rebuild it from)
+    def hibernateIdleRooms(self) -> None:
+        cutoff = time.monotonic() - self.ROOM_IDLE_SECONDS
+
+        while self.idleRooms:
+            name, since = next(iter(self.idleRooms.items()))
+
+            if since > cutoff:
+                return
+
+            self.idleRooms.popitem(last=False)
+            room = self.openRooms[name]
+
+            if name == self.MAIN_ROOM:
+                continue
+
+            room.closeLog()
+            del self.openRooms[name]
+            del self.roomIds[room.ROOM_ID]
+            self.hibernated[name] = (room.lastSeq, () if self.LOG_DIR else tuple(room.msgCache))
+
+
+    def newRoomId(self) -> int:
+        self.lastRoomId += 1
+
+        return self.lastRoomId
+
+
+    def acceptClient(self) -> None:
+        try:
+            client_socket, _ = self.server.accept()
+        except BlockingIOError:
+            return
+
+        # The username is read like any other frame; the client has HANDSHAKE_TIMEOUT to send it
+        client_socket.setblocking(False)
+        conn = Connection(client_socket, self)
+        self.connectedUsers[client_socket] = conn
+
+        # With TLS on, the first bytes decide between plaintext and a TLS handshake, which the
+        # HANDSHAKE_TIMEOUT covers too
+        if self.tlsContext is not None:
+            conn.tls = None
+            self.selector.register(client_socket, selectors.EVENT_READ, ServerHandshake(self, conn))
+        else:
+            self.selector.register(client_socket, selectors.EVENT_READ, conn)
+
+        self.timers.arm(conn, self.HANDSHAKE_TIMEOUT)
+        self.stats.connections += 1
+
+
+    # Pull everything the socket has in one read and handle each complete frame in it.
+    # A TLS socket hands out at most one record per read, so it is read until what the
+    # TLS layer has decrypted is used up; the selector would not wake for that.
+    def readClient(self, conn: Connection) -> None:
+        trace = self.trace
+
+        if trace.active:
+            previous = trace.switch(PHASE_READ)
+
+        received = 0
+
+        try:
+            received = conn.decoder.feed(conn.sock)
+
+            while conn.tls and conn.sock.pending():
+                received += conn.decoder.feed(conn.sock)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            # Only part of a record, or only a TLS message of its own such as a key update
+            if received == 0:
+                if trace.active:
+                    trace.switch(previous)
+
+                return
+        except OSError:
+            received = 0
+
+        if trace.active:
+            trace.switch(previous)
+
+        if received == 0:
+            self.closeClient(conn)
+            return
+
+        self.stats.bytesIn += received
+        self.heartbeats.seen(conn)
+        self.handleFrames(conn)
+
+
+    def handleFrames(self, conn: Connection) -> None:
+        try:
+            for frame in conn.decoder.frames():
+                # Client is leaving
+                if len(frame) == 0 or frame == self.DISCON_FRAME:
+                    self.endSessions(conn)
+                    self.closeClient(conn)
+                    return
+
+                # Answer to a heartbeat; reading it already counted as a sign of life
+                if frame == self.PONG_FRAME and conn.username is not None:
+                    continue
+
+                # Sockets inside a room carry chat messages
+                if conn.room is not None:
+                    conn.room.handleMessage(conn, frameText(frame))
+
+                    # Leave the rest of the messages buffered until the client is under its limits again
+                    if conn.throttleFor:
+                        self.throttle(conn)
+                        return
+
+                    continue
+
+                if conn.lobbyState == LobbyState.HANDSHAKE:
+                    self.setUsername(conn, frame)
+                elif conn.protocol == 2:
+                    self.handleRequest(conn, frame)
+                elif conn.lobbyState == LobbyState.IDLE:
+                    self.runCommand(conn, frame)
+                else:
+                    self.stepHandlers[conn.lobbyState](conn, frame)
+
+                if conn.closed:
+                    return
+
+                if conn.throttleFor:
+                    self.throttle(conn)
+                    return
+
+                # Leave the rest of the requests buffered until the replies are written
+                if conn.room is None and conn.outbound.backlogged():
+                    conn.paused = True
+                    return
+        except (OSError, ValueError, UnicodeDecodeError):
+            self.closeClient(conn)
+
+
+    # First frame: a v2 HELLO or a legacy client's username
+    def setUsername(self, conn: Connection, frame) -> None:
+        hello = parseHello(frame)
+
+        if hello is not None:
+            request_id, conn.username, extensions = hello
+            conn.protocol = 2
+            conn.codec = pickCodec(extensions, self.COMPRESSION_CODECS)
+            incarnation = peerIncarnation(extensions) if self.federation is not None else None
+
+            if incarnation is not None:
+                conn.codec = None
+                self.linkPeer(conn, request_id, incarnation)
+            elif conn.codec is not None:
+                self.queueReply(conn, encodeMessage(OP_OK, request_id, PROTOCOL_ID, COMPRESS_EXTENSION + conn.codec.NAME))
+            else:
+                self.queueReply(conn, encodeMessage(OP_OK, request_id, PROTOCOL_ID))
+        else:
+            conn.username = frameText(frame)
+
+        self.heartbeats.watch(conn)
+        self.idle(conn)
+
+
+    # Incoming link from another federation node, named by its username
+    def linkPeer(self, conn: Connection, request_id: int, incarnation: str) -> None:
+        if conn.username == self.NODE_NAME:
+            self.queueReply(conn, encodeMessage(OP_ERROR, request_id, "Link to self"))
+            return
+
+        conn.peer = conn.username
+        replaced = self.federation.addPeer(conn.peer, incarnation, conn)
+
+        # The node reconnected (or restarted) before its old link was noticed to be gone
+        if replaced is not None:
+            self.closeClient(replaced)
+
+        console.info(f"<Federation link from {conn.peer}>")
+        self.queueReply(conn, encodeMessage(OP_OK, request_id, PROTOCOL_ID, PEER_EXTENSION + self.NODE_NAME))
+
+
+    # Lobby commands are matched on the raw frame bytes, without decoding
+    def runCommand(self, conn: Connection, frame) -> None:
+        command = bytes(frame)
+        handler = self.lobbyCommands.get(command)
+
+        if handler is not None:
+            self.stats.requests += 1
+            handler(conn)
+            return
+
+        verb, _, args = command.partition(b" ")
+        handler = self.lobbyArgCommands.get(verb)
+
+        if handler is not None:
+            self.stats.requests += 1
+            handler(conn, args.decode("utf-8"))
+
+
+    # Wait for the client's next frame in the given state, for at most STEP_TIMEOUT
+    def expect(self, conn: Connection, state: LobbyState) -> None:
+        conn.lobbyState = state
+        self.timers.arm(conn, self.STEP_TIMEOUT)
+
+
+    def idle(self, conn: Connection) -> None:
+        conn.lobbyState = LobbyState.IDLE
+        self.timers.disarm(conn)
+
+
+    # One binary request, answered with exactly one OK or ERROR carrying its request id
+    def handleRequest(self, conn: Connection, frame) -> None:
+        try:
+            opcode, request_id, fields = decodeMessage(frame)
+        except RequestError:
+            self.closeClient(conn)
+            return
+
+        if opcode == OP_BYE:
+            self.endSessions(conn)
+            self.closeClient(conn)
+            return
+
+        # Answer to a heartbeat
+        if opcode == OP_PONG:
+            return
+
+        handler = self.requestHandlers.get(opcode)
+        self.stats.requests += 1
+
+        try:
+            if handler is None:
+                raise RequestError(f"Unknown opcode {opcode}")
+
+            reply = handler(conn, request_id, fields)
+        except (RequestError, ValueError, UnicodeDecodeError) as error:
+            reply = encodeMessage(OP_ERROR, request_id, str(error))
+            self.stats.requestErrors += 1
+
+        # Request id 0 wants no OK response
+        if reply is not None and (request_id != 0 or reply[HEADER_BYTES] == OP_ERROR):
+            self.queuePacked(conn, reply)
+
+
+    # Queue an already framed lobby reply
+    def queueReply(self, conn: Connection, frame) -> None:
+        if not self.queueFrame(conn, frame):
+            self.closeClient(conn)
+
+
+    # Frames compressed into one push with codec, if they are big enough for it to be worth
+    # it and it makes them smaller; otherwise the frames themselves
+    def packFrames(self, codec, frames: bytes) -> bytes:
+        if len(frames) < self.COMPRESS_MIN_BYTES:
+            return frames
+
+        packed = encodeCompressed(codec, frames)
+        self.stats.compressed += 1
+
+        return packed if len(packed) < len(frames) else frames
+
+
+    # Queue a reply (one or more frames), compressed if the connection negotiated a codec
+    def queuePacked(self, conn: Connection, frames: bytes) -> None:
+        if conn.codec is not None:
+            packed = self.packFrames(conn.codec, frames)
+            self.stats.compressionSaved += len(frames) - len(packed)
+            frames = packed
+
+        self.queueReply(conn, frames)
+
+
+    # Queue a frame for a client and write what the socket accepts now. Returns False if the client must be dropped.
+    def queueFrame(self, conn: Connection, frame: bytes) -> bool:
+        if conn.closed:
+            return True
+
+        if not conn.outbound.push(frame):
+            return False
+
+        # Already waiting on writability, so the frame goes out with the rest of the backlog
+        if conn.writing:
+            return True
+
+        if not self.COALESCE_WRITES:
+            try:
+                self.sendQueued(conn)
+            except OSError:
+                return False
+
+            return True
+
+        # Written once this loop iteration is done, together with anything else queued for it
+        if not conn.dirty:
+            conn.dirty = True
+            self.dirtyConns.append(conn)
+
+        return True
+
+
+    def flushDirty(self) -> None:
+        # Resumed lobby clients can queue more replies while this runs
+        while self.dirtyConns:
+            dirty_conns = self.dirtyConns
+            self.dirtyConns = []
+
+            for conn in dirty_conns:
+                conn.dirty = False
+
+                if conn.closed or conn.writing:
+                    continue
+
+                try:
+                    self.sendQueued(conn)
+                except OSError:
+                    self.closeClient(conn)
+
+
+    # Write what the socket accepts now and watch for writability if anything is left
+    def sendQueued(self, conn: Connection) -> None:
+        if not conn.outbound.flush(conn.sock):
+            conn.writing = True
+            self.updateInterest(conn)
+        elif conn.paused:
+            self.resumeClient(conn)
+
+
+    def flushClient(self, conn: Connection) -> None:
+        try:
+            done = conn.outbound.flush(conn.sock)
+        except OSError:
+            self.closeClient(conn)
+            return
+
+        if done:
+            conn.writing = False
+
+            if conn.paused:
+                self.resumeClient(conn)
+            else:
+                self.updateInterest(conn)
+
+
+    # Paused and throttled clients are only watched for writability until they may send again
+    def updateInterest(self, conn: Connection) -> None:
+        events = selectors.EVENT_WRITE if conn.writing else 0
+
+        if not conn.paused and not conn.throttled:
+            events |= selectors.EVENT_READ
+
+        # A registered socket must be watched for something, so one with nothing to wait
+        # for is unregistered until it has
+        try:
+            if events:
+                self.selector.modify(conn.sock, events, conn)
+            else:
+                self.selector.unregister(conn.sock)
+        except KeyError:
+            if events:
+                self.selector.register(conn.sock, events, conn)
+
+
+    # Backlog written: read from the client again and handle the requests left buffered
+    def resumeClient(self, conn: Connection) -> None:
+        conn.paused = False
+        self.updateInterest(conn)
+        self.handleFrames(conn)
+
+
+    def closeClient(self, conn: Connection) -> None:
+        if conn.closed:
+            return
+
+        conn.closed = True
+        self.timers.disarm(conn)
+        self.heartbeats.forget(conn)
+
+        self.stats.disconnections += 1
+        self.stats.closedBytesOut += conn.outbound.bytesWritten
+
+        for stream in list(conn.streams.values()):
+            self.finishStream(stream, "Sender disconnected")
+
+        if conn.peer is not None:
+            self.federation.removePeer(conn.peer, conn)
+
+        # Rooms entered with a session keep the user's place for a resume
+        if conn.room is not None:
+            self.leaveRoom(conn, conn.room)
+            conn.room = None
+
+        for room in conn.rooms.values():
+            self.leaveRoom(conn, room)
+        conn.rooms = {}
+        conn.sessions = {}
+
+        self.connectedUsers.pop(conn.sock, None)
+
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+
+        conn.sock.close()
+
+
+    def leaveRoom(self, conn: Connection, room: Room) -> None:
+        session = conn.sessions.get(room.ROOM_ID)
+
+        if session is None:
+            room.disconnectClient(conn.sock)
+            return
+
+        room.disconnectClient(conn.sock, announce=False)
+        self.sessions.detach(session)
+
+
+    # The client left on purpose: nothing is kept for a resume
+    def endSessions(self, conn: Connection) -> None:
+        for session in conn.sessions.values():
+            self.sessions.close(session)
+
+        conn.sessions = {}
+
+
+    # Session for a client entering a room: (session, True) when the token resumes one,
+    # otherwise (new session, False)
+    def enterRoom(self, conn: Connection, room: Room, token: str):
+        session = self.sessions.find(token, room.NAME, conn.username) if token else None
+
+        if session is None:
+            session = self.sessions.open(room.NAME, conn.username, conn)
+            conn.sessions[room.ROOM_ID] = session
+            return session, False
+
+        # Still attached to an older connection the server has not noticed is gone
+        # (typically half-open): take the place over from it without announcing anything
+        old = session.conn
+
+        if old is not None and old is not conn:
+            del old.sessions[room.ROOM_ID]
+            room.disconnectClient(old.sock, announce=False)
+
+            if old.room is room:
+                old.room = None
+                self.closeClient(old)
+            else:
+                old.rooms.pop(room.ROOM_ID, None)
+
+        self.sessions.attach(session, conn)
+        conn.sessions[room.ROOM_ID] = session
+
+        return session, True
+
+
+    # Live upgrade, old process: a successor connected on the upgrade socket. Pass it every
+    # socket and the room state, and exit once it confirms; if it does not, keep serving.
+    # Clients are not read from in between, so nothing they send is lost either way.
+    def handOff(self, successor) -> None:
+        console.info("<Handing over to a new server process>")
+
+        # Streams do not survive the handoff
+        for conn in list(self.connectedUsers.values()):
+            for stream in list(conn.streams.values()):
+                self.abortStream(stream, "Server restarting")
+
+        # Neither do TLS connections, whose keys live in this process: their clients reconnect
+        # (and resume their room sessions) on the successor
+        for conn in list(self.connectedUsers.values()):
+            if conn.tls is not False:
+                self.closeClient(conn)
+
+        # Send pending announcements and whatever the sockets accept now, so less state moves
+        while self.presenceWindows:
+            self.presenceWindows.popleft().announcePresence()
+
+        self.flushDirty()
+
+        # The successor opens its own federation links; what this one still holds for them is lost
+        if self.federation is not None:
+            self.federation.flush()
+
+        # The successor reopens the room logs; they reopen here too if the handoff fails
+        for room in self.openRooms.values():
+            room.closeLog()
+
+        state, sockets = self.handoffState()
+        successor.settimeout(self.UPGRADE_TIMEOUT)
+
+        try:
+            sendHandoff(successor, state, [sock.fileno() for sock in sockets])
+            confirmed = awaitConfirmation(successor)
+        except OSError:
+            confirmed = False
+
+        successor.close()
+
+        if not confirmed:
+            console.info("<Successor did not take over, still serving>")
+            return
+
+        console.info(f"<Handed {len(self.connectedUsers)} connections to the new server process, exiting>")
+        console.close()
+
+        # Exit without closing anything: the successor holds the same sockets
+        os._exit(0)
+
+
+    # JSON-able server state and the sockets it refers to by index (listening sockets first)
+    def handoffState(self):
+        sockets = [self.server]
+        listeners = {"server": 0}
+
+        if self.metricsEndpoint is not None:
+            listeners["metrics"] = len(sockets)
+            sockets.append(self.metricsEndpoint.sock)
+
+        if self.upgradeListener is not None:
+            listeners["upgrade"] = len(sockets)
+            sockets.append(self.upgradeListener.sock)
+
+        connections = []
+
+        for conn in self.connectedUsers.values():
+            connections.append({
+                "fd": len(sockets),
+                "username": conn.username,
+                "protocol": conn.protocol,
+                "state": conn.lobbyState.value,
+                "deadline": self.timers.deadlines.get(conn),
+                "room": conn.room.NAME if conn.room is not None else None,
+                "rooms": list(conn.rooms),
+                "sessions": [[room_id, session.TOKEN] for room_id, session in conn.sessions.items()],
+                "sequenced": conn.sequenced,
+                "codec": conn.codec.NAME if conn.codec is not None else None,
+                "peer": conn.peer,
+                "policy": conn.outbound.POLICY.value,
+                "lagging": conn.outbound.lagging,
+                "skipped": conn.outbound.skipped,
+                "paused": conn.paused,
+                "listing": conn.listing,
+                "unread": b64encode(conn.decoder.buffered()).decode("ascii"),
+                "unsent": b64encode(conn.outbound.unsent()).decode("ascii")
+            })
+            sockets.append(conn.sock)
+
+        state = {
+            "listeners": listeners,
+            "lastRoomId": self.lastRoomId,
+            "lastStreamId": self.lastStreamId,
+            "rooms": [
+                {"name": name, "id": room.ROOM_ID, "cache": list(room.msgCache), "lastSeq": room.lastSeq}
+                for name, room in self.openRooms.items()
+            ],
+            "idleRooms": list(self.idleRooms.items()),
+            "hibernated": {name: [last_seq, list(cache)] for name, (last_seq, cache) in self.hibernated.items()},
+            "sessions": [[session.TOKEN, session.ROOM, session.USERNAME] for session in self.sessions.sessions.values()],
+            "federation": self.federation.handoffState() if self.federation is not None else None,
+            "connections": connections
+        }
+
+        return state, sockets
+
+
+    # Live upgrade, new process: receive the running server's sockets and state from the
+    # upgrade socket, rebuild around them and confirm, after which the old process exits
+    def takeOver(self) -> None:
+        state, fds, handoff = receiveHandoff(self.UPGRADE_SOCKET, self.UPGRADE_TIMEOUT)
+        sockets = [socket.socket(fileno=fd) for fd in fds]
+        listeners = state["listeners"]
+
+        self.server = sockets[listeners["server"]]
+        self.server.setblocking(False)
+        self.SERVER_PORT = self.server.getsockname()[1]
+        self.selector.register(self.server, selectors.EVENT_READ)
+
+        if "metrics" in listeners:
+            self.metricsEndpoint = MetricsEndpoint(self.selector, None, self.renderMetrics, sockets[listeners["metrics"]])
+        elif self.METRICS_PORT is not None:
+            self.metricsEndpoint = MetricsEndpoint(self.selector, self.METRICS_PORT, self.renderMetrics)
+
+        if "upgrade" in listeners:
+            self.upgradeListener = UpgradeListener(self.selector, self.UPGRADE_SOCKET, self.handOff, sockets[listeners["upgrade"]])
+
+        for entry in state["rooms"]:
+            room = Room(self, entry["name"])
+
+            # Multiplexed clients already hold the room's id
+            room.ROOM_ID = entry["id"]
+            room.ROOM_FIELD = packU32(room.ROOM_ID)
+            room.msgCache.clear()
+            room.msgCache.extend(entry["cache"])
+            room.lastSeq = entry["lastSeq"]
+
+            self.roomIds[room.ROOM_ID] = room
+            self.openRooms[room.NAME] = room
+
+        self.lastRoomId = state["lastRoomId"]
+        self.lastStreamId = state["lastStreamId"]
+        self.idleRooms.update(state["idleRooms"])
+        self.hibernated = {name: (last_seq, tuple(cache)) for name, (last_seq, cache) in state["hibernated"].items()}
+
+        # Sessions start out detached; the ones still in use are attached again as their
+        # connections are adopted, and the rest get a fresh RESUME_WINDOW
+        for token, room_name, username in state["sessions"]:
+            self.sessions.detach(self.sessions.open(room_name, username, None, token))
+
+        if self.federation is not None and state["federation"] is not None:
+            self.federation.restore(state["federation"])
+
+        conns = [self.adoptClient(entry, sockets[entry["fd"]]) for entry in state["connections"]]
+
+        handoff.sendall(CONFIRM)
+        handoff.close()
+
+        console.info(f"<SudoChat took over {len(conns)} connections and {len(self.openRooms)} rooms>")
+
+        # Requests the old process had read but not handled yet
+        for conn in conns:
+            if not conn.paused and not conn.closed:
+                self.handleFrames(conn)
+
+
+    def adoptClient(self, entry: dict, sock) -> Connection:
+        sock.setblocking(False)
+        conn = Connection(sock, self)
+
+        conn.username = entry["username"]
+        conn.protocol = entry["protocol"]
+        conn.sequenced = entry["sequenced"]
+        conn.codec = CODECS.get(entry["codec"])
+
+        if conn.sequenced:
+            conn.outbound.sequenceNotices()
+
+        # Another node's link keeps its place, incarnation and all
+        if entry["peer"] is not None and self.federation is not None:
+            conn.peer = entry["peer"]
+            self.federation.addPeer(conn.peer, self.federation.incarnations.get(conn.peer), conn)
+        conn.lobbyState = LobbyState(entry["state"])
+        conn.listing = entry.get("listing")
+        conn.decoder.preload(b64decode(entry["unread"]))
+
+        conn.outbound.POLICY = SlowConsumerPolicy(entry["policy"])
+        conn.outbound.lagging = entry["lagging"]
+        conn.outbound.skipped = entry["skipped"]
+
+        # A paused client is only watched for writability until its backlog is written
+        unsent = b64decode(entry["unsent"])
+        conn.paused = conn.writing = entry["paused"] and len(unsent) > 0
+
+        self.connectedUsers[sock] = conn
+        self.selector.register(sock, selectors.EVENT_WRITE if conn.paused else selectors.EVENT_READ, conn)
+
+        if entry["deadline"] is not None:
+            self.timers.armAt(conn, entry["deadline"])
+
+        # Heartbeats start over: the takeover counts as having just heard from every client
+        if conn.lobbyState != LobbyState.HANDSHAKE:
+            self.heartbeats.watch(conn)
+
+        if entry["room"] is not None:
+            conn.room = self.openRooms[entry["room"]]
+            self.addMember(conn.room, conn)
+
+        for room_id in entry["rooms"]:
+            conn.rooms[room_id] = self.roomIds[room_id]
+            conn.outbound.encodeNotice = encodeNotice
+            self.addMember(conn.rooms[room_id], conn)
+
+        for room_id, token in entry["sessions"]:
+            conn.sessions[room_id] = session = self.sessions.sessions[token]
+            self.sessions.attach(session, conn)
+
+        if unsent:
+            self.queueFrame(conn, unsent)
+
+        return conn
+
+
+    def addMember(self, room: Room, conn: Connection) -> None:
+        if not room.members:
+            self.roomBusy(room)
+
+        room.members[conn.sock] = conn
+
+
+    # Replies are queued like room traffic, so a client that stops reading never blocks the loop
+    def sendData(self, conn: Connection, message: str) -> None:
+        self.queueReply(conn, encodeFrame(message, self.HEADER_BYTES))
+
+
+    # Client requests to see all the open chatrooms
+    def listChatRooms(self, conn: Connection):
+        self.sendData(conn, "ACK")
+
+        # Send back number of chatrooms, then wait for the client's ACK. The names are taken
+        # now, so the client gets exactly as many as it was told (federated rooms included).
+        conn.listing = self.roomNames()
+        self.sendData(conn, str(len(conn.listing)))
+
+        self.expect(conn, LobbyState.LIST_ACK)
+
+
+    def finishListRooms(self, conn: Connection, frame):
+        self.idle(conn)
+
+        # A connection handed over by a server that did not keep the names gets the current ones
+        listing = conn.listing if conn.listing is not None else self.roomNames()
+        conn.listing = None
+
+        if frame != b"ACK":
+            console.info("<Send chat room list failed>", "client")
+            return
+
+        # Iterate through room names and send to client
+        for roomName in listing:
+            self.sendData(conn, roomName)
+
+
+    # Client requests entry to room: get room name and send back port
+    def sendPort(self, conn: Connection):
+        self.sendData(conn, "ACK")
+        self.expect(conn, LobbyState.GET_ROOM_NAME)
+
+
+    def finishSendPort(self, conn: Connection, frame):
+        self.idle(conn)
+
+        port = self.roomPort(frameText(frame))
+
+        if port is not None:
+            self.sendData(conn, str(port))
+        else:
+            self.sendData(conn, "NACK")
+
+
+    def openChatRoom(self, conn: Connection):
+        # Check if we have reached limit num of rooms
+        if self.roomCount() < self.MAX_ROOMS:
+            self.sendData(conn, "ACK")
+            self.expect(conn, LobbyState.CREATE_ROOM_NAME)
+        else:
+            self.sendData(conn, "NACK")
+
+
+    def finishOpenChatRoom(self, conn: Connection, frame):
+        self.idle(conn)
+
+        room = self.addRoom(frameText(frame))
+
+        if room is not None:
+            self.sendData(conn, str(room.PORT))
+        else:
+            self.sendData(conn, "NACK")
+
+
+    def roomPort(self, roomName: str):
+        room = self.findRoom(roomName)
+
+        return room.PORT if room is not None else None
+
+
+    # Open a new room, or return None if the name is taken or the room limit is reached
+    def addRoom(self, name: str):
+        if not name or name.startswith(CONTROL_PREFIX) or name in self.openRooms or name in self.hibernated or self.roomCount() >= self.MAX_ROOMS:
+            return None
+
+        # Room names are shared across a federation
+        if self.federation is not None and name in self.federation.directory:
+            return None
+
+        # Creating a room only allocates its state, no port or thread
+        room = self.createRoom(name)
+        self.openRooms[name] = room
+        console.info(f"<Welcome to the {name} Room!>", "room")
+
+        if self.federation is not None:
+            self.federation.announce([name])
+
+        return room
+
+
+    # Room a client asks to join by name, created on demand by room hosts behind a control plane
+    def joinableRoom(self, roomName: str):
+        room = self.findRoom(roomName)
+
+        if room is None and roomName and not roomName.startswith(CONTROL_PREFIX) and self.CREATE_ON_JOIN:
+            room = self.createRoom(roomName)
+            self.openRooms[roomName] = room
+
+        return room
+
+
+    # Room client names the room it is entering in the next frame
+    def joinRoom(self, conn: Connection) -> None:
+        self.expect(conn, LobbyState.JOIN_ROOM_NAME)
+
+
+    # RESUME_ROOM <token, or - for a new session> <last seen seq>: JOIN_ROOM with sequenced
+    # frames and a resumable session
+    def resumeRoom(self, conn: Connection, args: str) -> None:
+        try:
+            token, last_seq = args.split(" ")
+            conn.resume = (token if token != "-" else None, int(last_seq))
+        except ValueError:
+            self.sendData(conn, "NACK")
+            return
+
+        self.expect(conn, LobbyState.JOIN_ROOM_NAME)
+
+
+    # The socket carries chat traffic from here on
+    def finishJoinRoom(self, conn: Connection, frame) -> None:
+        self.idle(conn)
+
+        room = self.joinableRoom(frameText(frame))
+
+        if room is None:
+            self.closeClient(conn)
+            return
+
+        # Members that fall behind are handled by the slow-consumer policy instead of backpressure
+        conn.outbound.POLICY = self.SLOW_CONSUMER_POLICY
+
+        if conn.resume is None:
+            room.joinClient(conn)
+            return
+
+        # "0 SESSION <token>" before the welcome, or "0 RESUMED <token>" before the missed messages
+        token, after_seq = conn.resume
+        conn.resume = None
+        conn.sequenced = True
+        conn.outbound.sequenceNotices()
+        session, resumed = self.enterRoom(conn, room, token)
+
+        if resumed:
+            room.sendData(conn, f"RESUMED {session.TOKEN}")
+            room.rejoinClient(conn, after_seq)
+        else:
+            room.sendData(conn, f"SESSION {session.TOKEN}")
+            room.joinClient(conn, after_seq)
+
+
+    # Log backing a room's history, or None if it has none
+    def roomLog(self, roomName: str):
+        room = self.findRoom(roomName)
+
+        return room.openLog() if room is not None else None
+
+
+    # HISTORY <room> <before-seq> <count>: reply "<first-seq> <count>" and then that many
+    # message frames, oldest first, sent straight from the mapped log segments.
+    # A before-seq of 0 pages back from the newest message.
+    def sendHistory(self, conn: Connection, args: str) -> None:
+        try:
+            roomName, before_seq, count = args.rsplit(" ", 2)
+            page = self.historyPage(roomName, int(before_seq), int(count))
+        except ValueError:
+            page = None
+
+        if page is None:
+            self.sendData(conn, "NACK")
+            return
+
+        first_seq, num_records, chunks = page
+        self.sendData(conn, f"{first_seq} {num_records}")
+
+        # Views over the mapped segments are queued as they are, without copying
+        for chunk in chunks:
+            self.queueReply(conn, chunk)
+
+
+    # (first seq, record count, mapped chunks) for a history request, or None if the room has no log
+    def historyPage(self, roomName: str, before_seq: int, count: int):
+        count = min(count, self.HISTORY_PAGE_MAX)
+        log = self.roomLog(roomName)
+
+        if log is None or count <= 0:
+            return None
+
+        return log.page(before_seq, count)
+
+
+    # STATS [<room>]: reply with the server's (or the room's) stats as one JSON frame, or NACK
+    def sendStats(self, conn: Connection, args: str = "") -> None:
+        stats = self.roomStats(args) if args else self.serverStats()
+
+        if stats is None:
+            self.sendData(conn, "NACK")
+        else:
+            self.sendData(conn, json.dumps(stats))
+
+
+    # PROFILE [on|off]: turn the profiler on, or off and dump it, and reply with its state
+    def sendProfile(self, conn: Connection, args: str = "") -> None:
+        status = profileCommand(conn.sock, args)
+        self.sendData(conn, "NACK" if status is None else json.dumps(status))
+
+
+    # Outbound backlog over every connection: (depth histogram, total bytes, deepest queue, dropped, skipped)
+    def queueDepths(self):
+        depths = Histogram(QUEUE_BUCKETS)
+        dropped = skipped = 0
+
+        for conn in self.connectedUsers.values():
+            depths.observe(conn.outbound.queuedBytes)
+            dropped += conn.outbound.dropped
+            skipped += conn.outbound.skipped
+
+        deepest = max((conn.outbound.queuedBytes for conn in self.connectedUsers.values()), default=0)
+
+        return depths, int(depths.sum), deepest, dropped, skipped
+
+
+    def bytesOut(self) -> int:
+        return self.stats.closedBytesOut + sum(conn.outbound.bytesWritten for conn in self.connectedUsers.values())
+
+
+    def serverStats(self) -> dict:
+        stats = self.stats
+        _, queued, deepest, dropped, skipped = self.queueDepths()
+
+        return {
+            "uptime_seconds": round(time.monotonic() - self.startedAt, 3),
+            "connected_users": len(self.connectedUsers),
+            "rooms_open": len(self.openRooms),
+            "rooms_hibernated": len(self.hibernated),
+            "connections": stats.connections,
+            "disconnections": stats.disconnections,
+            "messages_in": stats.messagesIn,
+            "messages_out": stats.messagesOut,
+            "bytes_in": stats.bytesIn,
+            "bytes_out": self.bytesOut(),
+            "requests": stats.requests,
+            "request_errors": stats.requestErrors,
+            "outbound_queued_bytes": queued,
+            "outbound_max_queued_bytes": deepest,
+            "frames_dropped": dropped,
+            "frames_skipped": skipped,
+            "heartbeat_pings": stats.pings,
+            "heartbeat_reaped": stats.reaped,
+            "throttles": stats.throttles,
+            "streams": stats.streams,
+            "stream_bytes": stats.streamBytes,
+            "compressed_frames": stats.compressed,
+            "compression_saved_bytes": stats.compressionSaved,
+            "federation_links_up": self.federation.linksUp() if self.federation is not None else 0,
+            "relays_out": stats.relaysOut,
+            "relays_in": stats.relaysIn,
+            "relay_duplicates": stats.relayDuplicates,
+            "tls_handshakes": stats.tlsHandshakes,
+            "tls_resumed": stats.tlsResumed,
+            "tls_failures": stats.tlsFailures,
+            "log_records_dropped": console.dropped,
+            "fanout_seconds": stats.fanoutSeconds.summary(),
+            "loop_seconds": stats.loopSeconds.summary()
+        }
+
+
+    # Messages in a room's history: the log's length, or the cache when the log is not open
+    def historySize(self, room: Room) -> int:
+        return room.log.lastSeq() if room.log is not None else len(room.msgCache)
+
+
+    # Stats for a room hosted here, or None
+    def roomStats(self, roomName: str):
+        room = self.openRooms.get(roomName)
+
+        if not isinstance(room, Room):
+            return None
+
+        return {
+            "room": room.NAME,
+            "members": len(room.members),
+            "messages_in": room.stats.messagesIn,
+            "messages_out": room.stats.messagesOut,
+            "bytes_in": room.stats.bytesIn,
+            "bytes_out": room.stats.bytesOut,
+            "throttles": room.stats.throttles,
+            "history_messages": self.historySize(room),
+            "outbound_queued_bytes": sum(conn.outbound.queuedBytes for conn in room.members.values())
+        }
+
+
+    # Prometheus exposition of the server stats, with per-room series for the
+    # METRICS_ROOM_LIMIT busiest rooms that have members
+    def renderMetrics(self) -> bytes:
+        stats = self.stats
+        depths, queued, deepest, dropped, skipped = self.queueDepths()
+        out = Exposition()
+
+        out.metric("sudochat_connected_users", "gauge", "Open client connections", len(self.connectedUsers))
+        out.metric("sudochat_rooms_open", "gauge", "Rooms held in memory", len(self.openRooms))
+        out.metric("sudochat_rooms_hibernated", "gauge", "Rooms hibernated to their name", len(self.hibernated))
+        out.metric("sudochat_connections_total", "counter", "Connections accepted", stats.connections)
+        out.metric("sudochat_disconnections_total", "counter", "Connections closed", stats.disconnections)
+        out.metric("sudochat_messages_in_total", "counter", "Room messages published", stats.messagesIn)
+        out.metric("sudochat_messages_out_total", "counter", "Room message copies queued to members", stats.messagesOut)
+        out.metric("sudochat_bytes_in_total", "counter", "Bytes read from clients", stats.bytesIn)
+        out.metric("sudochat_bytes_out_total", "counter", "Bytes written to clients", self.bytesOut())
+        out.metric("sudochat_requests_total", "counter", "Lobby commands and v2 requests handled", stats.requests)
+        out.metric("sudochat_request_errors_total", "counter", "v2 requests answered with ERROR", stats.requestErrors)
+        out.metric("sudochat_outbound_queued_bytes", "gauge", "Bytes queued to clients", queued)
+        out.metric("sudochat_outbound_max_queued_bytes", "gauge", "Deepest outbound queue", deepest)
+        out.metric("sudochat_frames_dropped", "gauge", "Frames dropped for slow consumers on open connections", dropped)
+        out.metric("sudochat_frames_skipped", "gauge", "Frames skipped for lagging consumers on open connections", skipped)
+        out.metric("sudochat_heartbeat_pings_total", "counter", "Pings sent to quiet connections", stats.pings)
+        out.metric("sudochat_heartbeat_reaped_total", "counter", "Connections closed for not answering a ping", stats.reaped)
+        out.metric("sudochat_throttles_total", "counter", "Times a client was left unread for going over a flood limit", stats.throttles)
+        out.metric("sudochat_streams_total", "counter", "Streamed transfers opened", stats.streams)
+        out.metric("sudochat_stream_bytes_total", "counter", "Chunk bytes relayed for streamed transfers", stats.streamBytes)
+        out.metric("sudochat_compressed_frames_total", "counter", "Compressed pushes encoded (once per codec for a broadcast)", stats.compressed)
+        out.metric("sudochat_compression_saved_bytes_total", "counter", "Bytes compression saved over every copy queued", stats.compressionSaved)
+        out.metric("sudochat_federation_links_up", "gauge", "Links to other federation nodes that are up", self.federation.linksUp() if self.federation is not None else 0)
+        out.metric("sudochat_relays_out_total", "counter", "Room messages sent to other federation nodes (one per link)", stats.relaysOut)
+        out.metric("sudochat_relays_in_total", "counter", "Room messages relayed from other federation nodes", stats.relaysIn)
+        out.metric("sudochat_relay_duplicates_total", "counter", "Relayed room messages dropped as already seen", stats.relayDuplicates)
+        out.metric("sudochat_tls_handshakes_total", "counter", "TLS handshakes completed", stats.tlsHandshakes)
+        out.metric("sudochat_tls_resumed_total", "counter", "TLS handshakes that resumed a session", stats.tlsResumed)
+        out.metric("sudochat_tls_failures_total", "counter", "TLS handshakes that failed", stats.tlsFailures)
+        out.metric("sudochat_log_records_dropped_total", "counter", "Console log records dropped on a full queue", console.dropped)
+        out.histogram("sudochat_fanout_seconds", "Time to queue one message to a room's members", stats.fanoutSeconds)
+        out.histogram("sudochat_loop_seconds", "Time handling one pass of the event loop", stats.loopSeconds)
+        out.histogram("sudochat_outbound_queue_bytes", "Outbound queue depth per connection", depths)
+
+        busy = [room for room in self.openRooms.values() if isinstance(room, Room) and room.members]
+        rooms = nlargest(self.METRICS_ROOM_LIMIT, busy, key=lambda room: room.stats.messagesIn)
+
+        room_series = (
+            ("sudochat_room_members", "gauge", "Room members", lambda room: len(room.members)),
+            ("sudochat_room_messages_in_total", "counter", "Messages published to the room", lambda room: room.stats.messagesIn),
+            ("sudochat_room_messages_out_total", "counter", "Message copies queued to room members", lambda room: room.stats.messagesOut),
+            ("sudochat_room_bytes_in_total", "counter", "Framed bytes published to the room", lambda room: room.stats.bytesIn),
+            ("sudochat_room_bytes_out_total", "counter", "Framed bytes queued to room members", lambda room: room.stats.bytesOut),
+            ("sudochat_room_throttles_total", "counter", "Senders throttled for the room's flood limit", lambda room: room.stats.throttles),
+            ("sudochat_room_history_messages", "gauge", "Messages in the room's history", self.historySize)
+        )
+
+        for name, kind, help_text, value in room_series:
+            out.family(name, kind, help_text)
+
+            for room in rooms:
+                out.sample(name, value(room), f"room=\"{escapeLabel(room.NAME)}\"")
+
+        return out.text()
+
+
+    # Binary request handlers: each returns its response frame (or queues it itself and
+    # returns None), or raises RequestError
+
+    # DIRECTORY <room name>... from a federation link: rooms that node hosts
+    def requestDirectory(self, conn: Connection, request_id: int, fields: list):
+        if conn.peer is None:
+            raise RequestError("Not a federation link")
+
+        self.federation.hostedBy(conn.peer, [fieldText(field) for field in fields])
+
+        return None
+
+
+    # RELAY <room name> <seq u64> <text> from a federation link: a message published on that node
+    def requestRelay(self, conn: Connection, request_id: int, fields: list):
+        if conn.peer is None:
+            raise RequestError("Not a federation link")
+
+        if len(fields) != 3:
+            raise RequestError("RELAY takes a room name, a sequence number and a message")
+
+        name = fieldText(fields[0])
+        seq = unpackInt(fields[1])
+
+        if not self.federation.isNew(conn.peer, name, seq):
+            self.stats.relayDuplicates += 1
+            return None
+
+        room = self.findRoom(name)
+
+        if room is None:
+            raise RequestError("No such room")
+
+        # Only a delivered message counts as seen, so one that failed is taken if it is sent again
+        room.publish(fieldText(fields[2]))
+        self.federation.taken(conn.peer, name, seq)
+        self.stats.relaysIn += 1
+
+        return None
+
+
+    # LIST_ROOMS -> OK <room name>...
+    def requestListRooms(self, conn: Connection, request_id: int, fields: list) -> bytes:
+        return encodeMessage(OP_OK, request_id, *self.roomNames())
+
+
+    # GET_ROOM <name> -> OK <port u32>
+    def requestGetRoom(self, conn: Connection, request_id: int, fields: list) -> bytes:
+        if len(fields) != 1:
+            raise RequestError("GET_ROOM takes a room name")
+
+        port = self.roomPort(fieldText(fields[0]))
+
+        if port is None:
+            raise RequestError("No such room")
+
+        return encodeMessage(OP_OK, request_id, packU32(port))
+
+
+    # CREATE_ROOM <name> -> OK <port u32>
+    def requestCreateRoom(self, conn: Connection, request_id: int, fields: list) -> bytes:
+        if len(fields) != 1:
+            raise RequestError("CREATE_ROOM takes a room name")
+
+        room = self.addRoom(fieldText(fields[0]))
+
+        if room is None:
+            raise RequestError("Room exists or room limit reached")
+
+        return encodeMessage(OP_OK, request_id, packU32(room.PORT))
+
+
+    # HISTORY <room> <before-seq u64> <count u32> -> OK <first-seq u64> <message>...
+    # Log records have the same length-prefixed layout as fields, so the mapped
+    # chunks are sent as the tail of the response without copying.
+    def requestHistory(self, conn: Connection, request_id: int, fields: list):
+        if len(fields) != 3:
+            raise RequestError("HISTORY takes a room, a sequence number and a count")
+
+        page = self.historyPage(fieldText(fields[0]), unpackInt(fields[1]), unpackInt(fields[2]))
+
+        if page is None:
+            raise RequestError("No history for room")
+
+        first_seq, _, chunks = page
+        head = encodeMessageHead(OP_OK, request_id, sum(len(chunk) for chunk in chunks), packU64(first_seq))
+
+        # The log's chunks are queued as they are, unless they are to be compressed
+        if conn.codec is not None:
+            self.queuePacked(conn, head + b"".join(chunks))
+            return None
+
+        self.queueReply(conn, head)
+
+        for chunk in chunks:
+            self.queueReply(conn, chunk)
+
+        return None
+
+
+    # JOIN <name> [<resume token> <last seen seq u64>] -> OK <room id u32> <resume token>, then
+    # the room's welcome as MESSAGE pushes, or only the missed messages when the session resumes
+    def requestJoin(self, conn: Connection, request_id: int, fields: list):
+        if len(fields) not in (1, 3):
+            raise RequestError("JOIN takes a room name, and optionally a resume token and sequence number")
+
+        room = self.joinableRoom(fieldText(fields[0]))
+
+        if room is None:
+            raise RequestError("No such room")
+
+        if room.ROOM_ID in conn.rooms:
+            raise RequestError("Already in room")
+
+        token, after_seq = (fieldText(fields[1]), unpackInt(fields[2])) if len(fields) == 3 else (None, 0)
+
+        # Members that fall behind are handled by the slow-consumer policy instead of backpressure
+        conn.outbound.POLICY = self.SLOW_CONSUMER_POLICY
+        conn.outbound.encodeNotice = encodeNotice
+
+        session, resumed = self.enterRoom(conn, room, token)
+
+        # The id goes out before any traffic tagged with it
+        self.queueReply(conn, encodeMessage(OP_OK, request_id, room.ROOM_FIELD, session.TOKEN))
+
+        if resumed:
+            room.rejoinClient(conn, after_seq)
+        else:
+            room.joinClient(conn, after_seq)
+
+        return None
+
+
+    # LEAVE <room id u32> -> OK
+    def requestLeave(self, conn: Connection, request_id: int, fields: list) -> bytes:
+        if len(fields) != 1:
+            raise RequestError("LEAVE takes a room id")
+
+        room = conn.rooms.pop(unpackInt(fields[0]), None)
+
+        if room is None:
+            raise RequestError("Not in room")
+
+        session = conn.sessions.pop(room.ROOM_ID, None)
+
+        if session is not None:
+            self.sessions.close(session)
+
+        room.disconnectClient(conn.sock)
+
+        return encodeMessage(OP_OK, request_id)
+
+
+    # STATS [<room name>] -> OK <JSON stats>
+    def requestStats(self, conn: Connection, request_id: int, fields: list) -> bytes:
+        if len(fields) > 1:
+            raise RequestError("STATS takes at most a room name")
+
+        stats = self.roomStats(fieldText(fields[0])) if fields else self.serverStats()
+
+        if stats is None:
+            raise RequestError("No stats for room")
+
+        return encodeMessage(OP_OK, request_id, json.dumps(stats))
+
+
+    # PROFILE [on|off] -> OK <JSON profiler state>
+    def requestProfile(self, conn: Connection, request_id: int, fields: list) -> bytes:
+        if len(fields) > 1:
+            raise RequestError("PROFILE takes at most on or off")
+
+        status = profileCommand(conn.sock, fieldText(fields[0]) if fields else "")
+
+        if status is None:
+            raise RequestError("PROFILE takes on or off, from the server's host only")
+
+        return encodeMessage(OP_OK, request_id, json.dumps(status))
+
+
+    # PING -> PONG, with the request id even when it is 0
+    def requestPing(self, conn: Connection, request_id: int, fields: list):
+        self.queueReply(conn, encodeMessage(OP_PONG, request_id))
+
+        return None
+
+
+    # PUBLISH <room id u32> <text> -> OK
+    def requestPublish(self, conn: Connection, request_id: int, fields: list) -> bytes:
+        if len(fields) != 2:
+            raise RequestError("PUBLISH takes a room id and a message")
+
+        room = conn.rooms.get(unpackInt(fields[0]))
+
+        if room is None:
+            raise RequestError("Not in room")
+
+        room.handleMessage(conn, fieldText(fields[1]))
+
+        return encodeMessage(OP_OK, request_id)
+
+
+    # STREAM_OPEN <room id u32> <name> <size u64> -> OK <stream id u32> <window u32> <largest chunk u32>. The room's
+    # other v2 members become its recipients; legacy room sockets cannot take binary chunks,
+    # so they are only told about it.
+    def requestStreamOpen(self, conn: Connection, request_id: int, fields: list) -> bytes:
+        if len(fields) != 3:
+            raise RequestError("STREAM_OPEN takes a room id, a name and a size")
+
+        room = conn.rooms.get(unpackInt(fields[0]))
+
+        if room is None:
+            raise RequestError("Not in room")
+
+        name, size = fieldText(fields[1]), unpackInt(fields[2])
+
+        if size > self.STREAM_MAX_BYTES:
+            raise RequestError(f"Streams are limited to {self.STREAM_MAX_BYTES} bytes")
+
+        if len(conn.streams) >= self.STREAM_MAX_OPEN:
+            raise RequestError(f"At most {self.STREAM_MAX_OPEN} streams may be open at once")
+
+        self.lastStreamId += 1
+        recipients = {sock: member for sock, member in room.members.items() if member.protocol == 2 and member is not conn}
+        stream = Stream(self.lastStreamId, room, conn, name, size, recipients, self.STREAM_WINDOW, time.monotonic())
+
+        conn.streams[stream.STREAM_ID] = stream
+        self.stats.streams += 1
+        self.chargeMessage(conn, room, len(name))
+
+        self.relayStream(stream, encodeMessage(OP_STREAM_START, 0, room.ROOM_FIELD, stream.STREAM_FIELD, conn.username, name, packU64(size)))
+
+        for member in [member for member in room.members.values() if member.protocol != 2 and member is not conn]:
+            room.sendData(member, f"<{conn.username} sent {name or 'a long message'} ({size} bytes), which needs a v2 client>")
+
+        return encodeMessage(OP_OK, request_id, stream.STREAM_FIELD, packU32(self.STREAM_WINDOW), packU32(self.STREAM_CHUNK_BYTES))
+
+
+    # STREAM_DATA <stream id u32> <chunk>, normally with request id 0: the chunk is framed once
+    # and that frame queued to every recipient
+    def requestStreamData(self, conn: Connection, request_id: int, fields: list):
+        if len(fields) != 2:
+            raise RequestError("STREAM_DATA takes a stream id and a chunk")
+
+        stream = conn.streams.get(unpackInt(fields[0]))
+
+        if stream is None:
+            raise RequestError("No such stream")
+
+        chunk = fields[1]
+
+        if len(chunk) > self.STREAM_CHUNK_BYTES:
+            raise RequestError(f"Chunks are limited to {self.STREAM_CHUNK_BYTES} bytes")
+
+        if len(chunk) > stream.credit:
+            self.abortStream(stream, "Window exceeded")
+            raise RequestError("Window exceeded")
+
+        if stream.received + len(chunk) > stream.SIZE:
+            self.abortStream(stream, "Size exceeded")
+            raise RequestError("Size exceeded")
+
+        stream.received += len(chunk)
+        stream.credit -= len(chunk)
+        stream.owed += len(chunk)
+        self.owingStreams.add(stream)
+        self.stats.streamBytes += len(chunk)
+
+        # A chunk counts against the sender's and room's byte rates like a message of its size, and
+        # a sender over them goes unread until it is under again; the stream was the message
+        self.chargeMessage(conn, stream.ROOM, len(chunk), 0)
+
+        self.relayStream(stream, encodeMessage(OP_STREAM_CHUNK, 0, stream.STREAM_FIELD, chunk))
+
+        return encodeMessage(OP_OK, request_id) if request_id else None
+
+
+    # STREAM_END <stream id u32> [<reason>] -> OK: the stream is complete, or the sender gave up on it
+    def requestStreamEnd(self, conn: Connection, request_id: int, fields: list) -> bytes:
+        if len(fields) not in (1, 2):
+            raise RequestError("STREAM_END takes a stream id and optionally a reason")
+
+        stream = conn.streams.get(unpackInt(fields[0]))
+
+        if stream is None:
+            raise RequestError("No such stream")
+
+        if len(fields) == 2:
+            self.finishStream(stream, fieldText(fields[1]))
+        elif stream.received != stream.SIZE:
+            self.finishStream(stream, "Size mismatch")
+            raise RequestError(f"Stream ended after {stream.received} of {stream.SIZE} bytes")
+        else:
+            self.finishStream(stream)
+
+        return encodeMessage(OP_OK, request_id)
+
+
+    # Queue a stream frame behind everything else for every recipient still in the room
+    def relayStream(self, stream: Stream, frame: bytes) -> None:
+        room = stream.ROOM
+        gone = []
+
+        for sock, member in stream.recipients.items():
+            if member.closed or member.rooms.get(room.ROOM_ID) is not room:
+                gone.append(sock)
+            else:
+                self.queueBulk(member, frame)
+
+        for sock in gone:
+            del stream.recipients[sock]
+
+
+    # Stream frames are always written at the end of the loop pass
+    def queueBulk(self, conn: Connection, frame: bytes) -> None:
+        conn.outbound.pushBulk(frame)
+
+        if not conn.writing and not conn.dirty:
+            conn.dirty = True
+            self.dirtyConns.append(conn)
+
+
+    # Tell the recipients the stream is complete, or with a reason, that it was cut short
+    def finishStream(self, stream: Stream, reason: str = None) -> None:
+        del stream.SENDER.streams[stream.STREAM_ID]
+        self.owingStreams.discard(stream)
+
+        if reason is None:
+            self.relayStream(stream, encodeMessage(OP_STREAM_FINISH, 0, stream.STREAM_FIELD))
+        else:
+            self.relayStream(stream, encodeMessage(OP_STREAM_FINISH, 0, stream.STREAM_FIELD, reason))
+
+
+    # The server gives up on a stream: its sender is told as well as the recipients
+    def abortStream(self, stream: Stream, reason: str) -> None:
+        self.finishStream(stream, reason)
+        self.queueReply(stream.SENDER, encodeMessage(OP_STREAM_FINISH, 0, stream.STREAM_FIELD, reason))
+
+
+    # Return credit to senders once every recipient has drained its bulk lane below half a window.
+    # A recipient that holds a stream up for STREAM_STALL_SECONDS is dropped from it instead.
+    def grantStreamCredit(self) -> None:
+        if not self.owingStreams:
+            return
+
+        now = time.monotonic()
+        limit = self.STREAM_WINDOW // 2
+
+        for stream in list(self.owingStreams):
+            slow = [sock for sock, member in stream.recipients.items() if member.outbound.bulkBytes > limit and not member.closed]
+
+            if slow and now - stream.since < self.STREAM_STALL_SECONDS:
+                continue
+
+            for sock in slow:
+                self.queueBulk(stream.recipients.pop(sock), encodeMessage(OP_STREAM_FINISH, 0, stream.STREAM_FIELD, "Too slow"))
+
+            self.owingStreams.discard(stream)
+            stream.credit += stream.owed
+            stream.since = now
+
+            self.queueReply(stream.SENDER, encodeMessage(OP_WINDOW, 0, stream.STREAM_FIELD, packU32(stream.owed)))
+            stream.owed = 0
+
+        # Credit goes out in this pass, so senders are not left waiting for the next event
+        self.flushDirty()
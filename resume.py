@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+
+# Resumable room sessions. Every room message has a sequence number, and a
+# client entering a room is given a resume token for its place there. If the
+# connection drops, the session is kept for RESUME_WINDOW seconds: the client
+# can reconnect with the token and the last sequence number it saw, and gets
+# back exactly the messages it missed, without a fresh welcome and without
+# its leave and rejoin being announced to the room. A session nobody resumes
+# expires, and only then is the user announced as gone.
+
+import secrets
+
+from timerwheel import TimerWheel
+
+
+class Session:
+    __slots__ = ("TOKEN", "ROOM", "USERNAME", "conn")
+
+    def __init__(self, token: str, room: str, username: str, conn):
+        self.TOKEN = token
+        self.ROOM = room
+        self.USERNAME = username
+
+        # Connection (or socket) currently in the room under this session, None while detached
+        self.conn = conn
+
+
+
+# Open sessions by token, with expiry timers for the detached ones
+class SessionTable:
+    def __init__(self, window: float):
+        self.WINDOW = window
+        self.sessions = {}
+        self.wheel = TimerWheel()
+
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+
+    def open(self, room: str, username: str, conn, token: str = None) -> Session:
+        session = Session(token or secrets.token_urlsafe(16), room, username, conn)
+        self.sessions[session.TOKEN] = session
+
+        return session
+
+
+    # The session a token names, if it is for this room and user
+    def find(self, token: str, room: str, username: str):
+        session = self.sessions.get(token)
+
+        if session is None or session.ROOM != room or session.USERNAME != username:
+            return None
+
+        return session
+
+
+    def attach(self, session: Session, conn) -> None:
+        self.wheel.cancel(session)
+        session.conn = conn
+
+
+    # Connection lost: keep the session for WINDOW seconds
+    def detach(self, session: Session) -> None:
+        session.conn = None
+        self.wheel.schedule(session, self.WINDOW)
+
+
+    # Client left on purpose
+    def close(self, session: Session) -> None:
+        self.sessions.pop(session.TOKEN, None)
+        self.wheel.cancel(session)
+
+
+    def wait(self, timeout: float = None):
+        return self.wheel.wait(timeout)
+
+
+    # Remove and return the detached sessions nobody resumed in time
+    def expired(self) -> list:
+        sessions = self.wheel.advance()
+
+        for session in sessions:
+            del self.sessions[session.TOKEN]
+
+        return sessions
+
+
+
+# Messages after after_seq held in a cache of the newest messages, newest last_seq:
+# (sequence number of the first one, up to limit of the newest of them)
+def cachedSince(cache, last_seq: int, after_seq: int, limit: int):
+    count = min(last_seq - max(after_seq, 0), len(cache), limit)
+
+    if count <= 0:
+        return last_seq + 1, []
+
+    return last_seq - count + 1, list(cache)[-count:]
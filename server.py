@@ -1,11 +1,31 @@
 #!/usr/bin/python3
 
+from itertools import islice
+
+import argparse
+import ipaddress
+import json
+import os
+import signal
 import socket
 import threading
 import select
-
-
-# Base class with config options
+import time
+
+from config import SERVER_SETTINGS, ConfigError, applySettings, configFile, reloadableDefaults
+from console import console
+from framing import CONTROL_PREFIX, FrameDecoder, controlCommand, encodeFrame, frameText
+from lobby import LobbyState, StepTimers
+from outbound import OutboundQueue, SlowConsumerPolicy
+from presence import PresenceWindow
+from profiler import PHASE_DECODE, PHASE_FANOUT, PHASE_OTHER, PHASE_READ, PHASE_WRITE, profiler, toggleProfiling
+from ratelimit import FloodLimit
+from resume import SessionTable, cachedSince
+from timerwheel import Heartbeats
+
+
+# Base class with config options. These are the defaults; config.json (see config.py)
+# overrides any of them, and a loop server applies the reloadable ones again on SIGHUP.
 class Base:
     def __init__(self):
         # Config constants
@@ -13,38 +33,237 @@ class Base:
         self.SERVER_PORT = 5000
         self.HEADER_BYTES = 4
         self.DISCON_MSG = "DISCONNECT"
-        self.MAX_ROOMS =  10
+        self.MAX_ROOMS = 100000
+        self.MAIN_ROOM = "Group Chat"
+
+        # Room cap for the threaded server, where every room costs a thread, a listening socket and a port
+        self.THREADED_MAX_ROOMS = 10
+
+        # Most recent messages each room keeps in memory, and how many of them a joining client is sent
+        self.ROOM_CACHE_MESSAGES = 10
+        self.JOIN_BACKFILL_MESSAGES = 5
+
+        # Seconds a loop server room may sit without members before it hibernates
+        self.ROOM_IDLE_SECONDS = 300.0
+
+        # Seconds over which joins and leaves after the first are collected into one announcement
+        self.PRESENCE_WINDOW = 0.5
+
+        # Outbound queue limits per room client (bytes) and what to do with clients that fall behind
+        self.HIGH_WATERMARK = 256 * 1024
+        self.LOW_WATERMARK = 64 * 1024
+        self.SLOW_CONSUMER_POLICY = SlowConsumerPolicy.DROP_OLDEST
+
+        # Hold room frames until the end of each loop pass so each socket gets one gathered write
+        self.COALESCE_WRITES = True
+
+        # Per-room message logs for the loop server ("" keeps history in memory only):
+        # directory, segment size, group fsync interval and largest HISTORY page
+        self.LOG_DIR = "history"
+        self.SEGMENT_BYTES = 16 * 1024 * 1024
+        self.LOG_SYNC_SECONDS = 0.05
+        self.HISTORY_PAGE_MAX = 500
+
+        # Seconds a client has to send its username after connecting, and to answer each
+        # step of a multi-step lobby command, before it is disconnected
+        self.HANDSHAKE_TIMEOUT = 10.0
+        self.STEP_TIMEOUT = 10.0
+
+        # Seconds a connection may send nothing before it is pinged, and then to send anything
+        # (such as the PONG) before it is disconnected as dead; None disables heartbeats
+        self.HEARTBEAT_INTERVAL = 30.0
+        self.HEARTBEAT_TIMEOUT = 30.0
+
+        # Flood control for chat messages, as token buckets: messages and bytes per second, and the
+        # burst allowed on top, for each client and for each room as a whole (None lifts a limit).
+        # A client over either limit is not read from until it is back under it.
+        self.CLIENT_MESSAGE_RATE = 20.0
+        self.CLIENT_MESSAGE_BURST = 50
+        self.CLIENT_BYTE_RATE = 64 * 1024
+        self.CLIENT_BYTE_BURST = 256 * 1024
+        self.ROOM_MESSAGE_RATE = 1000.0
+        self.ROOM_MESSAGE_BURST = 2000
+        self.ROOM_BYTE_RATE = 1024 * 1024
+        self.ROOM_BYTE_BURST = 4 * 1024 * 1024
+
+        # Seconds a room session is kept after its connection drops, so the client can resume it
+        # with its token and last seen sequence number, and most missed messages sent on resume
+        self.RESUME_WINDOW = 60.0
+        self.RESUME_MAX_MESSAGES = 500
+
+        # Streamed transfers (v2 clients of the loop server): largest chunk, bytes a sender may have
+        # in flight per stream, largest stream, streams open per sender, and seconds a stream waits
+        # on a recipient that is not taking its chunks before dropping that recipient from it
+        self.STREAM_CHUNK_BYTES = 16 * 1024
+        self.STREAM_WINDOW = 256 * 1024
+        self.STREAM_MAX_BYTES = 1024 * 1024 * 1024
+        self.STREAM_MAX_OPEN = 4
+        self.STREAM_STALL_SECONDS = 30.0
+
+        # Compression codecs v2 clients may negotiate, in order of preference (empty disables
+        # compression; see compression.py), and the fewest bytes of frames worth compressing
+        self.COMPRESSION_CODECS = ("deflate-dict/1",)
+        self.COMPRESS_MIN_BYTES = 512
+
+        # Federation of loop servers (see federation.py): this node's name (None disables it), the
+        # "host:port" of every other node, and the most bytes queued for a link that is down or slow
+        self.NODE_NAME = None
+        self.PEERS = ()
+        self.PEER_QUEUE_BYTES = 4 * 1024 * 1024
+
+        # Localhost port serving Prometheus metrics from the loop server (None disables it),
+        # and how many of the busiest rooms get their own series
+        self.METRICS_PORT = None
+        self.METRICS_ROOM_LIMIT = 100
+
+        # Console log written by a background thread: most records queued before new ones are
+        # dropped, records per write, one chat message logged in every LOG_MESSAGE_SAMPLE
+        # (0 logs none) and "text" or "json" lines
+        self.LOG_QUEUE_RECORDS = 65536
+        self.LOG_BATCH = 512
+        self.LOG_MESSAGE_SAMPLE = 1
+        self.LOG_FORMAT = "text"
+
+        # Profiling (see profiler.py), off until SIGUSR2 or a PROFILE command from the server's own
+        # host: seconds between stack samples, most samples and loop passes kept, and where
+        # the folded stacks are written when it is turned off
+        self.PROFILE_INTERVAL = 0.005
+        self.PROFILE_SAMPLES = 100000
+        self.PROFILE_SPANS = 65536
+        self.PROFILE_DIR = "profiles"
+
+        # TLS on the loop server's port (see tls.py): PEM certificate chain (None serves plaintext
+        # only) and its private key (None when the chain file holds it), and whether plaintext
+        # clients are turned away. Federation links are plaintext, so nodes with peers leave
+        # TLS_REQUIRED off.
+        self.TLS_CERT_FILE = None
+        self.TLS_KEY_FILE = None
+        self.TLS_REQUIRED = False
+
+        # Unix socket on which a loop server hands its sockets and rooms to a successor
+        # (None disables live upgrades), and how long it waits for the successor to confirm
+        self.UPGRADE_SOCKET = None
+        self.UPGRADE_TIMEOUT = 10.0
         
         # Commands b/w server and root client
         self.CMD_LIST_ROOMS = "LIST_ROOMS"
         self.CMD_GET_ROOM = "GET_ROOM"
         self.CMD_CREATE_ROOM = "CREATE_ROOM"
 
+        # Command sent by room clients (after username) naming the room to enter
+        self.CMD_JOIN_ROOM = "JOIN_ROOM"
+
+        # Room client command used instead of JOIN_ROOM for sequenced messages and a resumable
+        # session: RESUME_ROOM <token, or - for a new session> <last seen seq>, then the room name
+        self.CMD_RESUME_ROOM = "RESUME_ROOM"
+
+        # Lobby command with arguments: HISTORY <room> <before-seq> <count>
+        self.CMD_HISTORY = "HISTORY"
+
+        # Lobby command replying with server (or, given a room name, room) stats as JSON: STATS [<room>]
+        self.CMD_STATS = "STATS"
+
+        # Lobby command turning the profiler on or off, replying with its state as JSON: PROFILE [on|off]
+        self.CMD_PROFILE = "PROFILE"
+
+        # Keepalive frames: the server sends PING to a quiet client, which answers PONG
+        self.CMD_PING = "PING"
+        self.CMD_PONG = "PONG"
+
+        # Defaults a reload falls back on for reloadable settings the file no longer sets
+        self.configDefaults = reloadableDefaults(self, SERVER_SETTINGS)
+        self.configGeneration = configFile.generation
+        applySettings(self, SERVER_SETTINGS)
+
+        # Heartbeats as control frames, which no room name or chat message can be mistaken for
+        self.PING_TEXT = controlCommand(self.CMD_PING)
+        self.PONG_TEXT = controlCommand(self.CMD_PONG)
+
 
 
 class MainServer(Base):
     def __init__(self):
         super().__init__()
-        # List of sockets to poll for activity
-        self.socketList = []
+        self.MAX_ROOMS = self.THREADED_MAX_ROOMS
+
+        console.configure(self.LOG_QUEUE_RECORDS, self.LOG_BATCH, self.LOG_MESSAGE_SAMPLE, self.LOG_FORMAT)
+
+        # Rooms here are threads on ports of their own; TLS is only served by the loop server
+        if self.TLS_CERT_FILE:
+            console.info("<TLS needs --loop or --workers, serving plaintext only>")
+
+        profiler.configure(self.PROFILE_INTERVAL, self.PROFILE_SAMPLES, self.PROFILE_SPANS, self.PROFILE_DIR)
+
+        # Phase timing of each loop pass while profiling
+        self.trace = profiler.loopTrace("lobby")
+
+        # Set of sockets to poll for activity
+        self.sockets = set()
 
         # Dictionary of sockets -> usernames
         self.connectedUsers = {}
 
+        # Dictionary of sockets -> FrameDecoder receive buffers
+        self.decoders = {}
+
+        # Dictionary of sockets -> OutboundQueue of replies not yet written
+        self.outbound = {}
+
+        # Sockets with queued replies, polled for writability
+        self.writers = set()
+
+        # Sockets not read from until their reply backlog is written
+        self.paused = set()
+
+        # Dictionary of sockets -> LobbyState, and deadlines for the ones waiting on the client
+        self.lobbyStates = {}
+        self.timers = StepTimers()
+
+        # Pings for clients that have gone quiet, so half-open connections are noticed
+        self.heartbeats = Heartbeats(self.HEARTBEAT_INTERVAL, self.HEARTBEAT_TIMEOUT)
+
+        # Handler for a message from a client in each lobby state
+        self.stepHandlers = {
+            LobbyState.HANDSHAKE: self.setUsername,
+            LobbyState.IDLE: self.runCommand,
+            LobbyState.LIST_ACK: self.finishListRooms,
+            LobbyState.GET_ROOM_NAME: self.finishSendPort,
+            LobbyState.CREATE_ROOM_NAME: self.finishOpenChatRoom
+        }
+
         # Dict of ChatRoom name -> ChatRoom objects
         self.openRooms = {}
 
+        # Next port to give a room; only ever increases, so ports are never handed out twice
+        self.nextRoomPort = self.SERVER_PORT + 1
+
         # Init server socket object for internet interface
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.bind((self.SERVER_IP, self.SERVER_PORT))
-        self.socketList.append(self.server)
+        self.server.setblocking(False)
+        self.sockets.add(self.server)
+
+        # The interpreter writes every signal it catches to this socket, which wakes the loop
+        # to toggle profiling on SIGUSR2 or reload config.json on SIGHUP (only the main thread
+        # may set it up)
+        self.signalReader = None
+        self.reloadPending = False
 
-        print("<SudoChat>")
+        if threading.current_thread() is threading.main_thread():
+            self.signalReader, self.signalWriter = socket.socketpair()
+            self.signalReader.setblocking(False)
+            self.signalWriter.setblocking(False)
+            signal.set_wakeup_fd(self.signalWriter.fileno(), warn_on_full_buffer=False)
+            signal.signal(signal.SIGHUP, self.requestReload)
+            self.sockets.add(self.signalReader)
+
+        console.info("<SudoChat>")
 
         # Initialize the main chat room in parallel thread
-        self.mainRoom = ChatRoom(self.SERVER_PORT + 1, "Group Chat")
+        self.mainRoom = ChatRoom(self.nextRoomPort, self.MAIN_ROOM)
+        self.nextRoomPort += 1
         self.openRooms[self.mainRoom.NAME] = self.mainRoom
-        t1 = threading.Thread(target=self.mainRoom.startChat)
+        t1 = threading.Thread(target=self.mainRoom.startChat, name=f"room {self.MAIN_ROOM}")
         t1.start()
 
         # Listen for messages and connections
@@ -54,130 +273,348 @@ class MainServer(Base):
 
     
     def __del__(self):
-        print("Main server thread closing...")
+        console.info("Main server thread closing...")
         self.server.close()
 
     
+    # Every client is a state machine advanced by readiness events, so no client can stall the others
     def serverMain(self):
+        trace = self.trace
+
         while True:
-            # OS level polling for activity on the listed sockets (listens for data packet on sockets)
-            active_sockets, _, _ = select.select(self.socketList, [], self.socketList)
+            read_sockets = [sock for sock in self.sockets if sock not in self.paused]
+
+            # OS level polling for activity on the listed sockets, waking up for the next step deadline or heartbeat
+            timeout = self.heartbeats.wait(self.timers.wait())
+            trace.begin()
+            active_sockets, writable_sockets, _ = select.select(read_sockets, list(self.writers), [], timeout)
+
+            # Continue writing queued replies to clients that can take more
+            if trace.active:
+                trace.switch(PHASE_WRITE)
+
+            for writable_socket in writable_sockets:
+                self.flushClient(writable_socket)
+
+            if trace.active:
+                trace.switch(PHASE_DECODE)
 
             for active_socket in active_sockets:
                 if active_socket == self.server:
-                    # accept connection from a client socket
-                    client_socket, _ = self.server.accept()
-
-                    # Call method to get username and store in clientDict
-                    username = self.getData(client_socket)
-
-                    if username is None:
-                        continue
-
-                    self.socketList.append(client_socket)
-                    self.connectedUsers[client_socket] = username
-                else:
-                    # Parse commands from client socket
-                    message = self.getData(active_socket)
-
-                    # If no message, the client has disconnected
-                    if not message or message == self.DISCON_MSG:
-                        self.socketList.remove(active_socket)
-                        continue
-                    
-                    if message == self.CMD_LIST_ROOMS:
-                        self.listChatRooms(active_socket)
-                    elif message == self.CMD_GET_ROOM:
-                        self.sendPort(active_socket)
-                    elif message == self.CMD_CREATE_ROOM:
-                        self.openChatRoom(active_socket)
-
-
-    def getData(self, client_socket) -> str:
+                    self.acceptClient()
+                elif active_socket == self.signalReader:
+                    self.drainSignals()
+                elif active_socket in self.decoders:
+                    # Parse every command the client has sent so far
+                    self.handleCommands(active_socket, self.readMessages(active_socket))
+
+            if trace.active:
+                trace.switch(PHASE_OTHER)
+
+            # Drop clients that have not completed a protocol step in time
+            for client_socket in self.timers.expired():
+                if client_socket in self.lobbyStates:
+                    console.info(f"<Lobby client timed out in {self.lobbyStates[client_socket].value} step>", "client")
+                    self.disconnectClient(client_socket)
+
+            self.checkHeartbeats()
+
+            if profiler.togglePending:
+                profiler.togglePending = False
+                profiler.toggle()
+
+            if self.reloadPending:
+                self.reloadPending = False
+                self.reloadConfig()
+
+            trace.end()
+
+
+    def requestReload(self, signum, frame) -> None:
+        self.reloadPending = True
+
+
+    # Apply the reloadable settings in config.json to the lobby. Rooms run on threads of their
+    # own and apply the same document between their passes once it has been adopted here.
+    def reloadConfig(self) -> None:
+        try:
+            document = configFile.read()
+            changed = applySettings(self, [setting for setting in SERVER_SETTINGS if setting.RELOADABLE], document, self.configDefaults)
+        except ConfigError as e:
+            console.info(f"<Config not reloaded: {e}>")
+            return
+
+        configFile.adopt(document)
+        self.configGeneration = configFile.generation
+
+        # Rooms are capped by the threaded server's own limit, which is only read at startup
+        self.MAX_ROOMS = self.THREADED_MAX_ROOMS
+        changed = [name for name in changed if name != "MAX_ROOMS"]
+
+        if changed:
+            self.retune(set(changed))
+
+        console.info(f"<Config reloaded ({', '.join(changed) or 'no changes'})>")
+
+
+    # Carry changed settings over to the lobby clients already connected
+    def retune(self, changed: set) -> None:
+        if changed & {"HIGH_WATERMARK", "LOW_WATERMARK"}:
+            for queue in self.outbound.values():
+                queue.HIGH_WATERMARK = self.HIGH_WATERMARK
+                queue.LOW_WATERMARK = self.LOW_WATERMARK
+
+        if changed & {"HEARTBEAT_INTERVAL", "HEARTBEAT_TIMEOUT"}:
+            self.heartbeats.INTERVAL = self.HEARTBEAT_INTERVAL
+            self.heartbeats.TIMEOUT = self.HEARTBEAT_TIMEOUT
+
+            for client_socket in self.connectedUsers:
+                self.heartbeats.forget(client_socket)
+                self.heartbeats.watch(client_socket)
+
+        console.SAMPLE_EVERY = self.LOG_MESSAGE_SAMPLE
+        profiler.configure(self.PROFILE_INTERVAL, self.PROFILE_SAMPLES, self.PROFILE_SPANS, self.PROFILE_DIR)
+
+
+    def drainSignals(self) -> None:
+        try:
+            while self.signalReader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+
+    # Ping clients that have gone quiet and drop the ones that never answered
+    def checkHeartbeats(self) -> None:
+        ping_sockets, dead_sockets = self.heartbeats.expired()
+
+        for client_socket in dead_sockets:
+            console.info(f"<Lobby client {self.connectedUsers.get(client_socket)} stopped answering>", "client")
+            self.disconnectClient(client_socket)
+
+        for client_socket in ping_sockets:
+            self.sendData(client_socket, self.PING_TEXT)
+
+
+    def acceptClient(self) -> None:
+        try:
+            client_socket, _ = self.server.accept()
+        except BlockingIOError:
+            return
+
+        # The username arrives like any other message; the client has HANDSHAKE_TIMEOUT to send it
+        client_socket.setblocking(False)
+        self.decoders[client_socket] = FrameDecoder(self.HEADER_BYTES)
+        self.outbound[client_socket] = OutboundQueue(self.HIGH_WATERMARK, self.LOW_WATERMARK, SlowConsumerPolicy.BACKPRESSURE, self.HEADER_BYTES)
+        self.lobbyStates[client_socket] = LobbyState.HANDSHAKE
+        self.timers.arm(client_socket, self.HANDSHAKE_TIMEOUT)
+        self.sockets.add(client_socket)
+
+
+    def handleCommands(self, client_socket, messages) -> None:
+        for message in messages:
+            # If no message, the client has disconnected
+            if not message or message == self.DISCON_MSG:
+                self.disconnectClient(client_socket)
+                break
+
+            # Answer to a heartbeat; reading it already counted as a sign of life
+            if message == self.PONG_TEXT and client_socket in self.connectedUsers:
+                continue
+
+            self.stepHandlers[self.lobbyStates[client_socket]](client_socket, message)
+
+            if client_socket not in self.lobbyStates:
+                break
+
+            # Leave the rest of the client's requests buffered until its replies are written
+            if self.outbound[client_socket].backlogged():
+                self.paused.add(client_socket)
+                break
+
+
+    # Wait for the client's next message in the given state, for at most STEP_TIMEOUT
+    def expect(self, client_socket, state: LobbyState) -> None:
+        self.lobbyStates[client_socket] = state
+        self.timers.arm(client_socket, self.STEP_TIMEOUT)
+
+
+    def idle(self, client_socket) -> None:
+        self.lobbyStates[client_socket] = LobbyState.IDLE
+        self.timers.disarm(client_socket)
+
+
+    def setUsername(self, client_socket, username: str) -> None:
+        self.connectedUsers[client_socket] = username
+        self.heartbeats.watch(client_socket)
+        self.idle(client_socket)
+
+
+    def runCommand(self, client_socket, message: str) -> None:
+        if message == self.CMD_LIST_ROOMS:
+            self.listChatRooms(client_socket)
+        elif message == self.CMD_GET_ROOM:
+            self.sendPort(client_socket)
+        elif message == self.CMD_CREATE_ROOM:
+            self.openChatRoom(client_socket)
+        elif message.partition(" ")[0] == self.CMD_PROFILE:
+            status = profileCommand(client_socket, message.partition(" ")[2])
+            self.sendData(client_socket, "NACK" if status is None else json.dumps(status))
+
+
+    # Read what is available on a readable socket and yield each complete message (None on disconnect)
+    def readMessages(self, client_socket, fill: bool = True):
+        decoder = self.decoders[client_socket]
+
         try:
-            # Read header packet which gives length of payload
-            msg_header = client_socket.recv(self.HEADER_BYTES)
-            msg_len = int.from_bytes(msg_header, byteorder="big")
-            
-            # Read message payload from client
-            payload = client_socket.recv(msg_len).decode("utf-8")
+            if fill:
+                if self.trace.active:
+                    previous = self.trace.switch(PHASE_READ)
 
-            return payload
-        except:
-            return None
+                received = decoder.feed(client_socket)
 
+                if self.trace.active:
+                    self.trace.switch(previous)
 
+                if received == 0:
+                    yield None
+                    return
+
+                self.heartbeats.seen(client_socket)
+
+            for frame in decoder.frames():
+                yield frameText(frame)
+        except Exception:
+            yield None
+
+
+    # Queue a reply and write what the socket accepts now
     def sendData(self, dest_socket, message: str) -> None:
-        header = len(message).to_bytes(self.HEADER_BYTES, byteorder="big")
-        data = message.encode("utf-8")
+        queue = self.outbound.get(dest_socket)
+
+        # Client was dropped by an earlier write
+        if queue is None:
+            return
+
+        queue.push(encodeFrame(message, self.HEADER_BYTES))
+
+        if dest_socket not in self.writers:
+            self.flushClient(dest_socket)
+
+
+    def flushClient(self, client_socket) -> None:
+        queue = self.outbound.get(client_socket)
+
+        # Client was dropped earlier in this pass
+        if queue is None:
+            return
+
+        try:
+            done = queue.flush(client_socket)
+        except OSError:
+            self.disconnectClient(client_socket)
+            return
+
+        if not done:
+            self.writers.add(client_socket)
+            return
+
+        self.writers.discard(client_socket)
+
+        # Backlog written: pick up the requests left buffered while the client was paused
+        if client_socket in self.paused:
+            self.paused.discard(client_socket)
+            self.handleCommands(client_socket, self.readMessages(client_socket, fill=False))
 
-        dest_socket.send(header + data)
+
+    def disconnectClient(self, client_socket) -> None:
+        if client_socket not in self.lobbyStates:
+            return
+
+        self.sockets.discard(client_socket)
+        self.connectedUsers.pop(client_socket, None)
+        del self.decoders[client_socket]
+        del self.outbound[client_socket]
+        del self.lobbyStates[client_socket]
+        self.writers.discard(client_socket)
+        self.paused.discard(client_socket)
+        self.timers.disarm(client_socket)
+        self.heartbeats.forget(client_socket)
+        client_socket.close()
 
 
     # Client requests to see all the open chatrooms
     def listChatRooms(self, client_socket):
-        try:
-            self.sendData(client_socket, "ACK")
+        self.sendData(client_socket, "ACK")
 
-            # Send back number of chatrooms
-            numRooms = len(self.openRooms)
-            self.sendData(client_socket, str(numRooms))
+        # Send back number of chatrooms, then wait for the client's ACK
+        numRooms = len(self.openRooms)
+        self.sendData(client_socket, str(numRooms))
 
-            response = self.getData(client_socket)
+        self.expect(client_socket, LobbyState.LIST_ACK)
 
-            assert(response == "ACK")
 
-            # Iterate through room names and send to client
-            for roomName in self.openRooms.keys():
-                self.sendData(client_socket, roomName)
-        except:
-            print("<Send chat room list failed>")
+    def finishListRooms(self, client_socket, response: str):
+        self.idle(client_socket)
+
+        if response != "ACK":
+            console.info("<Send chat room list failed>", "client")
+            return
+
+        # Iterate through room names and send to client
+        for roomName in self.openRooms.keys():
+            self.sendData(client_socket, roomName)
 
 
     # Client requests entry to room: get room name and send back port
     def sendPort(self, client_socket):
-        try:
-            self.sendData(client_socket, "ACK")
+        self.sendData(client_socket, "ACK")
+        self.expect(client_socket, LobbyState.GET_ROOM_NAME)
 
-            roomName = self.getData(client_socket)
 
-            # If room name found, send back the port
-            if self.openRooms.get(roomName):
-                self.sendData(client_socket, str(self.openRooms[roomName].PORT))
-            else:
-                self.sendData(client_socket, "NACK")
-        except:
-            print("<Send port to client failed>")
+    def finishSendPort(self, client_socket, roomName: str):
+        self.idle(client_socket)
+
+        # If room name found, send back the port
+        if self.openRooms.get(roomName):
+            self.sendData(client_socket, str(self.openRooms[roomName].PORT))
+        else:
+            self.sendData(client_socket, "NACK")
 
 
     def openChatRoom(self, client_socket):
-        try:
-            # Check if we have reached limit num of rooms
-            if len(self.openRooms) < self.MAX_ROOMS:
-                self.sendData(client_socket, "ACK")
-            else:
-                self.sendData(client_socket, "NACK")
-                return
+        # Check if we have reached limit num of rooms
+        if len(self.openRooms) < self.MAX_ROOMS:
+            self.sendData(client_socket, "ACK")
+            self.expect(client_socket, LobbyState.CREATE_ROOM_NAME)
+        else:
+            self.sendData(client_socket, "NACK")
 
-            name = self.getData(client_socket)
 
-            # If name valid, start room in next port and send port num to client
-            if name not in self.openRooms.keys():
-                port = self.SERVER_PORT + len(self.openRooms) + 1
+    def finishOpenChatRoom(self, client_socket, name: str):
+        self.idle(client_socket)
 
+        # If name valid, start room in next port and send port num to client
+        if name and not name.startswith(CONTROL_PREFIX) and name not in self.openRooms.keys():
+            port = self.nextRoomPort
+            self.nextRoomPort += 1
+
+            try:
                 chat = ChatRoom(port, name)
-                t1 = threading.Thread(target=chat.startChat)
+            except OSError:
+                self.sendData(client_socket, "NACK")
+                return
 
-                # Append to list of chat rooms
-                self.openRooms[name] = chat
+            t1 = threading.Thread(target=chat.startChat, name=f"room {name}")
 
-                t1.start()            
+            # Append to list of chat rooms
+            self.openRooms[name] = chat
 
-                self.sendData(client_socket, str(port))
-            else:
-                self.sendData(client_socket, "NACK")
-        except:
-            pass
+            t1.start()            
+
+            self.sendData(client_socket, str(port))
+        else:
+            self.sendData(client_socket, "NACK")
 
 
 
@@ -185,25 +622,68 @@ class ChatRoom(Base):
     def __init__(self, port: int, name: str):
         super().__init__()
         
-        # List of client sockets connected to the chat room
-        self.socketList = []
+        # Set of client sockets connected to the chat room (O(1) removal when clients leave)
+        self.sockets = set()
 
-        # List of previous messages (limit of 10)
+        # List of previous messages (limit of ROOM_CACHE_MESSAGES), the newest having sequence number lastSeq
         self.msgCache = []
+        self.lastSeq = 0
 
         # Dictionary of connected sockets -> usernames
         self.clientDict = {}
 
+        # Dictionary of connected sockets -> FrameDecoder receive buffers
+        self.decoders = {}
+
+        # Dictionary of connected sockets -> OutboundQueue of frames not yet written
+        self.outbound = {}
+
+        # Sockets with queued frames, polled for writability
+        self.writers = set()
+
+        # Sockets with frames queued during this pass of the loop
+        self.dirty = set()
+
+        # Join/leave announcements batched over PRESENCE_WINDOW
+        self.presence = PresenceWindow()
+
+        # Sockets still sending their username and JOIN_ROOM -> LobbyState, with their
+        # usernames and deadlines; they only become members once the handshake is done
+        self.handshakes = {}
+        self.pendingUsers = {}
+        self.timers = StepTimers()
+
+        # Pings for members that have gone quiet, so half-open connections stop receiving broadcasts
+        self.heartbeats = Heartbeats(self.HEARTBEAT_INTERVAL, self.HEARTBEAT_TIMEOUT)
+        self.PING_FRAME = encodeFrame(self.PING_TEXT, self.HEADER_BYTES)
+
+        # Resumable sessions: open sessions by token, the member socket holding each one, sockets
+        # that get "<seq> <message>" frames, and the RESUME_ROOM arguments of sockets still in the handshake
+        self.sessions = SessionTable(self.RESUME_WINDOW)
+        self.socketSessions = {}
+        self.sequenced = set()
+        self.pendingResumes = {}
+
+        # Flood control: limits per member socket and for the whole room, members left unread
+        # until they are back under them (socket -> monotonic time to resume), and how often that happened
+        self.limits = {}
+        self.roomLimit = FloodLimit(self.ROOM_MESSAGE_RATE, self.ROOM_MESSAGE_BURST, self.ROOM_BYTE_RATE, self.ROOM_BYTE_BURST, time.monotonic())
+        self.throttled = {}
+        self.throttles = 0
+
         # Initialize attributes
         self.PORT = port
         self.NAME = name
 
+        # Phase timing of each loop pass while profiling
+        self.trace = profiler.loopTrace(f"room {name}")
+
         # Init socket object for internet interface
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.bind((self.SERVER_IP, self.PORT))
 
         # Add our server socket to the socket list
-        self.socketList.append(self.server)
+        self.sockets.add(self.server)
 
     
     def __del__(self):
@@ -211,7 +691,7 @@ class ChatRoom(Base):
 
 
     def startChat(self):
-        print(f"<Welcome to the {self.NAME} Room!>")
+        console.info(f"<Welcome to the {self.NAME} Room!>", "room")
 
         # Listen for messages and connections
         self.server.listen()
@@ -220,126 +700,502 @@ class ChatRoom(Base):
 
 
     def chatMain(self):
+        trace = self.trace
+
         while True:
-            # OS level polling for activity on the listed sockets (listens for data packet on sockets)
-            active_sockets, _, _ = select.select(self.socketList, [], self.socketList)
+            # OS level polling for activity on the listed sockets, waking up for the next handshake
+            # deadline, heartbeat, session expiry, throttled member or the end of the presence window
+            timeout = self.sessions.wait(self.heartbeats.wait(self.timers.wait()))
+            if self.presence.due is not None:
+                due = max(0.0, self.presence.due - time.monotonic())
+                timeout = due if timeout is None else min(timeout, due)
+
+            read_sockets = self.sockets
+            if self.throttled:
+                read_sockets = [sock for sock in self.sockets if sock not in self.throttled]
+                due = max(0.0, min(self.throttled.values()) - time.monotonic())
+                timeout = due if timeout is None else min(timeout, due)
+
+            trace.begin()
+            active_sockets, writable_sockets, _ = select.select(read_sockets, list(self.writers), [], timeout)
+
+            # Continue writing queued frames to clients that can take more
+            if trace.active:
+                trace.switch(PHASE_WRITE)
+
+            for writable_socket in writable_sockets:
+                self.flushClient(writable_socket)
+
+            if trace.active:
+                trace.switch(PHASE_DECODE)
 
             # Iterate over sockets where activity has been found
             for active_socket in active_sockets:
 
                 # If activity on server socket, a new client is connecting
                 if active_socket == self.server:
-                    # accept connection from a client socket
-                    client_socket, _ = self.server.accept()
+                    self.acceptClient()
 
-                    # Call method to get username
-                    username = self.getData(client_socket)
+                # Client still completing its handshake
+                elif active_socket in self.handshakes:
+                    self.handleHandshake(active_socket, self.readMessages(active_socket))
 
-                    if username is None:
-                        continue
+                # If activity is from a client socket, get data and broadcast to other clients
+                elif active_socket in self.clientDict:
+                    self.handleMessages(active_socket, self.readMessages(active_socket))
 
-                    # Welcome message for the new client
-                    self.sendData(client_socket, f"<Welcome to the {self.NAME} Room!>")
+            if trace.active:
+                trace.switch(PHASE_OTHER)
 
-                    # Send notif to new client of how many users in the chat
-                    notif = self.chatUsersNotif()
-                    self.sendData(client_socket, notif)
+            # Announce the joins and leaves counted while the presence window was open
+            if self.presence.due is not None and time.monotonic() >= self.presence.due:
+                self.announcePresence()
 
-                    # Send previous 5 messages to new client
-                    for msg in self.msgCache[-5:]:
-                        self.sendData(client_socket, msg)
+            self.resumeThrottled()
+            self.checkHeartbeats()
 
-                    # Append to socket list and enter in clientDict
-                    self.socketList.append(client_socket)
-                    self.clientDict[client_socket] = username
+            # Users whose sessions were not resumed in time are announced as gone
+            for session in self.sessions.expired():
+                self.notePresence(session.USERNAME, None, False)
 
-                    # Broadcast notification to other clients in room
-                    notif = f"<{username} has entered the chat! ({len(self.socketList) - 1} users online)>"
+            # Everything queued for a socket in this pass goes out in one gathered write
+            dirty_sockets = self.dirty
+            self.dirty = set()
 
-                    print(notif)
-                    self.broadcast(client_socket, notif)
+            if trace.active:
+                trace.switch(PHASE_WRITE)
 
-                # If activity is from a client socket, get data and broadcast to other clients
-                else:
-                    message = self.getData(active_socket)
+            for dirty_socket in dirty_sockets:
+                self.flushClient(dirty_socket)
 
-                    # If no message, the client has disconnected
-                    if not message or message == self.DISCON_MSG:
-                        self.disconnectClient(active_socket)
-                        continue
+            if trace.active:
+                trace.switch(PHASE_OTHER)
 
-                    # Get username of the message sender
-                    sender = self.clientDict[active_socket]
+            # Settings reloaded by the lobby since this room last looked
+            if self.configGeneration != configFile.generation:
+                self.reloadConfig()
 
-                    msg_prefix = f"<{sender}> "
+            # Drop clients that did not finish the handshake in time. One that has sent nothing after
+            # its username never meant to send JOIN_ROOM, and is admitted as a plain member.
+            for client_socket in self.timers.expired():
+                if self.handshakes.get(client_socket) == LobbyState.JOIN_ROOM:
+                    self.admitClient(client_socket)
+                elif client_socket in self.handshakes:
+                    console.info(f"<Room client timed out in {self.handshakes[client_socket].value} step>", "client")
+                    self.dropHandshake(client_socket)
 
-                    # Data to send clients
-                    print(msg_prefix + message)
-                    msg_data = (msg_prefix + message)
+            trace.end()
 
-                    # Store message in cache
-                    if len(self.msgCache) >= 10:
-                        self.msgCache.pop(0)
-                    self.msgCache.append(msg_data)
 
-                    # Broadcast message
-                    self.broadcast(active_socket, msg_data)
+    # Apply the document the lobby adopted on SIGHUP, and carry the changes over to the members
+    def reloadConfig(self) -> None:
+        self.configGeneration = configFile.generation
+        changed = set(applySettings(self, [setting for setting in SERVER_SETTINGS if setting.RELOADABLE], configFile.load(), self.configDefaults))
 
+        if changed & {"HIGH_WATERMARK", "LOW_WATERMARK", "SLOW_CONSUMER_POLICY"}:
+            for queue in self.outbound.values():
+                queue.HIGH_WATERMARK = self.HIGH_WATERMARK
+                queue.LOW_WATERMARK = self.LOW_WATERMARK
+                queue.POLICY = self.SLOW_CONSUMER_POLICY
 
-    def getData(self, client_socket) -> str:
-        try:
-            # Read header packet which gives length of payload
-            msg_header = client_socket.recv(self.HEADER_BYTES)
-            msg_len = int.from_bytes(msg_header, byteorder="big")
-            
-            # Read message payload from client
-            payload = client_socket.recv(msg_len).decode("utf-8")
-
-            return payload
-        except Exception as e:
-            # Check if error resulted from disconnection:
-            if "10054" in str(e):
+        # Flood limits start over at the new rates; debts run up so far are forgiven
+        if any(name.startswith(("CLIENT_", "ROOM_MESSAGE", "ROOM_BYTE")) for name in changed):
+            self.limits = {}
+            self.roomLimit = FloodLimit(self.ROOM_MESSAGE_RATE, self.ROOM_MESSAGE_BURST, self.ROOM_BYTE_RATE, self.ROOM_BYTE_BURST, time.monotonic())
+
+        if "ROOM_CACHE_MESSAGES" in changed:
+            del self.msgCache[:max(0, len(self.msgCache) - self.ROOM_CACHE_MESSAGES)]
+
+        if changed & {"HEARTBEAT_INTERVAL", "HEARTBEAT_TIMEOUT"}:
+            self.heartbeats.INTERVAL = self.HEARTBEAT_INTERVAL
+            self.heartbeats.TIMEOUT = self.HEARTBEAT_TIMEOUT
+
+            for client_socket in self.clientDict:
+                self.heartbeats.forget(client_socket)
+                self.heartbeats.watch(client_socket)
+
+        self.sessions.WINDOW = self.RESUME_WINDOW
+
+
+    # Ping members that have gone quiet and drop the ones that never answered
+    def checkHeartbeats(self) -> None:
+        ping_sockets, dead_sockets = self.heartbeats.expired()
+
+        for client_socket in dead_sockets:
+            console.info(f"<{self.clientDict.get(client_socket)} stopped answering in {self.NAME}>", "client")
+            self.disconnectClient(client_socket)
+
+        # Pings are never sequenced
+        for client_socket in ping_sockets:
+            if not self.queueFrame(client_socket, self.PING_FRAME):
                 self.disconnectClient(client_socket)
+
+
+    def acceptClient(self) -> None:
+        try:
+            client_socket, _ = self.server.accept()
+        except BlockingIOError:
+            return
+
+        # The room never blocks on this client, not even for the username
+        client_socket.setblocking(False)
+        self.decoders[client_socket] = FrameDecoder(self.HEADER_BYTES)
+        self.handshakes[client_socket] = LobbyState.HANDSHAKE
+        self.timers.arm(client_socket, self.HANDSHAKE_TIMEOUT)
+        self.sockets.add(client_socket)
+
+
+    # Username, then JOIN_ROOM (or RESUME_ROOM and its arguments) and the room name (discarded:
+    # the room is implied by the port)
+    def handleHandshake(self, client_socket, messages) -> None:
+        for message in messages:
+            if not message or message == self.DISCON_MSG:
+                self.dropHandshake(client_socket)
+                return
+
+            state = self.handshakes[client_socket]
+
+            if state == LobbyState.HANDSHAKE:
+                self.pendingUsers[client_socket] = message
+                self.handshakes[client_socket] = LobbyState.JOIN_ROOM
+                self.timers.arm(client_socket, self.STEP_TIMEOUT)
+            elif state == LobbyState.JOIN_ROOM and message == self.CMD_JOIN_ROOM:
+                self.handshakes[client_socket] = LobbyState.JOIN_ROOM_NAME
+                self.timers.arm(client_socket, self.STEP_TIMEOUT)
+            elif state == LobbyState.JOIN_ROOM and message.startswith(self.CMD_RESUME_ROOM + " "):
+                try:
+                    token, last_seq = message[len(self.CMD_RESUME_ROOM) + 1:].split(" ")
+                    self.pendingResumes[client_socket] = (token if token != "-" else None, int(last_seq))
+                except ValueError:
+                    self.dropHandshake(client_socket)
+                    return
+
+                self.handshakes[client_socket] = LobbyState.JOIN_ROOM_NAME
+                self.timers.arm(client_socket, self.STEP_TIMEOUT)
             else:
-                print("Data receive failed: " + str(e))
-            
-            return None
+                # Clients that skip JOIN_ROOM are admitted with this as their first chat message
+                self.admitClient(client_socket)
+
+                if state == LobbyState.JOIN_ROOM:
+                    self.handleMessages(client_socket, [message])
+
+                # Messages may have arrived in the same read as the handshake
+                if client_socket in self.clientDict:
+                    self.handleMessages(client_socket, self.readMessages(client_socket, fill=False))
+                return
+
+
+    def dropHandshake(self, client_socket) -> None:
+        self.sockets.discard(client_socket)
+        del self.handshakes[client_socket]
+        del self.decoders[client_socket]
+        self.pendingUsers.pop(client_socket, None)
+        self.pendingResumes.pop(client_socket, None)
+        self.timers.disarm(client_socket)
+        client_socket.close()
+
+
+    def admitClient(self, client_socket) -> None:
+        username = self.pendingUsers.pop(client_socket)
+        del self.handshakes[client_socket]
+        self.timers.disarm(client_socket)
+
+        self.outbound[client_socket] = OutboundQueue(self.HIGH_WATERMARK, self.LOW_WATERMARK, self.SLOW_CONSUMER_POLICY, self.HEADER_BYTES)
+
+        # Who is in the room, for the welcome, before the new client counts
+        notif = self.chatUsersNotif()
+
+        # Enter in clientDict (the socket is already polled) before anything is queued, so a
+        # client whose first writes fail is dropped like any other member
+        self.clientDict[client_socket] = username
+        self.heartbeats.watch(client_socket)
+
+        # Sequenced client: "0 RESUMED <token>" and only the missed messages if its session is
+        # still open, otherwise "0 SESSION <token>" before the usual welcome
+        resume = self.pendingResumes.pop(client_socket, None)
+        after_seq = self.lastSeq - self.JOIN_BACKFILL_MESSAGES
+
+        if resume is not None:
+            self.sequenced.add(client_socket)
+            self.outbound[client_socket].sequenceNotices()
+            token, last_seq = resume
+            session = self.sessions.find(token, self.NAME, username) if token else None
+
+            if session is not None:
+                self.resumeSession(client_socket, session, last_seq)
+                return
+
+            session = self.sessions.open(self.NAME, username, client_socket)
+            self.socketSessions[client_socket] = session
+            self.sendData(client_socket, f"SESSION {session.TOKEN}")
+
+            if last_seq > 0:
+                after_seq = last_seq
+
+        # Welcome message for the new client
+        self.sendData(client_socket, f"<Welcome to the {self.NAME} Room!>")
+
+        # Send notif to new client of how many users in the chat
+        self.sendData(client_socket, notif)
+
+        # Send previous 5 messages (or every one since the last it saw) to new client
+        self.replay(client_socket, after_seq)
+
+        # Notify the other clients in the room, unless the new client has already been dropped
+        if client_socket in self.clientDict:
+            self.notePresence(username, client_socket, True)
+
+
+    # Resumed session: the user never left as far as the room is concerned
+    def resumeSession(self, client_socket, session, after_seq: int) -> None:
+        # Still held by an older socket the room has not noticed is gone (typically half-open)
+        old_socket = session.conn
+
+        if old_socket is not None:
+            del self.socketSessions[old_socket]
+            self.disconnectClient(old_socket, announce=False)
+
+        self.sessions.attach(session, client_socket)
+        self.socketSessions[client_socket] = session
+
+        self.sendData(client_socket, f"RESUMED {session.TOKEN}")
+        self.replay(client_socket, after_seq)
+
+
+    # Send the cached messages after after_seq, each with its sequence number
+    def replay(self, client_socket, after_seq: int) -> None:
+        first_seq, messages = cachedSince(self.msgCache, self.lastSeq, after_seq, self.RESUME_MAX_MESSAGES)
+
+        for offset, msg in enumerate(messages):
+            self.sendData(client_socket, msg, first_seq + offset)
+
+
+    def handleMessages(self, client_socket, messages) -> None:
+        for message in messages:
+            # If no message, the client has disconnected (on purpose, unless the connection was
+            # lost, so its session ends)
+            if not message or message == self.DISCON_MSG:
+                session = self.socketSessions.pop(client_socket, None) if message is not None else None
+
+                if session is not None:
+                    self.sessions.close(session)
+
+                self.disconnectClient(client_socket)
+                break
+
+            # Answer to a heartbeat, not chat
+            if message == self.PONG_TEXT:
+                continue
+
+            # Get username of the message sender
+            sender = self.clientDict[client_socket]
+
+            msg_prefix = f"<{sender}> "
+
+            # Data to send clients
+            console.message(msg_prefix + message)
+            msg_data = (msg_prefix + message)
+
+            # Store message in cache
+            if len(self.msgCache) >= self.ROOM_CACHE_MESSAGES:
+                self.msgCache.pop(0)
+            self.msgCache.append(msg_data)
+            self.lastSeq += 1
+
+            # Broadcast message
+            self.broadcast(client_socket, msg_data, self.lastSeq)
+
+            # Leave the rest of the messages unread until the client is back under its limits
+            wait = self.chargeMessage(client_socket, len(msg_data))
+
+            if wait:
+                self.throttle(client_socket, wait)
+                break
+
+
+    # Charge a message to its sender's and the room's flood limits; returns how long the sender must wait
+    def chargeMessage(self, client_socket, size: int) -> float:
+        now = time.monotonic()
+        limit = self.limits.get(client_socket)
+
+        if limit is None:
+            limit = self.limits[client_socket] = FloodLimit(self.CLIENT_MESSAGE_RATE, self.CLIENT_MESSAGE_BURST, self.CLIENT_BYTE_RATE, self.CLIENT_BYTE_BURST, now)
+
+        return max(limit.charge(size, now), self.roomLimit.charge(size, now))
+
+
+    # What the client sends meanwhile stays in the kernel's buffers, so TCP slows it down
+    def throttle(self, client_socket, wait: float) -> None:
+        self.throttled[client_socket] = time.monotonic() + wait
+        self.throttles += 1
+        console.info(f"<{self.clientDict[client_socket]} throttled for {wait:.2f}s in {self.NAME} ({self.throttles} throttles)>", "flood")
+
+
+    # Read from throttled members again once their wait is over, starting with what is buffered
+    def resumeThrottled(self) -> None:
+        now = time.monotonic()
+
+        for client_socket in [sock for sock, due in self.throttled.items() if due <= now]:
+            del self.throttled[client_socket]
+
+            if client_socket in self.clientDict:
+                self.handleMessages(client_socket, self.readMessages(client_socket, fill=False))
+
+
+    # Read what is available on a readable socket and yield each complete message (None on disconnect)
+    def readMessages(self, client_socket, fill: bool = True):
+        decoder = self.decoders[client_socket]
+
+        try:
+            if fill:
+                if self.trace.active:
+                    previous = self.trace.switch(PHASE_READ)
+
+                received = decoder.feed(client_socket)
+
+                if self.trace.active:
+                    self.trace.switch(previous)
+
+                if received == 0:
+                    yield None
+                    return
+
+                self.heartbeats.seen(client_socket)
+
+            for frame in decoder.frames():
+                yield frameText(frame)
+        except OSError:
+            # Reset or otherwise broken connection: the client is gone
+            yield None
+        except Exception as e:
+            console.info("Data receive failed: " + str(e), "client")
+            yield None
 
     
-    def sendData(self, dest_socket, message: str) -> None:
-        header = len(message).to_bytes(self.HEADER_BYTES, byteorder="big")
-        data = message.encode('utf-8')
+    # Notices go out with sequence number 0
+    def sendData(self, dest_socket, message: str, seq: int = 0) -> None:
+        if dest_socket in self.sequenced:
+            message = f"{seq} {message}"
+
+        if not self.queueFrame(dest_socket, encodeFrame(message, self.HEADER_BYTES)):
+            self.disconnectClient(dest_socket)
+
 
-        dest_socket.send(header + data)
+    def broadcast(self, sender_socket, message: str, seq: int = 0) -> None:
+        if self.trace.active:
+            previous = self.trace.switch(PHASE_FANOUT)
 
+        frame = encodeFrame(message, self.HEADER_BYTES)
+        seq_frame = encodeFrame(f"{seq} {message}", self.HEADER_BYTES) if self.sequenced else None
 
-    def broadcast(self, sender_socket, message: str) -> None:
-        header = len(message).to_bytes(self.HEADER_BYTES, byteorder="big")
-        data = message.encode('utf-8')
+        # Queue the frame for every member; clients that have fallen too far behind are dropped afterwards
+        slow_sockets = [
+            sock for sock in self.clientDict
+            if sock != sender_socket and not self.queueFrame(sock, seq_frame if sock in self.sequenced else frame)
+        ]
 
-        for sock in self.socketList:
-            if sock != self.server and sock != sender_socket:
-                sock.send(header + data)
+        if self.trace.active:
+            self.trace.switch(previous)
+
+        for sock in slow_sockets:
+            self.disconnectClient(sock)
+
+
+    # Queue a frame for a client and write what the socket accepts now. Returns False if the client must be dropped.
+    def queueFrame(self, dest_socket, frame: bytes) -> bool:
+        queue = self.outbound.get(dest_socket)
+
+        # Client was dropped earlier in this pass
+        if queue is None or not queue.push(frame):
+            return False
+
+        # Already waiting on writability, so the frame goes out with the rest of the backlog
+        if dest_socket in self.writers:
+            return True
+
+        if self.COALESCE_WRITES:
+            self.dirty.add(dest_socket)
+            return True
+
+        try:
+            if not queue.flush(dest_socket):
+                self.writers.add(dest_socket)
+        except OSError:
+            return False
+
+        return True
+
+
+    def flushClient(self, client_socket) -> None:
+        queue = self.outbound.get(client_socket)
+
+        # Client was dropped earlier in this pass
+        if queue is None:
+            return
+
+        try:
+            done = queue.flush(client_socket)
+        except OSError:
+            self.disconnectClient(client_socket)
+            return
+
+        if done:
+            self.writers.discard(client_socket)
+        else:
+            self.writers.add(client_socket)
 
     
-    def disconnectClient(self, exit_socket) -> None:
+    # A client dropped while holding a session keeps its place for RESUME_WINDOW, and is only
+    # announced as gone if the session expires
+    def disconnectClient(self, exit_socket, announce: bool = True) -> None:
         # If socket has already been removed then exit
-        if exit_socket not in self.socketList:
+        if exit_socket not in self.sockets:
             return
 
-        self.socketList.remove(exit_socket)
-        user = self.clientDict[exit_socket]
-        del self.clientDict[exit_socket]
+        self.sockets.discard(exit_socket)
+        user = self.clientDict.pop(exit_socket, None)
+        self.decoders.pop(exit_socket, None)
+        self.outbound.pop(exit_socket, None)
+        self.writers.discard(exit_socket)
+        self.dirty.discard(exit_socket)
+        self.heartbeats.forget(exit_socket)
+        self.limits.pop(exit_socket, None)
+        self.throttled.pop(exit_socket, None)
+        self.sequenced.discard(exit_socket)
+        exit_socket.close()
+
+        session = self.socketSessions.pop(exit_socket, None)
+
+        if session is not None:
+            self.sessions.detach(session)
+        elif announce and user is not None:
+            self.notePresence(user, exit_socket, False)
+
 
-        notif = f"<{user} has disconnected ({len(self.socketList) - 1} users online)>"
+    # Announce a join or leave now, or count it into the open presence window
+    def notePresence(self, username: str, client_socket, joined: bool) -> None:
+        if self.presence.note(username, client_socket, joined):
+            self.announcePresence()
+
+
+    # Broadcast what has been counted and open a new window; with nothing counted the window closes
+    def announcePresence(self) -> None:
+        notif, skip_socket = self.presence.take(len(self.clientDict))
+
+        if notif is None:
+            self.presence.due = None
+            return
 
-        print(notif)
-        self.broadcast(exit_socket, notif)
+        console.info(notif, "presence")
+        self.broadcast(skip_socket, notif)
+        self.presence.due = time.monotonic() + self.PRESENCE_WINDOW
 
     
     def chatUsersNotif(self) -> str:
-        numUsers = len(self.clientDict.values())
-        users = [user for user in self.clientDict.values()]
+        numUsers = len(self.clientDict)
+
+        # At most three names are shown, so only those are looked at
+        users = list(islice(self.clientDict.values(), 3))
 
         if numUsers == 0:
             return "<You are the only user in the room!>"
@@ -353,8 +1209,83 @@ class ChatRoom(Base):
             return f"<{users[0]}, {users[1]} and {numUsers - 2} others are in the room!>"
 
 
+# PROFILE [on|off] from a lobby client: the profiler's state after the change, or None
+# for a client that is not on the server's host or an unknown argument
+def profileCommand(client_socket, action: str):
+    try:
+        host = client_socket.getpeername()[0]
+    except OSError:
+        return None
+
+    if not ipaddress.ip_address(host).is_loopback or action not in ("", "on", "off"):
+        return None
+
+    if action == "on":
+        profiler.start()
+    elif action == "off":
+        profiler.stop()
+
+    return profiler.status()
+
+
+# Write out the queued console log before exiting on SIGTERM (room threads would keep sys.exit waiting)
+def terminate(signum, frame):
+    console.close()
+    os._exit(0)
+
+
 # Starting the chat server
-chat = MainServer()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sudoChat server")
+    parser.add_argument("--loop", action="store_true", help="host the lobby and every room on one event loop")
+    parser.add_argument("--workers", type=int, default=0, help="spread rooms over this many worker processes")
+    parser.add_argument("--log-dir", default=None, help="directory for room message logs (empty string disables them)")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve Prometheus metrics on this localhost port (loop and worker modes)")
+    parser.add_argument("--upgrade-socket", default=None, help="Unix socket path a successor process connects to for a live upgrade (loop mode)")
+    parser.add_argument("--takeover", action="store_true", help="take over the sockets and rooms of the server on --upgrade-socket")
+    parser.add_argument("--port", type=int, default=None, help="port to serve on (loop mode)")
+    parser.add_argument("--node", default=None, help="name of this node in a federation of loop servers")
+    parser.add_argument("--peer", action="append", default=None, metavar="HOST:PORT", help="another node of the federation (repeat for each)")
+    parser.add_argument("--tls-cert", default=None, help="PEM certificate chain: accept TLS clients as well as plaintext ones (loop and worker modes)")
+    parser.add_argument("--tls-key", default=None, help="PEM private key for --tls-cert, unless the chain file holds it")
+    args = parser.parse_args()
+
+    if (args.upgrade_socket or args.takeover) and not args.loop:
+        parser.error("live upgrades need --loop")
+
+    if args.takeover and not args.upgrade_socket:
+        parser.error("--takeover needs --upgrade-socket")
+
+    if (args.port is not None or args.node or args.peer) and not args.loop:
+        parser.error("--port, --node and --peer need --loop")
+
+    if args.peer and not args.node:
+        parser.error("--peer needs --node")
+
+    if (args.tls_cert or args.tls_key) and not (args.loop or args.workers > 0):
+        parser.error("--tls-cert and --tls-key need --loop or --workers")
+
+    if args.tls_key and not args.tls_cert:
+        parser.error("--tls-key needs --tls-cert")
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGUSR2, toggleProfiling)
+
+    if args.workers > 0:
+        from shard import ShardedServer
+
+        chat = ShardedServer(args.workers, log_dir=args.log_dir, metrics_port=args.metrics_port, tls_cert=args.tls_cert, tls_key=args.tls_key)
+        chat.watchReloads()
+        chat.serverMain()
+    elif args.loop:
+        from reactor import LoopServer
+
+        chat = LoopServer(args.port, log_dir=args.log_dir, metrics_port=args.metrics_port, upgrade_socket=args.upgrade_socket, takeover=args.takeover,
+                          node=args.node, peers=args.peer, tls_cert=args.tls_cert, tls_key=args.tls_key)
+        chat.watchReloads()
+        chat.serverMain()
+    else:
+        chat = MainServer()
 
 
 
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+
+import bisect
+import hashlib
+import multiprocessing
+import os
+import signal
+import sys
+
+from console import console
+from msglog import MessageLog, roomLogDir
+from profiler import toggleProfiling
+from protocol import RequestError
+from reactor import LoopServer
+
+
+# Consistent hash ring mapping room names onto worker indexes.
+# Each worker owns many points on the ring so rooms spread evenly.
+class HashRing:
+    def __init__(self, nodes: int, replicas: int = 64):
+        ring = sorted((self.hashKey(f"worker-{node}-{replica}"), node) for node in range(nodes) for replica in range(replicas))
+
+        # Sorted ring positions and the worker that owns each one
+        self.points = [point for point, _ in ring]
+        self.owners = [node for _, node in ring]
+
+
+    @staticmethod
+    def hashKey(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), byteorder="big")
+
+
+    # Worker owning the first ring point at or after the key's hash
+    def nodeFor(self, key: str) -> int:
+        index = bisect.bisect(self.points, self.hashKey(key)) % len(self.points)
+
+        return self.owners[index]
+
+
+
+# Lobby entry for a room hosted by a worker process
+class RemoteRoom:
+    __slots__ = ("NAME", "PORT")
+
+    def __init__(self, name: str, port: int):
+        self.NAME = name
+        self.PORT = port
+
+
+
+# Loop server in a worker process, hosting the rooms routed to it
+class RoomWorker(LoopServer):
+    # The main room is created like any other, by the first join routed here
+    HOSTS_MAIN_ROOM = False
+
+    def __init__(self, port: int, parent_pid: int, log_dir: str, metrics_port: int = None, tls_cert: str = None, tls_key: str = None):
+        super().__init__(port, log_dir, metrics_port, tls_cert=tls_cert, tls_key=tls_key)
+        self.PARENT_PID = parent_pid
+
+        # Rooms are created on the first JOIN_ROOM the control plane routes here
+        self.CREATE_ON_JOIN = True
+
+        # Wake up regularly to notice the control plane going away
+        self.TICK_SECONDS = 1.0
+
+
+    def onTick(self) -> None:
+        if os.getppid() != self.PARENT_PID:
+            console.info(f"<Room worker on port {self.SERVER_PORT} lost its control plane, exiting>")
+            sys.exit(0)
+
+
+
+def runWorker(port: int, parent_pid: int, log_dir: str, metrics_port: int = None, tls_cert: str = None, tls_key: str = None) -> None:
+    worker = RoomWorker(port, parent_pid, log_dir, metrics_port, tls_cert, tls_key)
+
+    # The control plane passes SIGHUP on to reload the worker's config too, and SIGUSR2 to toggle profiling
+    worker.watchReloads()
+    signal.signal(signal.SIGUSR2, toggleProfiling)
+    worker.serverMain()
+
+
+
+# Control plane: serves the lobby on the server port and places every room on one of
+# N worker processes, so room fan-out runs on as many cores as there are workers
+class ShardedServer(LoopServer):
+    def __init__(self, workers: int, log_dir: str = None, metrics_port: int = None, tls_cert: str = None, tls_key: str = None):
+        self.ring = HashRing(workers)
+
+        # Read-only views of the room logs the workers write, opened on the first HISTORY request
+        self.logReaders = {}
+
+        # Worker processes by index; worker i listens on SERVER_PORT + 1 + i
+        self.workers = [None] * workers
+        self.context = multiprocessing.get_context("spawn")
+
+        super().__init__(log_dir=log_dir, metrics_port=metrics_port, tls_cert=tls_cert, tls_key=tls_key)
+
+        # Wake up regularly to supervise the workers
+        self.TICK_SECONDS = 1.0
+
+        # Room traffic never reaches the control plane
+        del self.lobbyCommands[self.CMD_JOIN_ROOM.encode("utf-8")]
+        del self.lobbyArgCommands[self.CMD_RESUME_ROOM.encode("utf-8")]
+
+        # Exit normally on SIGTERM so the daemon workers are terminated with us
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        for node in range(workers):
+            self.startWorker(node)
+
+
+    def workerPort(self, node: int) -> int:
+        return self.SERVER_PORT + 1 + node
+
+
+    # Each worker serves metrics for its own rooms on the ports after the control plane's
+    def workerMetricsPort(self, node: int):
+        return self.METRICS_PORT + 1 + node if self.METRICS_PORT else None
+
+
+    # History is read from the logs the workers write
+    def roomLog(self, roomName: str):
+        if not self.LOG_DIR or roomName not in self.openRooms:
+            return None
+
+        if roomName not in self.logReaders:
+            self.logReaders[roomName] = MessageLog(roomLogDir(self.LOG_DIR, roomName), self.SEGMENT_BYTES, readonly=True)
+
+        return self.logReaders[roomName]
+
+
+    # Multiplexed clients subscribe to rooms on the worker hosting them
+    def requestJoin(self, conn, request_id: int, fields: list):
+        raise RequestError("Rooms are hosted on worker ports; JOIN there after GET_ROOM")
+
+
+    # Rooms are only names here; the worker creates the room state on the first join
+    def createRoom(self, name: str):
+        return RemoteRoom(name, self.workerPort(self.ring.nodeFor(name)))
+
+
+    def startWorker(self, node: int) -> None:
+        # Workers serve TLS with the control plane's certificate, but seal their own session tickets
+        process = self.context.Process(target=runWorker, args=(self.workerPort(node), os.getpid(), self.LOG_DIR, self.workerMetricsPort(node),
+                                                                self.TLS_CERT_FILE, self.TLS_KEY_FILE), daemon=True)
+        process.start()
+
+        self.workers[node] = process
+        console.info(f"<Room worker {node} started on port {self.workerPort(node)} (pid {process.pid})>")
+
+
+    # SIGUSR2 toggles profiling here and in every worker, where the rooms run
+    def toggleProfiling(self) -> None:
+        super().toggleProfiling()
+
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signal.SIGUSR2)
+
+
+    # Workers read config.json for themselves
+    def reloadConfig(self) -> None:
+        super().reloadConfig()
+
+        for process in self.workers:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+
+
+    # Restart any worker that has died; it comes back on the same port so room routing is unchanged
+    def onTick(self) -> None:
+        for node, process in enumerate(self.workers):
+            if not process.is_alive():
+                console.info(f"<Room worker {node} exited with code {process.exitcode}, restarting>")
+                process.join()
+                self.startWorker(node)
@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+
+# Streamed transfers of large messages and attachments (see protocol.py).
+#
+# The server keeps none of a stream's payload itself: each chunk becomes one
+# STREAM_CHUNK frame shared by every recipient's bulk lane (outbound.py) and is
+# gone once they have all written it. The sender may have at most WINDOW bytes
+# that have not been credited back; credit goes back once every recipient's
+# bulk lane has drained below half a window, so a stream costs the server about
+# a window and a half however large it is, and a slow recipient slows the
+# sender down instead of growing a queue.
+
+from protocol import packU32
+
+
+class Stream:
+    __slots__ = ("STREAM_ID", "STREAM_FIELD", "ROOM", "SENDER", "NAME", "SIZE", "recipients", "received", "credit", "owed", "since")
+
+    def __init__(self, stream_id: int, room, sender, name: str, size: int, recipients: dict, window: int, now: float):
+        self.STREAM_ID = stream_id
+        self.STREAM_FIELD = packU32(stream_id)
+        self.ROOM = room
+        self.SENDER = sender
+
+        # File name, or "" for a long text message, and the size announced for it
+        self.NAME = name
+        self.SIZE = size
+
+        # Sockets -> connections of the room's v2 members when the stream opened
+        self.recipients = recipients
+
+        # Bytes received, bytes the sender may still send, and bytes received but not credited back yet
+        self.received = 0
+        self.credit = window
+        self.owed = 0
+
+        # Monotonic time credit was last returned (or the stream opened)
+        self.since = now
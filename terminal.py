@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+# Terminal output for the chat client. The listening thread only queues the lines
+# it receives; a render thread draws whatever has queued up at most once every
+# FRAME_SECONDS, each batch in a single write followed by the input prompt. A busy
+# room or a long backfill then costs one terminal write per frame instead of two
+# per message, so the client keeps up with its socket.
+#
+# Lines waiting to be drawn are capped at SCROLLBACK lines. When the terminal
+# falls further behind than that, the oldest are skipped and a notice says how
+# many, so the client's memory stays bounded however fast the room is.
+
+from collections import deque
+
+import sys
+import threading
+import time
+
+
+class Renderer:
+    def __init__(self, prompt: str, frame_seconds: float = 1 / 30, scrollback: int = 1000, stream=None):
+        self.PROMPT = prompt
+        self.FRAME_SECONDS = frame_seconds
+        self.SCROLLBACK = scrollback
+        self.stream = stream if stream is not None else sys.stdout
+
+        # Lines not drawn yet, and how many were pushed out of them undrawn
+        self.pending = deque(maxlen=scrollback)
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+        # Set when there is something to draw, or on close
+        self.ready = threading.Event()
+        self.closed = False
+
+        # Terminal writes made and lines skipped in all, for benchmarks
+        self.writes = 0
+        self.skippedLines = 0
+
+        self.thread = threading.Thread(target=self.renderLoop, daemon=True)
+        self.thread.start()
+
+
+    # Queue a line; safe to call from any thread
+    def show(self, line: str) -> None:
+        with self.lock:
+            if len(self.pending) == self.SCROLLBACK:
+                self.skipped += 1
+
+            self.pending.append(line)
+
+        self.ready.set()
+
+
+    def renderLoop(self) -> None:
+        while not self.closed:
+            self.ready.wait()
+            self.ready.clear()
+            self.draw()
+
+            # Let the next batch gather
+            time.sleep(self.FRAME_SECONDS)
+
+
+    def draw(self) -> None:
+        with self.lock:
+            lines = list(self.pending)
+            skipped = self.skipped
+            self.pending.clear()
+            self.skipped = 0
+
+        if not lines:
+            return
+
+        if skipped:
+            lines.insert(0, f"<{skipped} messages skipped>")
+            self.skippedLines += skipped
+
+        # Over the prompt left on the current line, then a fresh prompt
+        self.stream.write("\r" + "\n".join(lines) + "\n" + self.PROMPT)
+        self.stream.flush()
+        self.writes += 1
+
+
+    # Draw what is left and stop the render thread
+    def close(self) -> None:
+        self.closed = True
+        self.ready.set()
+
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+        self.draw()
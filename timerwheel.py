@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+
+# Hierarchical timer wheel and the connection heartbeats built on it.
+#
+# Time advances in ticks. Level 0 has one slot per tick; each higher level has
+# slots SLOTS times as wide and is cascaded down one level whenever the level
+# below wraps around. Scheduling and cancelling a timer are dict operations on
+# one slot, and a tick only visits the slot that is due (plus, every SLOTS
+# ticks, one slot of the level above), so the cost does not grow with the
+# number of connections being watched.
+
+import time
+
+
+class TimerWheel:
+    def __init__(self, tick: float = 1.0, slots: int = 64, levels: int = 4):
+        self.TICK = tick
+        self.SLOTS = slots
+        self.LEVELS = levels
+
+        # Per level: slots of key -> expiry tick
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+
+        # Key -> (level, slot) it sits in, so it can be cancelled in place
+        self.positions = {}
+
+        # Last tick processed
+        self.current = int(time.monotonic() / tick)
+
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+
+    def __contains__(self, key) -> bool:
+        return key in self.positions
+
+
+    # Fire the key once `delay` seconds have passed (rounded up to a whole tick)
+    def schedule(self, key, delay: float) -> None:
+        self.cancel(key)
+        expiry = max(self.current + 1, -int(-(time.monotonic() + delay) // self.TICK))
+        self.place(key, expiry)
+
+
+    def cancel(self, key) -> None:
+        position = self.positions.pop(key, None)
+
+        if position is not None:
+            level, slot = position
+            del self.wheels[level][slot][key]
+
+
+    # Lowest level whose slot will come round before the expiry: the one at which the
+    # expiry and the current tick first agree on every higher digit
+    def place(self, key, expiry: int) -> None:
+        width = 1
+        level = 0
+
+        while level < self.LEVELS - 1 and expiry // (width * self.SLOTS) != self.current // (width * self.SLOTS):
+            width *= self.SLOTS
+            level += 1
+
+        slot = (expiry // width) % self.SLOTS
+        self.wheels[level][slot][key] = expiry
+        self.positions[key] = (level, slot)
+
+
+    # Move the wheel on to the current time and return the keys that have expired
+    def advance(self) -> list:
+        target = int(time.monotonic() / self.TICK)
+        expired = []
+
+        while self.current < target:
+            self.current += 1
+
+            # A wrapped level pulls the next slot of the level above down towards level 0
+            width = 1
+
+            for level in range(1, self.LEVELS):
+                width *= self.SLOTS
+
+                if self.current % width:
+                    break
+
+                slot = (self.current // width) % self.SLOTS
+                cascading = self.wheels[level][slot]
+
+                if cascading:
+                    self.wheels[level][slot] = {}
+
+                    for key, expiry in cascading.items():
+                        self.place(key, expiry)
+
+            slot = self.current % self.SLOTS
+            due = self.wheels[0][slot]
+
+            if due:
+                self.wheels[0][slot] = {}
+
+                for key in due:
+                    del self.positions[key]
+                    expired.append(key)
+
+        return expired
+
+
+    # Seconds until the next tick that has work (expiries or a cascade), capped at timeout
+    def wait(self, timeout: float = None):
+        if not self.positions:
+            return timeout
+
+        # Level 0 only holds expiries before the next cascade, so at most one revolution is scanned
+        first = self.current + 1
+        last = self.current - self.current % self.SLOTS + self.SLOTS
+        due = last
+
+        for tick in range(first, last):
+            if self.wheels[0][tick % self.SLOTS]:
+                due = tick
+                break
+
+        remaining = max(0.0, due * self.TICK - time.monotonic())
+
+        return remaining if timeout is None else min(timeout, remaining)
+
+
+
+# Application-level keepalive: a connection that has sent nothing for INTERVAL
+# seconds is pinged, and one that still sends nothing within TIMEOUT seconds of
+# the ping is reported dead. Any frame from the peer counts as a sign of life;
+# recording one is a single dict store, and the wheel only looks at a connection
+# once per interval.
+class Heartbeats:
+    def __init__(self, interval: float, timeout: float, tick: float = 1.0):
+        self.INTERVAL = interval
+        self.TIMEOUT = timeout
+        self.wheel = TimerWheel(tick)
+
+        # Key -> monotonic time the peer last sent anything
+        self.lastSeen = {}
+
+        # Keys pinged and not heard from since -> when the ping was sent
+        self.pinged = {}
+
+
+    def watch(self, key) -> None:
+        # Heartbeats are disabled
+        if self.INTERVAL is None:
+            return
+
+        self.lastSeen[key] = time.monotonic()
+        self.wheel.schedule(key, self.INTERVAL)
+
+
+    def seen(self, key) -> None:
+        if key in self.lastSeen:
+            self.lastSeen[key] = time.monotonic()
+
+
+    def forget(self, key) -> None:
+        self.lastSeen.pop(key, None)
+        self.pinged.pop(key, None)
+        self.wheel.cancel(key)
+
+
+    def wait(self, timeout: float = None):
+        return self.wheel.wait(timeout)
+
+
+    # (keys to ping now, keys that never answered their ping). Dead keys stay watched
+    # until the caller forgets them.
+    def expired(self):
+        ping = []
+        dead = []
+        now = time.monotonic()
+
+        for key in self.wheel.advance():
+            last = self.lastSeen[key]
+            pinged_at = self.pinged.get(key)
+
+            if pinged_at is not None and last < pinged_at:
+                dead.append(key)
+                continue
+
+            self.pinged.pop(key, None)
+            idle = now - last
+
+            if idle >= self.INTERVAL:
+                self.pinged[key] = now
+                self.wheel.schedule(key, self.TIMEOUT)
+                ping.append(key)
+            else:
+                # Heard from since the timer was set: look again when the interval is up
+                self.wheel.schedule(key, self.INTERVAL - idle)
+
+        return ping, dead
@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+
+# Optional TLS for the loop server and its clients.
+#
+# A loop server given a certificate still serves plaintext on the same port:
+# the first byte a client sends tells the two apart, since a TLS ClientHello
+# starts with a handshake record (0x16) and a 4-byte frame header never does
+# (frames are at most MAX_FRAME_BYTES long). TLS_REQUIRED turns plaintext clients away.
+# The handshake runs on the event loop like any other socket activity, and once
+# it is done the connection is handled as before, reading and writing through
+# the TLS socket.
+#
+# A full handshake costs a key exchange and a certificate signature on both
+# ends, and each room a client enters is a new connection. The server hands out
+# TLS 1.3 session tickets, and clients keep the newest session per server
+# address (TLSConnector), so entering a room, or reconnecting to one after a
+# drop, resumes the lobby's session instead of starting over. Tickets are
+# sealed with a key that lives in the server process, so they resume on the
+# process that issued them: a room worker or a restarted server does one full
+# handshake per client before resuming again.
+
+import select
+import selectors
+import socket
+import ssl
+
+from console import console
+
+
+# First byte of a TLS record carrying a handshake message, such as the ClientHello
+HANDSHAKE_RECORD = 0x16
+
+# Session tickets sent after each handshake. One is enough: clients resume with the newest
+# session they have, and every resumed connection is sent a fresh ticket.
+TICKETS = 1
+
+
+def serverContext(cert_file: str, key_file: str = None) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert_file, key_file)
+    context.num_tickets = TICKETS
+
+    return context
+
+
+# Verifies the server against ca_file (for a self-signed certificate, the certificate
+# itself) or, without one, the system's trusted CAs
+def clientContext(ca_file: str = None) -> ssl.SSLContext:
+    context = ssl.create_default_context(cafile=ca_file)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.sslsocket_class = ResumableSocket
+
+    return context
+
+
+
+# Client TLS socket that leaves its session with the connector that opened it when closed
+class ResumableSocket(ssl.SSLSocket):
+    connector = None
+    address = None
+
+    def close(self) -> None:
+        if self.connector is not None:
+            self.connector.keep(self.address, self)
+
+        super().close()
+
+
+
+# Opens TLS connections for a blocking client, resuming the newest session it has
+# for the same server address
+class TLSConnector:
+    def __init__(self, context: ssl.SSLContext):
+        self.context = context
+
+        # Newest resumable session, and the newest open socket, by (host, port). A TLS 1.3
+        # session only becomes resumable once its ticket has been read along with the
+        # server's first reply, so the socket is asked for it when the next connection opens.
+        self.sessions = {}
+        self.sockets = {}
+
+        # Handshakes done, and how many of them resumed a session
+        self.handshakes = 0
+        self.resumed = 0
+
+
+    # Remember sock's session for address if it can be resumed
+    def keep(self, address, sock) -> None:
+        session = sock.session
+
+        if session is not None and session.has_ticket:
+            self.sessions[address] = session
+
+
+    def session(self, address):
+        sock = self.sockets.get(address)
+
+        if sock is not None:
+            self.keep(address, sock)
+
+        return self.sessions.get(address)
+
+
+    # Handshake over a socket connected to address; the plain socket is taken over (or closed
+    # if the handshake fails)
+    def wrap(self, sock, address) -> ssl.SSLSocket:
+        # Handshake messages and requests are small and written whole, so nothing is gained by
+        # holding them back until the last write is acknowledged
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        tls_sock = self.context.wrap_socket(sock, server_hostname=address[0], session=self.session(address))
+
+        tls_sock.connector = self
+        tls_sock.address = address
+        self.sockets[address] = tls_sock
+        self.handshakes += 1
+        self.resumed += tls_sock.session_reused
+
+        return tls_sock
+
+
+    def connect(self, address, timeout: float = None) -> ssl.SSLSocket:
+        sock = socket.create_connection(address, timeout)
+
+        try:
+            return self.wrap(sock, address)
+        except BaseException:
+            sock.close()
+            raise
+
+
+    # Forget the sessions for a server, so the next connection does a full handshake
+    def forget(self, address) -> None:
+        self.sessions.pop(address, None)
+        self.sockets.pop(address, None)
+
+
+
+# Read side of a blocking TLS socket that other threads write to under lock. OpenSSL
+# must not read and write one connection at the same time, so the reader waits for
+# data without the lock and holds it only for a read that cannot block: what arrived
+# may be part of a record, or a session ticket with no data behind it.
+class LockedReader:
+    def __init__(self, sock: ssl.SSLSocket, lock):
+        self.sock = sock
+        self.lock = lock
+
+
+    def recv_into(self, buffer) -> int:
+        while True:
+            if not self.sock.pending():
+                select.select([self.sock], [], [])
+
+            with self.lock:
+                timeout = self.sock.gettimeout()
+                self.sock.setblocking(False)
+
+                try:
+                    return self.sock.recv_into(buffer)
+                except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                    continue
+                finally:
+                    self.sock.settimeout(timeout)
+
+
+
+# A loop server connection until it is known to be plaintext or its TLS handshake is
+# done. It stands in for the Connection as the socket's selector data, so the loop
+# only pays for TLS while a handshake is in progress; on success the socket is
+# registered for the Connection again.
+class ServerHandshake:
+    __slots__ = ("server", "conn")
+
+    def __init__(self, server, conn):
+        self.server = server
+        self.conn = conn
+
+
+    def handleEvent(self, mask: int) -> None:
+        conn = self.conn
+
+        if conn.closed:
+            return
+
+        if conn.tls is None:
+            self.sniff()
+        else:
+            self.handshake()
+
+
+    # Peek at the first byte: plaintext goes straight to the Connection, TLS is wrapped
+    def sniff(self) -> None:
+        server, conn = self.server, self.conn
+
+        try:
+            first = conn.sock.recv(1, socket.MSG_PEEK)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            first = b""
+
+        if not first:
+            server.closeClient(conn)
+            return
+
+        if first[0] != HANDSHAKE_RECORD:
+            if server.TLS_REQUIRED:
+                console.info("<Plaintext client refused: TLS is required>", "client")
+                server.closeClient(conn)
+                return
+
+            conn.tls = False
+            server.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+            server.readClient(conn)
+            return
+
+        # Wrapping takes the descriptor over from the plain socket, which the selector
+        # and connection table know the connection by
+        server.selector.unregister(conn.sock)
+        server.connectedUsers.pop(conn.sock, None)
+
+        # The handshake flights and session tickets are written separately; without this the
+        # tickets and the first reply wait on the client's delayed acknowledgement
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.sock = server.tlsContext.wrap_socket(conn.sock, server_side=True, do_handshake_on_connect=False)
+        conn.tls = True
+
+        server.connectedUsers[conn.sock] = conn
+        server.selector.register(conn.sock, selectors.EVENT_READ, self)
+
+        self.handshake()
+
+
+    def handshake(self) -> None:
+        server, conn = self.server, self.conn
+
+        try:
+            conn.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            server.selector.modify(conn.sock, selectors.EVENT_READ, self)
+            return
+        except ssl.SSLWantWriteError:
+            server.selector.modify(conn.sock, selectors.EVENT_WRITE, self)
+            return
+        except (ssl.SSLError, OSError) as e:
+            console.info(f"<TLS handshake failed: {getattr(e, 'reason', None) or e}>", "client")
+            server.stats.tlsFailures += 1
+            server.closeClient(conn)
+            return
+
+        conn.outbound.tls = True
+
+        server.stats.tlsHandshakes += 1
+        server.stats.tlsResumed += conn.sock.session_reused
+
+        # The username may have arrived with the end of the handshake; the loop only wakes
+        # for what is still in the socket, not what the TLS layer has already taken from it
+        server.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+        if conn.sock.pending():
+            server.readClient(conn)